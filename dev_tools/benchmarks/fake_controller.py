@@ -0,0 +1,53 @@
+import os
+import tty
+import time
+import select
+from threading import Thread
+
+# Fake controller running on the master side of a pty pair
+# The slave side can be opened by DeviceSerial as a real serial port (os.ttyname(controller.slave))
+# The controller answers "ok" to every line received. Notice that a pty is not limited by the baudrate: the benchmarks measure the software overhead
+# The controller keeps track of the time spent waiting for new lines after acking all the lines received (starvation)
+
+class PtyController():
+    def __init__(self, ack=b"ok\n"):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.ack = ack
+        self.bytes_received = 0
+        self.lines_received = 0
+        self.idle_time = 0
+        self._idle_since = None
+        self._running = False
+        self._th = Thread(target=self._thf, daemon=True)
+        self._th.name = "pty_controller"
+
+    def start(self):
+        self._running = True
+        self._th.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._th.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _thf(self):
+        while self._running:
+            r, _, _ = select.select([self.master], [], [], 0.1)
+            if not r:
+                continue
+            data = os.read(self.master, 4096)
+            if not self._idle_since is None:
+                self.idle_time += time.perf_counter() - self._idle_since
+                self._idle_since = None
+            self.bytes_received += len(data)
+            lines = data.count(b"\n")
+            self.lines_received += lines
+            if lines and not self.ack is None:
+                os.write(self.master, self.ack*lines)
+                if data.endswith(b"\n"):
+                    self._idle_since = time.perf_counter()      # all the lines received have been acked
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import argparse
+from math import cos, sin
+from array import array
+from collections import deque
+from threading import Event
+
+from server.hw_controller.feeder import Feeder, FeederEventHandler
+from server.hw_controller.device_serial import DeviceSerial
+from server.hw_controller.emulator import EmulatorClock, GRBL_MODEL
+from server.database.generic_playlist_element import GenericPlaylistElement
+from server.utils import settings_utils
+import server.hw_controller.firmware_defaults as firmware
+from dev_tools.benchmarks.fake_controller import PtyController
+
+# Benchmark for the full streaming path: Feeder (element -> producer -> send_gcode_command -> _generate_line) + DeviceSerial + device answers (_parse_device_line)
+# Streams synthetic spiral drawings to a grbl device (character counting protocol) and reports:
+#  * lines/s and bytes/s
+#  * ack round trip time percentiles (from the line passed to the serial device to the "ok" parsed by the feeder)
+#  * CPU per line (whole process: with the emulator includes the device model)
+#  * starvation: time the controller had nothing to do while the drawing was running
+#    (pty: time waiting for new lines after acking all the lines received, emulator: time with the planner empty)
+# Devices:
+#  * pty: fake controller that acks every line immediately (measures the software overhead)
+#  * emulator: grbl model of the emulator (RX buffer, planner, acceleration) running with the given clock speed.
+#    The starvation is meaningful only with a speed the feeder can keep up with (use "1" to emulate the real device)
+# The results are compared with the baseline file (same machine only): the run fails if a value is worse than the baseline by more than the tolerance
+# run it from the main project folder with: (env)$> python -m dev_tools.benchmarks.feeder_throughput
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "feeder_baseline.json")
+DEFAULT_SIZES = (1000, 10000, 100000)
+# relative tolerance used to compare the results with the baseline
+TOLERANCE = 0.25
+# metrics compared with the baseline: name -> True if higher is better
+COMPARED_METRICS = {"lines_per_s": True, "bytes_per_s": True, "cpu_us_per_line": False, "rtt_p99_ms": False}
+
+class SpiralDrawing(GenericPlaylistElement):
+    element_type = "benchmark"
+
+    def __init__(self, segments, segment_length=0.5, **kwargs):
+        super().__init__(element_type=SpiralDrawing.element_type, **kwargs)
+        self.segments = segments
+        self.segment_length = segment_length
+
+    # the lines are generated while the element is executed (1M segments do not fit comfortably in memory as a single string)
+    def execute(self, logger):
+        yield "G1 X0 Y0 F3000"
+        r, angle = 1.0, 0.0
+        for i in range(self.segments):
+            angle += self.segment_length/r
+            r += 0.05*self.segment_length
+            yield "G1 X{:.3f} Y{:.3f}".format(200 + r*cos(angle), 200 + r*sin(angle))
+
+class EndHandler(FeederEventHandler):
+    def __init__(self):
+        self.ended = Event()
+
+    def on_element_ended(self, element):
+        self.ended.set()
+
+# keeps track of the lines sent and of the acks received (the acks are in the same order of the lines)
+class AckTimer():
+    def __init__(self, feeder):
+        self.sent = deque()
+        self.rtt = array("d")
+        self.bytes_sent = 0
+        self.lines_sent = 0
+        send = feeder.serial.send
+        def timed_send(line):
+            # text or bytes (fast mode lines, marlin resends joined in a single write): every line ends with a newline
+            # a single realtime byte does not get an ack and is not counted
+            count = line.count("\n" if isinstance(line, str) else b"\n")
+            if count > 0:
+                now = time.perf_counter()
+                self.sent.extend([now]*count)
+                self.bytes_sent += len(line)
+                self.lines_sent += count
+            send(line)
+        feeder.serial.send = timed_send
+        ack_received = feeder._ack_received
+        def timed_ack(*args, **kwargs):
+            if len(args) == 0 and len(kwargs) == 0 and len(self.sent) > 0:
+                self.rtt.append(time.perf_counter() - self.sent.popleft())
+            ack_received(*args, **kwargs)
+        feeder._ack_received = timed_ack
+
+    def percentile(self, p):
+        if len(self.rtt) == 0:
+            return 0
+        values = sorted(self.rtt)
+        return values[min(int(len(values)*p/100), len(values) - 1)]
+
+def create_feeder(serial):
+    settings = settings_utils.load_settings()
+    settings["device"]["firmware"]["value"] = firmware.GRBL.name
+    feeder = Feeder()
+    feeder.update_settings(settings)
+    feeder.serial = serial
+    serial.set_onreadline_callback(feeder.on_serial_read)
+    serial.start_reading()
+    return feeder
+
+def run(device, segments, speed):
+    controller = None
+    if device == "pty":
+        controller = PtyController().start()
+        serial = DeviceSerial(controller.port, 115200)
+        get_starvation = lambda: controller.idle_time
+    else:
+        serial = DeviceSerial(emulator_clock=EmulatorClock(speed), emulator_model=GRBL_MODEL)
+        serial._emulator.firmware = firmware.GRBL.name
+        get_starvation = lambda: serial._emulator.grbl.starved_time
+    feeder = create_feeder(serial)
+    handler = EndHandler()
+    feeder.set_event_handler(handler)
+    timer = AckTimer(feeder)
+
+    starvation = get_starvation()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    feeder.start_element(SpiralDrawing(segments))
+    handler.ended.wait()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    starvation = get_starvation() - starvation
+
+    serial.close()
+    if not controller is None:
+        controller.stop()
+    lines = max(timer.lines_sent, 1)
+    return {
+        "lines_per_s":      timer.lines_sent/elapsed,
+        "bytes_per_s":      timer.bytes_sent/elapsed,
+        "rtt_p50_ms":       timer.percentile(50)*1e3,
+        "rtt_p90_ms":       timer.percentile(90)*1e3,
+        "rtt_p99_ms":       timer.percentile(99)*1e3,
+        "cpu_us_per_line":  cpu/lines*1e6,
+        "starvation_s":     starvation,
+        "elapsed_s":        elapsed
+    }
+
+def report(name, result):
+    print("{:18s} {:9.0f} lines/s {:10.0f} bytes/s  rtt p50/p90/p99 {:6.2f}/{:6.2f}/{:6.2f} ms {:7.1f} us CPU/line  starved {:6.2f} s of {:6.2f} s".format(
+        name, result["lines_per_s"], result["bytes_per_s"], result["rtt_p50_ms"], result["rtt_p90_ms"], result["rtt_p99_ms"], result["cpu_us_per_line"], result["starvation_s"], result["elapsed_s"]))
+
+# returns the list of the regressions compared with the baseline
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if not name in baseline:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value, reference = result[metric], baseline[name][metric]
+            if higher_is_better and value < reference*(1 - tolerance) or not higher_is_better and value > reference*(1 + tolerance):
+                regressions.append("{} {}: {:.2f} (baseline {:.2f})".format(name, metric, value, reference))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Feeder throughput benchmark")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="number of segments of the drawings (1000 to 1000000)")
+    parser.add_argument("-d", "--devices", nargs="+", default=("pty", "emulator"), choices=("pty", "emulator"), help="devices used for the benchmark")
+    parser.add_argument("--speed", default="instant", help="clock speed of the emulator: 1 (real time), 10, ..., instant")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="saves the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative tolerance used to compare the results with the baseline")
+    args = parser.parse_args()
+
+    results = {}
+    for device in args.devices:
+        for size in args.sizes:
+            name = "{}_{}".format(device, size)
+            results[name] = run(device, size, args.speed)
+            report(name, results[name])
+
+    if args.save:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            f.write(json.dumps(baseline, indent=4))
+        print("Baseline saved")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print("Regression: " + r)
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,102 @@
+import re
+import time
+import argparse
+from math import cos, sin
+
+from server.utils.gcode_tokenizer import tokenize, tokenize_all
+
+# Benchmark for the gcode tokenizer
+# The old parsers (one for every module) are measured for comparison:
+#  * feeder: "findall" with a regex for every value (F, X, Y)
+#  * emulator: same as the feeder but the regexes do not accept negative values
+#  * split: "str.split" loop used by the rescalers and the thumbnails
+#  * tokenize (old): regex "findall" and a second "sub" to check for extra characters
+# The new tokenizer parses the values and the command once, both for single lines and for whole files (tokenize_all)
+# run it from the main project folder with: (env)$> python -m dev_tools.benchmarks.gcode_tokenizer
+
+_feed_regex = re.compile("[F]([0-9.-]+)($|\s)")
+_x_regex = re.compile("[X]([0-9.-]+)($|\s)")
+_y_regex = re.compile("[Y]([0-9.-]+)($|\s)")
+_emulator_x_regex = re.compile("[X]([0-9.]+)($|\s)")
+_emulator_y_regex = re.compile("[Y]([0-9.]+)($|\s)")
+_emulator_f_regex = re.compile("[F]([0-9.]+)($|\s)")
+_word_regex = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+
+def generate_lines(n, compact=False):
+    lines = ["G1 X{:.3f} Y{:.3f} F3000".format(200 + i*0.01*cos(i*0.1), 200 + i*0.01*sin(i*0.1)) for i in range(n)]
+    if compact:
+        lines = [l.replace(" ", "") for l in lines]
+    return lines
+
+def parse_feeder(line):
+    x = y = f = None
+    if "F" in line:
+        f = float(_feed_regex.findall(line)[0][0])
+    if "X" in line:
+        x = float(_x_regex.findall(line)[0][0])
+    if "Y" in line:
+        y = float(_y_regex.findall(line)[0][0])
+    return x, y, f
+
+def parse_emulator(line):
+    x = y = f = None
+    values = _emulator_f_regex.findall(line)
+    if len(values) > 0:
+        f = float(values[0][0])
+    try:
+        x = float(_emulator_x_regex.findall(line)[0][0])
+    except:
+        pass
+    try:
+        y = float(_emulator_y_regex.findall(line)[0][0])
+    except:
+        pass
+    return x, y, f
+
+def parse_split(line):
+    x = y = None
+    for p in line.split(" "):
+        if len(p) > 1:
+            if p[0].upper() == "X":
+                try:
+                    x = float(p[1:])
+                except: pass
+            elif p[0].upper() == "Y":
+                try:
+                    y = float(p[1:])
+                except: pass
+    return x, y
+
+def parse_old_tokenizer(line):
+    line = line.strip().upper()
+    words = _word_regex.findall(line)
+    extra = _word_regex.sub("", line).strip() != ""
+    return [(letter, float(value)) for letter, value in words], extra
+
+# returns the time per line and the number of lines that could not be parsed
+def measure(f, lines):
+    errors = 0
+    start = time.perf_counter()
+    for l in lines:
+        try:
+            f(l)
+        except (IndexError, ValueError):
+            errors += 1
+    return (time.perf_counter() - start)/len(lines), errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gcode tokenizer benchmark")
+    parser.add_argument("-n", "--lines", type=int, default=100000, help="number of lines to parse")
+    args = parser.parse_args()
+
+    for compact in (False, True):
+        lines = generate_lines(args.lines, compact)
+        print("{} lines (\"{}\")".format("compact" if compact else "spaced", lines[1]))
+        for name, f in (("feeder regex", parse_feeder), ("emulator regex", parse_emulator), ("split", parse_split), ("tokenize (old)", parse_old_tokenizer), ("tokenize", tokenize)):
+            t, errors = measure(f, lines)
+            print("  {:15s} {:6.2f} us/line{}".format(name, t*1e6, "   ({} lines not parsed)".format(errors) if errors > 0 else ""))
+        start = time.perf_counter()
+        tokenize_all(lines)
+        print("  {:15s} {:6.2f} us/line".format("tokenize_all", (time.perf_counter() - start)/len(lines)*1e6))
+    # the old parsers do not agree on the negative values
+    print("emulator regex on \"G1 X-10 Y5\": {}, tokenize: {}".format(parse_emulator("G1 X-10 Y5"), tokenize("G1 X-10 Y5")))
@@ -0,0 +1,86 @@
+import time
+import argparse
+from math import cos, sin
+
+from server.hw_controller.line_encoder import LineEncoder, get_decimals
+from server.utils.gcode_tokenizer import tokenize
+
+# Benchmark for the fast mode line encoder
+# Compares the lines generated for a spiral drawing (planner feedrates: the F word changes every few segments):
+#  * normal: line sent as it is (marlin: "N<n> <line> *<checksum>")
+#  * old fast mode: spaces removed and X, Y rounded (the G1 and F words are repeated on every line, per character checksum)
+#  * encoder: modal words dropped (marlin keeps the motion command), decimals from the steps per unit, checksum on the bytes
+#  * encoder (parsed): same but with the lines already parsed (the drawings are streamed as parsed commands)
+# Reports bytes/line, us/line and the max lines/s that fit in the serial bandwidth (10 bits per byte)
+# run it from the main project folder with: (env)$> python -m dev_tools.benchmarks.line_encoder
+
+BAUDRATE = 115200
+
+def generate_lines(n):
+    lines = []
+    r, angle = 1.0, 0.0
+    for i in range(n):
+        angle += 0.5/r
+        r += 0.025
+        lines.append("G1 X{:.3f} Y{:.3f} F{}".format(200 + r*cos(angle), 200 + r*sin(angle), 2000 + 50*((i//4) % 10)))
+    return lines
+
+def old_checksum(line):
+    cs = 0
+    for i in line:
+        cs = cs ^ ord(i)
+    return cs & 0xff
+
+def encode_normal(lines, marlin):
+    res = []
+    for n, l in enumerate(lines):
+        if marlin:
+            l = "N{} {} ".format(n, l)
+            l += "*{}\n".format(old_checksum(l))
+        else: l += "\n"
+        res.append(l.encode())
+    return res
+
+def encode_old_fast_mode(lines, marlin, resolution="{:.3f}"):
+    res = []
+    for n, command in enumerate(lines):
+        new_line = []
+        for l in command.split(" "):
+            if l.startswith("X"):
+                l = "X" + resolution.format(float(l[1:])).rstrip("0").rstrip(".")
+            elif l.startswith("Y"):
+                l = "Y" + resolution.format(float(l[1:])).rstrip("0").rstrip(".")
+            new_line.append(l)
+        line = "".join(new_line)
+        if marlin:
+            line = "N{}{}".format(n, line)
+            line += "*{}\n".format(old_checksum(line))
+        else: line += "\n"
+        res.append(line.encode())
+    return res
+
+def encode_new(lines, marlin, decimals):
+    encoder = LineEncoder(decimals)
+    return [encoder.encode(l, n if marlin else None) for n, l in enumerate(lines)]
+
+def measure(f, *args):
+    start = time.perf_counter()
+    res = f(*args)
+    return time.perf_counter() - start, res
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fast mode line encoder benchmark")
+    parser.add_argument("-n", "--lines", type=int, default=100000, help="number of lines to encode")
+    parser.add_argument("--steps", type=float, default=80, help="steps per unit of the motors")
+    args = parser.parse_args()
+    lines = generate_lines(args.lines)
+    parsed = [tokenize(l) for l in lines]
+    decimals = get_decimals(args.steps)
+
+    for marlin in (False, True):
+        print("Marlin" if marlin else "Grbl")
+        for name, f, f_lines, f_args in (("normal", encode_normal, lines, ()), ("old fast mode", encode_old_fast_mode, lines, ()),
+                                         ("encoder", encode_new, lines, (decimals,)), ("encoder (parsed)", encode_new, parsed, (decimals,))):
+            t, res = measure(f, f_lines, marlin, *f_args)
+            size = sum(len(l) for l in res)/len(res)
+            print("  {:16s} {:6.2f} bytes/line {:6.2f} us/line {:6.0f} lines/s at {} baud".format(name, size, t/len(lines)*1e6, BAUDRATE/10/size, BAUDRATE))
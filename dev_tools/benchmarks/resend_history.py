@@ -0,0 +1,64 @@
+import time
+import argparse
+from copy import deepcopy
+
+from server.utils.limited_size_dict import LimitedSizeDict
+from server.utils.resend_history import ResendHistory
+from server.hw_controller.feeder import RESEND_HISTORY_SIZE
+
+# Benchmark for the history of the lines sent to Marlin (used to answer the "Resend: N" requests)
+#  * add: per line overhead of the history tracking (done for every line sent)
+#  * resend: time to collect the lines to send again when a resend is requested
+# The old history (LimitedSizeDict with "N123" keys, copied and scanned on every resend) is measured for comparison
+# run it from the main project folder with: (env)$> python -m dev_tools.benchmarks.resend_history
+
+def generate_lines(n):
+    return ["N{} G1 X{:.3f} Y{:.3f} *{}\n".format(i, (i*0.2) % 500, (i*0.7) % 500, i % 256) for i in range(n)]
+
+def add_dict(lines):
+    history = LimitedSizeDict(size_limit=RESEND_HISTORY_SIZE)
+    for n, l in enumerate(lines):
+        history["N{}".format(n)] = l
+    return history
+
+def add_ring(lines):
+    history = ResendHistory(RESEND_HISTORY_SIZE)
+    for n, l in enumerate(lines):
+        history.add(n, l.encode())
+    return history
+
+def resend_dict(history, line_number):
+    items = deepcopy(history)
+    lines = []
+    for n, c in items.items():
+        if int(n.strip("N")) >= line_number:
+            lines.append(c.encode())
+    return b"".join(lines)
+
+def resend_ring(history, line_number):
+    _, lines = history.get_from(line_number)
+    return b"".join(lines)
+
+def measure(f, *args, repeat=1):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = f(*args)
+    return (time.perf_counter() - start)/repeat, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Marlin resend history benchmark")
+    parser.add_argument("-n", "--lines", type=int, default=200000, help="number of lines to add to the history")
+    parser.add_argument("-r", "--resends", type=int, default=2000, help="number of resend requests")
+    args = parser.parse_args()
+    lines = generate_lines(args.lines)
+    # the resend request is for one of the lines still waiting for an ack (8 lines buffered by the device)
+    line_number = args.lines - 8
+
+    t_dict, dict_history = measure(add_dict, lines)
+    t_ring, ring_history = measure(add_ring, lines)
+    print("add    dict {:7.3f} us/line   ring {:7.3f} us/line".format(t_dict/args.lines*1e6, t_ring/args.lines*1e6))
+
+    r_dict, data_dict = measure(resend_dict, dict_history, line_number, repeat=args.resends)
+    r_ring, data_ring = measure(resend_ring, ring_history, line_number, repeat=args.resends)
+    assert data_dict == data_ring
+    print("resend dict {:7.3f} us        ring {:7.3f} us".format(r_dict*1e6, r_ring*1e6))
@@ -0,0 +1,90 @@
+import time
+import argparse
+from threading import Condition
+
+from server.hw_controller.device_serial import DeviceSerial
+from dev_tools.benchmarks.fake_controller import PtyController
+
+# Benchmark for the DeviceSerial write path
+# Streams synthetic G1 lines to a pty-backed fake controller and reports bytes/s, lines/s, CPU per line and the number of write calls
+#  * raw: the lines are sent as fast as possible (measures the write queue and the coalescing)
+#  * acked: the lines are sent with the character counting protocol (128 bytes RX buffer), every line waits for the controller ack
+# run it from the main project folder with: (env)$> python -m dev_tools.benchmarks.serial_write
+
+RX_BUFFER_SIZE = 128
+
+def generate_lines(n):
+    return ["G1 X{:.3f} Y{:.3f}\n".format((i*0.2) % 500, (i*0.7) % 500) for i in range(n)]
+
+def open_device(controller):
+    device = DeviceSerial(controller.port, 115200)
+    # counts the write calls to check the coalescing
+    device.write_calls = 0
+    write = device.serial.write
+    def counted_write(data):
+        device.write_calls += 1
+        return write(data)
+    device.serial.write = counted_write
+    return device
+
+def run_raw(lines):
+    controller = PtyController(ack=None).start()
+    device = open_device(controller)
+    start, cpu_start = time.time(), time.process_time()
+    for l in lines:
+        device.send(l)
+    device.drain(timeout=30)
+    elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+    result = report("raw", lines, elapsed, cpu, device.write_calls)
+    device.close()
+    controller.stop()
+    return result
+
+def run_acked(lines):
+    controller = PtyController().start()
+    device = open_device(controller)
+    condition = Condition()
+    in_flight = []
+
+    def on_line(line):
+        with condition:
+            if len(in_flight) > 0:
+                in_flight.pop(0)
+            condition.notify_all()
+    device.set_onreadline_callback(on_line)
+    device.start_reading()
+
+    start, cpu_start = time.time(), time.process_time()
+    for l in lines:
+        with condition:
+            while sum(in_flight) + len(l) > RX_BUFFER_SIZE:
+                condition.wait()
+            in_flight.append(len(l))
+        device.send(l)
+    with condition:
+        while len(in_flight) > 0:
+            condition.wait()
+    elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+    result = report("acked", lines, elapsed, cpu, device.write_calls)
+    device.close()
+    controller.stop()
+    return result
+
+def report(name, lines, elapsed, cpu, write_calls):
+    n_bytes = sum(len(l) for l in lines)
+    result = {
+        "lines_per_s":      len(lines)/elapsed,
+        "bytes_per_s":      n_bytes/elapsed,
+        "cpu_us_per_line":  cpu/len(lines)*1e6,
+        "lines_per_write":  len(lines)/max(write_calls, 1)
+    }
+    print("{:6s} {:9.0f} lines/s {:10.0f} bytes/s {:7.1f} us CPU/line {:6.1f} lines/write".format(name, *result.values()))
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DeviceSerial write path benchmark")
+    parser.add_argument("-n", "--lines", type=int, default=20000, help="number of lines to send")
+    args = parser.parse_args()
+    lines = generate_lines(args.lines)
+    run_raw(lines)
+    run_acked(lines)
@@ -72,6 +72,11 @@ function deviceNewPosition(cb) {
     socket.on("preview_new_position", (val) => { cb(val) });
 }
 
+// pass to the callback the position executed by the device while drawing: {x, y, length, total_length}
+function deviceExecutedPosition(cb) {
+    socket.on("preview_executed_position", (val) => { cb(val) });
+}
+
 // pass to the callback the leds values
 function deviceLeds(cb) {
     socket.on("preview_leds", (val) => { cb(val) });
@@ -102,6 +107,7 @@ export {
     queueStatus,
     deviceCommandLineReturn,
     deviceNewPosition,
+    deviceExecutedPosition,
     deviceLeds,
     settingsNow,
     showToast
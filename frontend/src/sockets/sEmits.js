@@ -142,10 +142,20 @@ function liveModeStop() {
     socket.emit("live_mode_stop");
 }
 
+// new target of the live mode: the server coalesces the points and streams them as jog moves
+function liveJog(x, y, feedrate) {
+    socket.emit("live_jog", x, y, feedrate);
+}
+
 function setMaxDrawingFeedrate(value) {
     socket.emit("set_max_drawing_feedrate", value);
 }
 
+// speed of the device as a percentage of the programmed feedrate
+function setFeedOverride(value) {
+    socket.emit("set_feed_override", value);
+}
+
 // ---- MANUAL CONTROL ----
 
 function controlEmergencyStop() {
@@ -176,7 +186,9 @@ export {
     ledsAutoDim,
     liveModeStart,
     liveModeStop,
+    liveJog,
     setMaxDrawingFeedrate,
+    setFeedOverride,
     playlistsRequest,
     playlistDelete,
     playlistQueue,
@@ -3,7 +3,7 @@ import { Form, Button, Modal, InputGroup } from 'react-bootstrap';
 import { Trash, Broadcast, Gear, Upload } from 'react-bootstrap-icons';
 import { useSelector } from 'react-redux';
 import RotaryDial from './RotaryDial';
-import { sendCommand, liveModeStart, liveModeStop } from '../../../sockets/sEmits';
+import { liveModeStart, liveModeStop, liveJog } from '../../../sockets/sEmits';
 import { getTableConfig, getCanvasDisplaySize } from '../../../utils/tableConfig';
 import { generateGCode, uploadGCode, CoordinateType } from '../../../utils/gcodeGenerator';
 import { canvasToGcode } from '../../../utils/coordinateTransform';
@@ -272,7 +272,8 @@ function EtchASketch() {
         });
     }, [resolution, liveModeDistanceScale]);
 
-    // Live mode streaming: send G-code at fixed intervals (handles straight lines)
+    // Live mode streaming: send the cursor position at fixed intervals
+    // The server coalesces the targets and moves the device toward the latest one with short jog moves
     // Only depends on liveTrack to start/stop — reads other values from refs
     useEffect(() => {
         if (liveTrack) {
@@ -286,13 +287,13 @@ function EtchASketch() {
                 if (path.length === 0) return;
                 const currentPos = path[path.length - 1];
 
-                // Always send the current position, even if unchanged
-                // This keeps the machine moving toward the target during straight lines
+                // The server keeps moving toward the last target: unchanged positions are not sent again
+                const last = lastSentPositionRef.current;
+                if (last && last.x === currentPos.x && last.y === currentPos.y) return;
                 const currentConfig = configRef.current;
                 const feedrate = liveModeFeedrateRef.current;
                 const gp = canvasToGcode(currentPos.x, 1 - currentPos.y, 1, 1, currentConfig);
-                const gcode = `G1 X${gp.x.toFixed(3)} Y${gp.y.toFixed(3)} F${feedrate}`;
-                sendCommand(gcode);
+                liveJog(gp.x, gp.y, feedrate);
 
                 lastSentPositionRef.current = { x: currentPos.x, y: currentPos.y };
             }, liveModeIntervalRef.current);
@@ -3,12 +3,14 @@ import "./ManualControl.scss";
 import React, { Component } from 'react';
 import { connect } from "react-redux";
 
-import { deviceNewPosition } from '../../../sockets/sCallbacks';
+import { deviceNewPosition, deviceExecutedPosition } from '../../../sockets/sCallbacks';
 import { getDevice, getIsFastMode } from "../settings/selector";
 import { dictsAreEqual } from "../../../utils/dictUtils";
 
 const ANIMATION_FRAMES_MAX = 10;
 const ANIMATION_DURATION = 1000;
+// the lines sent are drawn only if the device is not reporting the executed position
+const EXECUTED_POSITION_TIMEOUT = 1000;
 
 const mapStateToProps = (state) => {
     // Safety checks to prevent crash on initial load or if settings are missing
@@ -43,6 +45,7 @@ class Preview extends Component {
         this.isPreviewMounted = false;
         this.forceImageRender = false;
         this.animationFrames = 0;
+        this.lastExecutedPositionTime = 0;
 
         // previous commanded point
         this.pp = {
@@ -69,6 +72,7 @@ class Preview extends Component {
                 this.forceUpdate();
                 console.log("Preview Debug: Subscribing to deviceNewPosition");
                 deviceNewPosition(this.newLineFromDevice.bind(this));
+                deviceExecutedPosition(this.newExecutedPosition.bind(this));
             }
         }
         // Start interval here
@@ -141,6 +145,10 @@ class Preview extends Component {
             }
         }
 
+        this.drawPoint(x, y);
+    }
+
+    drawPoint(x, y) {
         this.pp.x = x;
         this.pp.y = y;
 
@@ -219,11 +227,19 @@ class Preview extends Component {
         if (line.includes("G28")) {
             this.clearCanvas();
         }
+        if (Date.now() - this.lastExecutedPositionTime < EXECUTED_POSITION_TIMEOUT) {
+            return;     // the lines sent are ahead of the device: the preview follows the executed position
+        }
         if (line.includes("G0") || line.includes("G1") || line.includes("G00") || line.includes("G01")) {
             this.drawLine(line);
         }
     }
 
+    newExecutedPosition(position) {
+        this.lastExecutedPositionTime = Date.now();
+        this.drawPoint(this.roundFloat(position.x), this.roundFloat(position.y));
+    }
+
     render() {
         if (this.props.device.type === "Cartesian") {
             // Use physical dimensions if available, otherwise fall back to drawing dimensions
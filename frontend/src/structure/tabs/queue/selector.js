@@ -26,6 +26,9 @@ const getQueueIsRunning =       state => {return state.queue.status.is_running}
 // returns the current interval value for the queue
 const getIntervalValue =        state => {return state.queue.interval}
 
+// returns the speed override percentage used by the device (undefined until the first status is received)
+const getFeedOverride =         state => {return state.queue.status.feed_override}
+
 export {
     getQueueEmpty, 
     getQueueElements, 
@@ -35,5 +38,6 @@ export {
     getQueueRepeat, 
     getQueueShuffle, 
     getQueueIsRunning, 
-    getIntervalValue
+    getIntervalValue,
+    getFeedOverride
 };
\ No newline at end of file
@@ -2,15 +2,17 @@ import React, { Component } from 'react';
 import { Container, Form, Col, Button, Row, Card, Accordion } from 'react-bootstrap';
 import { PlusSquare, Save, Trash, Joystick, Lightbulb, Gear, PlayFill, Cpu, Speedometer2 } from 'react-bootstrap-icons';
 import { connect } from 'react-redux';
+import _ from 'lodash';
 
 import { Section, Subsection, SectionGroup } from '../../../components/Section';
 import IconButton from '../../../components/IconButton';
 
 import { getSettings } from "./selector.js";
+import { getFeedOverride } from "../queue/selector.js";
 import { createNewHWButton, removeHWButton, updateAllSettings, updateSetting } from "./Settings.slice.js";
 
 import { settingsNow } from '../../../sockets/sCallbacks';
-import { settingsSave, setMaxDrawingFeedrate } from '../../../sockets/sEmits';
+import { settingsSave, setMaxDrawingFeedrate, setFeedOverride } from '../../../sockets/sEmits';
 import { cloneDict } from '../../../utils/dictUtils';
 import SettingField from './SettingField';
 import SoftwareVersion from './SoftwareVersion';
@@ -23,7 +25,8 @@ import GrblSettings from './GrblSettings';
 
 const mapStateToProps = (state) => {
     return {
-        settings: getSettings(state)
+        settings: getSettings(state),
+        feedOverride: getFeedOverride(state)
     }
 }
 
@@ -36,7 +39,12 @@ const mapDispatchToProps = (dispatch) => {
     }
 }
 
+// min interval between the speed override values sent while the slider is dragged [ms]
+const FEED_OVERRIDE_THROTTLE = 200;
+
 class Settings extends Component {
+    // the speed override is sent at most every FEED_OVERRIDE_THROTTLE ms while the slider is dragged (the last value is always sent)
+    sendFeedOverride = _.throttle((val) => setFeedOverride(val), FEED_OVERRIDE_THROTTLE);
 
     componentDidMount() {
         settingsNow((data) => {
@@ -202,8 +210,20 @@ class Settings extends Component {
             .catch(err => window.showToast("Reconnect error: " + err));
     }
 
+    componentDidUpdate(prevProps) {
+        // the value selected with the slider is shown until the device reports the new speed override
+        if (prevProps.feedOverride !== this.props.feedOverride && this.state && this.state.feedOverride === this.props.feedOverride)
+            this.setState({ feedOverride: undefined });
+    }
+
     componentWillUnmount() {
         if (this.statusInterval) clearInterval(this.statusInterval);
+        this.sendFeedOverride.flush();
+    }
+
+    getFeedOverride() {
+        if (this.state && this.state.feedOverride !== undefined) return this.state.feedOverride;
+        return this.props.feedOverride !== undefined ? this.props.feedOverride : 100;
     }
 
     checkStatus() {
@@ -476,6 +496,28 @@ class Settings extends Component {
                                                     Limits the maximum speed for drawings played from the queue. Does not affect live mode.
                                                 </small>
                                             </Form.Group>
+                                            <Form.Group>
+                                                <Form.Label className="text-white d-flex justify-content-between">
+                                                    <span>Speed override</span>
+                                                    <span>{this.getFeedOverride()} %</span>
+                                                </Form.Label>
+                                                <Form.Control
+                                                    type="range"
+                                                    min={10}
+                                                    max={200}
+                                                    step={10}
+                                                    value={this.getFeedOverride()}
+                                                    onChange={(e) => {
+                                                        const val = parseInt(e.target.value, 10);
+                                                        this.setState({ feedOverride: val === this.props.feedOverride ? undefined : val });
+                                                        this.sendFeedOverride(val);
+                                                    }}
+                                                    className="custom-range"
+                                                />
+                                                <small className="text-muted mt-2 d-block">
+                                                    Changes the speed of the device immediately, also for the moves already sent (Grbl). Marlin applies it after the moves already in its buffer.
+                                                </small>
+                                            </Form.Group>
                                         </Container>
                                     </Card.Body>
                                 </Accordion.Collapse>
@@ -39,6 +39,13 @@ const defaultSettings = {
 			value: false,
 			label: "Enable fast mode",
 			tip: "Will make the command as short as possible to have a faster communication (will remove spaces and unnecessary line numbers)"
+		},
+		position_poll_rate: {
+			name: "serial.position_poll_rate",
+			type: "input",
+			value: 5,
+			label: "Position updates per second",
+			tip: "How often the position of the device is requested while drawing (Grbl only) to show the real progress and ball position. Use 0 to disable"
 		}
 	},
 	device: {
@@ -225,6 +232,63 @@ const defaultSettings = {
 				"Scara"
 			],
 			tip: "Angle for the home position of the second arm (uses the values from the conversion factor, not rad: if angle_conversion_factor is 6 and must shift the homing by half turn must put 1.5"
+		},
+		ball_diameter: {
+			name: "device.ball_diameter",
+			type: "input",
+			value: 10,
+			label: "Ball diameter (mm)",
+			tip: "Diameter of the ball. Used to decide how much the drawings can be simplified"
+		},
+		path_simplification: {
+			name: "device.path_simplification",
+			type: "check",
+			value: false,
+			label: "Simplify dense drawings",
+			tip: "Removes the points that are closer to the path than the tolerance so that the device can move faster on drawings with many tiny segments"
+		},
+		simplification_tolerance: {
+			name: "device.simplification_tolerance",
+			type: "input",
+			value: 0,
+			label: "Simplification tolerance (mm)",
+			tip: "Max distance between the optimized path (simplified or with arcs) and the original one. Use 0 to derive it from the ball diameter (5% of the diameter)"
+		},
+		arc_fitting: {
+			name: "device.arc_fitting",
+			type: "check",
+			value: false,
+			label: "Use arcs for curves",
+			tip: "Replaces the sequences of points lying on a circle with arc commands (G2/G3). The firmware must support arcs"
+		},
+		feedrate_planner: {
+			name: "device.feedrate_planner",
+			type: "check",
+			value: false,
+			label: "Plan the feedrate",
+			tip: "Sets the feedrate of every segment from the shape of the drawing: slower in the tight turns, faster on the long straight lines. The max drawing feedrate is still applied"
+		},
+		planner_acceleration: {
+			name: "device.planner_acceleration",
+			type: "input",
+			value: 0,
+			label: "Acceleration (mm/s^2)",
+			depends_on: "device.feedrate_planner",
+			depends_values: [
+				true
+			],
+			tip: "Acceleration used to plan the feedrate. Use 0 to read it from the device (Grbl $120, $121)"
+		},
+		planner_max_feedrate: {
+			name: "device.planner_max_feedrate",
+			type: "input",
+			value: 0,
+			label: "Max planned feedrate (mm/min)",
+			depends_on: "device.feedrate_planner",
+			depends_values: [
+				true
+			],
+			tip: "Feedrate used on the long straight lines. Use 0 to read it from the device (Grbl $110, $111)"
 		}
 	},
 	scripts: {
@@ -267,6 +331,13 @@ const defaultSettings = {
 			value: 0,
 			label: "Interval between drawings [h]",
 			tip: "Write the number of seconds to let the table pause between drawings"
+		},
+		resume_drawing: {
+			name: "autostart.resume_drawing",
+			type: "check",
+			value: true,
+			label: "Resume interrupted drawing on power up",
+			tip: "If the device was turned off while drawing, the drawing continues from the last point reached"
 		}
 	},
 	leds: {
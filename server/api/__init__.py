@@ -1,2 +1,2 @@
 # added this file to avoid linter errors/warnings
-from . import drawings, leds, system, calibration, grbl_settings
\ No newline at end of file
+from . import drawings, leds, system, calibration, grbl_settings, metrics
\ No newline at end of file
@@ -0,0 +1,15 @@
+from flask import jsonify, Response
+from server import app
+from server.utils.metrics import metrics
+
+# ENDPOINT: GET /api/metrics - streaming metrics in the Prometheus text format
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.to_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ENDPOINT: GET /api/metrics/json - snapshot of the streaming metrics and of the feeder pipeline
+@app.route('/api/metrics/json', methods=['GET'])
+def get_metrics_json():
+    snapshot = metrics.snapshot()
+    snapshot["pipeline"] = app.feeder.get_pipeline_stats()
+    return jsonify(snapshot)
@@ -21,6 +21,8 @@ UNKNOWN_PROGRESS = {
     before_start method:
         by default returns the same element. 
         If the element is a placeholder to calculate some other type of element can return the correct element
+    interrupt method:
+        Called by the feeder when the element is stopped. Elements that wait inside "execute" (like the timing elements) must return as soon as possible
     get_progress method:
         Must return a dict with the following format:
             eta: float ETA value for the current element (-1 means "unknown")
@@ -55,6 +57,10 @@ class GenericPlaylistElement():
     def execute(self, logger):
         raise StopIteration("You must implement an iterator in every element class")
 
+    # called (from another thread) when the element is stopped while running
+    def interrupt(self):
+        pass
+
     # returns a dict with ETA
     # some type of elements may require a feedrate -> the function should always require a feedrate and should handle the case of a 0 feedrate
     # dict format:
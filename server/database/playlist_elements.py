@@ -1,12 +1,9 @@
 import os
-import re
 import json
 from pathlib import Path
-from dotmap import DotMap
-from time import time, sleep
+from time import time
+from threading import Condition
 from datetime import datetime, timedelta
-from math import sqrt
-import copy
 
 from server.database.models import UploadedFiles
 from server.database.playlist_elements_tables import get_playlist_table_class
@@ -14,6 +11,13 @@ from server.database.generic_playlist_element import GenericPlaylistElement
 from server.utils.settings_utils import LINE_RECEIVED
 from server.utils.gcode_converter import ImageFactory
 from server.utils.settings_utils import load_settings, get_only_values
+from server.utils.gcode_tokenizer import GcodeCommand, tokenize
+from server.utils.gcode_sidecar import open_sidecar, build_sidecar, load_transformed_path, get_drawing_fit_dimensions, PRE_TRANSFORMED_TAG
+from server.utils.path_simplification import get_tolerance, get_arc_tolerance
+from server.utils.arc_fitting import move_length
+from server.utils.feedrate_planner import get_planner_limits
+from server.utils.drawing_checkpoint import get_path_hash
+from server.hw_controller.gcode_rescalers import Fit
 
 """ 
     ---------------------------------------------------------------------------
@@ -41,11 +45,33 @@ class DrawingElement(GenericPlaylistElement):
             raise ValueError("The drawing id must be an integer")
         self._distance = 0
         self._total_distance = 0
-        self._new_position = DotMap({"x":0, "y":0})
-        self._last_position = self._new_position
-        self._x_regex = re.compile("[X]([0-9.-]+)($|\s)")                                           # looks for a +/- float number after an X, until the first space or the end of the line
-        self._y_regex = re.compile("[Y]([0-9.-]+)($|\s)")                                           # looks for a +/- float number after an Y, until the first space or the end of the line
-
+        self._index = 0             # number of commands yielded (used for the checkpoints, see "get_cursor")
+        self._offset = 0            # byte offset of the next line of the .gcode file (only when the sidecar is not available)
+        self._resume = None
+        self._path_index = None     # cumulative length and time of the path (see "PathIndex"): progress, ETA and position of the device on the drawing
+        self._executed_length = None    # length of the path executed by the device (None if the device position is not tracked)
+        self._feedrate = None       # feedrate of the last command yielded (the ETA of the index is scaled by the actual feedrate)
+        self._path_hash = 0         # transformed path played (the command index of the checkpoints refers to it, see "get_path_hash")
+
+    # resumes the drawing from a checkpoint (see "DrawingCheckpoint"): the commands already done are skipped
+    def set_resume_point(self, checkpoint):
+        self._resume = checkpoint
+
+    # returns the position of the last command yielded: (number of commands yielded, byte offset in the .gcode file)
+    def get_cursor(self):
+        return self._index, self._offset
+
+    # returns the hash of the transformed path played (0 if the drawing is not precompiled)
+    def get_path_hash(self):
+        return self._path_hash
+
+    # returns the cumulative length and time index of the path played (None if not available yet or if the drawing is not precompiled)
+    def get_path_index(self):
+        return self._path_index
+
+    # length of the path executed by the device (the commands yielded are ahead of the device by the whole device buffer)
+    def set_executed_length(self, length):
+        self._executed_length = length
         
     def execute(self, logger):
         # generate filename
@@ -71,54 +97,123 @@ class DrawingElement(GenericPlaylistElement):
             except Exception as e:
                 logger.exception(e)
 
-        with open(filename) as f:
+        # uses the precompiled version of the drawing (created again if missing or not valid anymore)
+        last_x, last_y = 0, 0
+        sidecar = open_sidecar(filename)
+        if sidecar is None:
+            try:
+                if not build_sidecar(filename) is None:
+                    sidecar = open_sidecar(filename)
+            except Exception as e:
+                logger.exception(e)
+        if not sidecar is None:
+            with sidecar:
+                # the coordinates are transformed for the table (orientation, scale, offset), simplified, fitted with arcs and planned at once and cached for the next runs
+                device = get_only_values(load_settings()["device"])
+                fit = Fit(get_drawing_fit_dimensions(sidecar, device))
+                path = load_transformed_path(filename, sidecar, fit, get_tolerance(device), get_arc_tolerance(device), get_planner_limits(device), logger)
+                self._path_index = path.index
+                self._path_hash = get_path_hash(path.key)
+                start = 0
+                if not self._resume is None and self._resume.path_hash != self._path_hash:
+                    # the device settings changed since the checkpoint: the index refers to a different path
+                    logger.warning("Cannot resume drawing {}: the drawing settings changed, restarting from the beginning".format(self.drawing_id))
+                elif not self._resume is None:
+                    # the sidecar records can be accessed directly: the drawing restarts from the last command done by the device
+                    indices = path.get_indices()
+                    start = min(self._resume.index, len(indices))
+                    logger.info("Resuming drawing {} from command {}/{}".format(self.drawing_id, start, len(indices)))
+                    self._index = start
+                    if start > 0:
+                        last = indices[start-1]
+                        yield GcodeCommand("G0", path.x[last], path.y[last])
+                        self._feedrate = sidecar.get_feedrate(last)
+                        if not self._feedrate is None:
+                            yield GcodeCommand("G1", f=self._feedrate)
+                # the distance travelled is read from the index (see "get_path_lenght_done")
+                for x, _, command in sidecar.iterate(path, fit, start):
+                    if not x is None:               # the segments of an interpolated arc are counted once (last segment)
+                        self._index += 1
+                    if not command.f is None:
+                        self._feedrate = command.f
+                    yield command
+            return
+
+        # drawings with relative coordinates are sent as they are
+        logger.warning("Cannot precompile the drawing {}: sending the original gcode without the table transformation".format(self.drawing_id))
+        with open(filename, "rb") as f:
+            if not self._resume is None and self._resume.path_hash == 0:
+                # the relative moves are sent from the saved offset: the position of the device cannot be restored
+                logger.warning("Resuming drawing {} from byte {} without restoring the position".format(self.drawing_id, self._resume.offset))
+                f.seek(self._resume.offset)
+                self._index, self._offset = self._resume.index, self._resume.offset
+                self._distance = self._total_distance * self._offset / max(os.path.getsize(filename), 1)
             for line in f:
+                self._offset += len(line)
+                line = line.decode(errors="replace")
                 # Check for special tag before stripping
-                if "; TYPE: PRE-TRANSFORMED" in line:
+                if PRE_TRANSFORMED_TAG in line:
                     yield line
                     continue
 
-                # clears the line
-                if line.startswith(";"):                                                            # skips commented lines
+                command = tokenize(line)
+                if command is None:                                                                 # skips empty and commented lines
                     continue
-                if ";" in line:                                                                     # remove in line comments
-                    line = line.split(";")[0]
                 # calculates the distance travelled
-                try:
-                    if "X" in line:
-                        self._new_position.x = float(self._x_regex.findall(line)[0][0])
-                    if "Y" in line:
-                        self._new_position.y = float(self._y_regex.findall(line)[0][0])
-                    self._distance += sqrt((self._new_position.x - self._last_position.x)**2 + (self._new_position.y - self._last_position.y)**2)
-                    self._last_position = copy.copy(self._new_position)
-                except Exception as e:
-                    logger.exception(e)
-                # yields the line
-                yield line
+                x = command.x if not command.x is None else last_x
+                y = command.y if not command.y is None else last_y
+                self._distance += move_length(last_x, last_y, x, y, command)
+                last_x, last_y = x, y
+                # yields the command
+                self._index += 1
+                yield command
 
     def get_progress(self, feedrate):
+        # precompiled drawings: the progress is read from the index of the path played
+        #  * the length done is the one executed by the device when its position is tracked (the commands yielded are ahead of the device)
+        #  * the ETA is the estimated time left (feedrate changes and slowdowns included) scaled by the actual feedrate of the device
+        #    (feed override, feedrate cap) with respect to the feedrate of the drawing
+        index = self._path_index
+        if not index is None and index.get_total_length() > 0:
+            done = self._executed_length if not self._executed_length is None else self.get_path_lenght_done()
+            if feedrate <= 0 or index.get_total_time() <= 0:
+                return {
+                    "eta": done/index.get_total_length() * 100,
+                    "units": "%"
+                }
+            scale = self._feedrate/feedrate if not self._feedrate is None and self._feedrate > 0 else 1
+            return {
+                "eta": (index.get_total_time() - index.get_time_at(done))*scale,
+                "units": "s"
+            }
+
+        total, done = self._total_distance, self._distance
         # if for some reason the total distance was not calculated the ETA is unknown
-        if self._total_distance == 0:
+        if total == 0:
             return super().get_progress(feedrate)
 
         # if a feedrate is available will use "s" otherwise will calculate the ETA as a percentage
         if feedrate <= 0:
             return {
-                "eta": self._distance/self._total_distance * 100,
+                "eta": done/total * 100,
                 "units": "%"
             }
         else:
             return {
-                "eta": (self._total_distance - self._distance)/feedrate,
+                "eta": (total - done)/feedrate,
                 "units": "s"
             }
     
     def get_path_length_total(self):
         """Returns the total lenght of the path of the drawing"""
+        if not self._path_index is None:
+            return self._path_index.get_total_length()
         return self._total_distance
     
     def get_path_lenght_done(self):
         """Returns the path lenght that has been done for the current drawing"""
+        if not self._path_index is None:
+            return self._path_index.get_length(self._index)
         return self._distance
 
 """
@@ -153,6 +248,8 @@ class TimeElement(GenericPlaylistElement):
         self.alarm_time = alarm_time if alarm_time != "" else None
         self.type = type
         self._final_time = -1
+        self._condition = Condition()       # wakes up the waiting element when the delay is changed or the element is stopped
+        self._interrupted = False
     
     def execute(self, logger):
         self._final_time = time()
@@ -173,22 +270,27 @@ class TimeElement(GenericPlaylistElement):
         else:                                                                                       # should not be the case because the check is done already in the constructore
             return         
         
-        while True:
-            if time() >= self._final_time:                                                          # If the delay expires can break the while to start the next element
-                break
-            elif time() < self._final_time-1:
-                logger.log(LINE_RECEIVED, "Waiting {:.1f} more seconds".format(self._final_time-time()))
-                sleep(1)
-                yield None
-            else: 
-                sleep(self._final_time-time())
-                yield None
+        yield None                                                                                  # the feeder can start the pipeline while the element waits
+        with self._condition:
+            while not self._interrupted:
+                remaining = self._final_time - time()
+                if remaining <= 0:                                                                  # If the delay expires can break the while to start the next element
+                    break
+                logger.log(LINE_RECEIVED, "Waiting {:.1f} more seconds".format(remaining))
+                self._condition.wait(remaining)                                                     # until the delay expires, is changed or the element is stopped
     
     # updates the delay value
     # used when in continuous mode
     def update_delay(self, interval):
-        self._final_time += (float(interval - self.delay))
-        self.delay = interval
+        with self._condition:
+            self._final_time += (float(interval - self.delay))
+            self.delay = interval
+            self._condition.notify_all()
+
+    def interrupt(self):
+        with self._condition:
+            self._interrupted = True
+            self._condition.notify_all()
 
     # return a progress only if the element is running
     def get_progress(self, feedrate):
@@ -1,5 +1,6 @@
 from enum import auto
 from threading import Thread, Lock
+from queue import Queue, Full, Empty
 import serial.tools.list_ports
 import serial
 import time
@@ -7,27 +8,38 @@ import traceback
 import sys
 import logging
 from server.hw_controller.emulator import Emulator
+from server.utils.metrics import metrics
 import glob
 
 # This class connects to a serial device
 # If the serial device request is not available it will create a virtual serial device
 
+READ_TIMEOUT = 0.5      # max time the read thread sleeps waiting for new bytes [s] (the thread is woken up as soon as some data is available)
+WRITE_TIMEOUT = 2       # max time a write can wait for the OS to accept the data (and period of the warnings while "send" waits for the write queue) [s]
+WRITE_QUEUE_SIZE = 64   # max number of lines waiting to be written by the write thread
+MAX_WRITE_CHUNK = 512   # max number of bytes coalesced in a single write
+DRAIN_POLL_TIME = 0.002 # polling period used while waiting for the OS output buffer to be empty [s]
+
+_serial_write_time = metrics.histogram("serial_write_seconds", "Time spent in the write calls of the serial port")
+_bytes_written = metrics.counter("serial_bytes_written_total", "Bytes written to the serial port")
+_serial_writes = metrics.counter("serial_writes_total", "Write calls of the serial port (several lines are coalesced in a single write)")
+
 class DeviceSerial():
-    def __init__(self, serialname = None, baudrate = 115200, logger_name = None, autostart = False):
+    def __init__(self, serialname = None, baudrate = 115200, logger_name = None, autostart = False, emulator_clock = None, emulator_model = None):
         self.logger = logging.getLogger(logger_name) if not logger_name is None else logging.getLogger()
         self.serialname = serialname
         self.baudrate = baudrate
         self.is_fake = False
         self._buffer = bytearray()
         self.echo = ""
-        self._emulator = Emulator()
+        self._emulator = Emulator(emulator_clock, emulator_model)
 
         # opening serial
         try:
             args = dict(
                 baudrate = self.baudrate,
-                timeout = 0,
-                write_timeout = 0
+                timeout = READ_TIMEOUT,         # the read thread blocks (select on the file descriptor) until some bytes are available
+                write_timeout = WRITE_TIMEOUT   # writes block (select) until the OS accepts the data instead of failing when the output buffer is full
             )
             self.serial = serial.Serial(**args)
             self.serial.port = self.serialname
@@ -45,10 +57,18 @@ class DeviceSerial():
 
         # setting up the read thread
         self._th = Thread(target=self._thf, daemon=True)
-        self._mutex = Lock()
+        self._mutex = Lock()                # write mutex: the read thread is the only one reading from the device and does not need it
         self._th.name = "serial_read"
         self._running = False
         self.set_onreadline_callback(useless)
+
+        # setting up the write thread: the lines are queued by "send" and written in the background
+        self._write_queue = Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._write_th = Thread(target=self._write_thf, daemon=True)
+        self._write_th.name = "serial_write"
+        if not self.is_fake:
+            self._write_th.start()
+
         if autostart:
             self.start_reading()
     
@@ -69,22 +89,59 @@ class DeviceSerial():
     def stop(self):
         self._running = False
 
-    # sends a line to the device
+    # sends a line to the device (already encoded lines are sent as they are: used to send several lines with a single write)
+    # the line is queued and written by the write thread: returns immediately unless the write queue is full
+    # the line has already been counted by the feeder (buffer accounting, line number): it is never dropped, "send" waits until the queue has space
+    # raises a SerialException if the port is closed while waiting
     def send(self, obj):
         if self.is_fake:
             self._emulator.send(obj)
         else:
             if self.serial.is_open:
-                try:
-                    with self._mutex:
-                        while self.serial.out_waiting:
-                            pass            # TODO should add a sort of timeout
-                        self._readline()
-                        self.serial.write(str(obj).encode())
-                        # TODO try to send byte by byte instead of a full line? (to reduce the risk of sending commands with missing digits or wrong values that may lead to a wrong position value)
-                except:
-                    self.close()
-                    self.logger.error("Error while sending a command")
+                data = obj if isinstance(obj, bytes) else str(obj).encode()
+                while True:
+                    try:
+                        self._write_queue.put(data, timeout=WRITE_TIMEOUT)
+                        return
+                    except Full:
+                        if not self.serial.is_open:
+                            raise serial.SerialException("The serial port has been closed while waiting to send a line")
+                        self.logger.warning("The write queue is full: waiting for the device")
+
+    # sends a realtime command (grbl single byte commands like feed hold, status request, overrides)
+    # the command is written immediately instead of waiting behind the lines in the write queue (the device picks it out of the stream)
+    def send_realtime(self, obj):
+        data = obj if isinstance(obj, bytes) else str(obj).encode("latin-1")
+        if self.is_fake:
+            self._emulator.send(data)
+        elif self.serial.is_open:
+            try:
+                with self._mutex:
+                    self.serial.write(data)
+                _bytes_written.inc(len(data))
+            except Exception as e:
+                self.logger.error("Error while sending a realtime command: {}".format(e))
+
+    # waits until the queued lines are written and transmitted by the OS (like tcdrain but with a timeout)
+    # returns False if the timeout expires before all the data is sent
+    def drain(self, timeout=WRITE_TIMEOUT):
+        if self.is_fake:
+            return True
+        end_time = time.time() + timeout
+        with self._write_queue.all_tasks_done:
+            while self._write_queue.unfinished_tasks:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
+                self._write_queue.all_tasks_done.wait(remaining)
+        try:
+            while self.serial.out_waiting:
+                if time.time() > end_time:
+                    return False
+                time.sleep(DRAIN_POLL_TIME)
+        except Exception:
+            return False
+        return True
     
     # return a list of available serial ports
     def serial_port_list(self):
@@ -104,9 +161,19 @@ class DeviceSerial():
             return False
         return self.serial.is_open
     
+    # returns the time of the emulated device clock (None when connected to a real device)
+    def get_emulated_time(self):
+        if self.is_fake:
+            return self._emulator.clock.time()
+        return None
+
     # close the connection with the serial device
     def close(self):
         self.stop()
+        try:
+            self._write_queue.put_nowait(None)      # stops the write thread
+        except Full:
+            pass                                    # the write thread will stop anyway as soon as the port is closed
         try:
             self.serial.close()
             self.logger.info("Serial port closed")
@@ -115,22 +182,77 @@ class DeviceSerial():
     
     # private functions
 
+    # returns the first complete line available in the read buffer (None if there is no full line yet)
+    def _pop_line(self):
+        index = self._buffer.find(b"\n")
+        if index < 0:
+            return None
+        line = self._buffer[:index+1]
+        del self._buffer[:index+1]
+        return line.decode(encoding="UTF-8", errors="replace")
+
     # reads a line from the device
+    # blocks until a full line is available or the READ_TIMEOUT expires (returns None in that case)
     def _readline(self):
-        if not self.is_fake:
-            if self.serial.is_open:
-                while self.serial.in_waiting>0:
-                    line = self.serial.readline()
-                    return line.decode(encoding="UTF-8")
-        else:
-            return self._emulator.readline()
+        if self.is_fake:
+            return self._emulator.readline(timeout=READ_TIMEOUT)
+        line = self._pop_line()
+        if not line is None:
+            return line
+        if not self.serial.is_open:
+            time.sleep(READ_TIMEOUT)            # avoid spinning while the port is closed
+            return None
+        try:
+            # sleeps until at least one byte is available, then reads everything that is already waiting
+            data = self.serial.read(max(1, self.serial.in_waiting))
+        except Exception as e:
+            self.logger.error("Error while reading from the serial device: {}".format(e))
+            self.close()
+            return None
+        self._buffer += data
+        return self._pop_line()
+
+    # write thread function
+    # every write contains all the lines already waiting in the queue (up to MAX_WRITE_CHUNK bytes) to reduce the number of system calls
+    def _write_thf(self):
+        running = True
+        while running:
+            data = self._write_queue.get()
+            chunk = bytearray()
+            items = 1
+            try:
+                while not data is None:
+                    chunk += data
+                    if len(chunk) >= MAX_WRITE_CHUNK:
+                        break
+                    data = self._write_queue.get_nowait()
+                    items += 1
+            except Empty:
+                pass
+            running = not data is None
+            try:
+                if len(chunk) > 0 and self.serial.is_open:
+                    with self._mutex:
+                        start = time.perf_counter()
+                        self.serial.write(chunk)
+                        _serial_write_time.record(time.perf_counter() - start)
+                    _serial_writes.inc()
+                    _bytes_written.inc(len(chunk))
+            except Exception as e:
+                self.logger.error("Error while sending a command: {}".format(e))
+                running = False
+                self.close()
+            finally:
+                for i in range(items):
+                    self._write_queue.task_done()
+            running = running and self.serial.is_open
 
-    # thread function
+    # read thread function
     def _thf(self):
         self._running = True
         next_line = ""
         while(self.is_running()):
-            with self._mutex:
-                next_line = self._readline()
-            # cannot use the callback inside the mutex otherwise may run into a deadlock with the mutex if the serial.send is called in the parsing method
-            self._on_readline(next_line)
\ No newline at end of file
+            next_line = self._readline()
+            # only complete lines are passed to the callback
+            if not next_line is None:
+                self._on_readline(next_line)
\ No newline at end of file
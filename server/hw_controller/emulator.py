@@ -1,66 +1,216 @@
-import time, re, math
+import os, time, math
 from collections import deque
+from threading import Condition
 
 from server.utils.settings_utils import load_settings
 import server.hw_controller.firmware_defaults as firmware
+from server.utils.gcode_tokenizer import tokenize
+from server.utils.arc_fitting import is_arc, move_length
+from server.hw_controller.grbl_model import GrblModel, VERSION_MESSAGE, apply_feed_override_command
 
 emulated_commands_with_delay = ["G0", "G00", "G1", "G01"]
 
 ACK = "ok\n\r"
+# min duration of a move when the emulator runs in real time (the frontend cannot show the moves otherwise) [s]
+MIN_MOVE_TIME = 0.1
+# environment variable with the speed of the emulator: "1" for real time, "1000" to run 1000 times faster, "instant" to ack the moves without waiting
+SPEED_ENV = "EMULATOR_SPEED"
+# environment variable with the model of the device:
+#  * "simple": every move is acked after its duration (distance/feedrate)
+#  * "grbl": with the grbl firmware uses a model of the RX buffer, the planner and the acceleration of the device (see "GrblModel")
+MODEL_ENV = "EMULATOR_MODEL"
+SIMPLE_MODEL = "simple"
+GRBL_MODEL = "grbl"
+
+# Clock of the emulated device
+# The emulated time runs "speed" times faster than the real time. The instant clock (infinite speed) jumps forward to the next ack as soon as
+# the device is waiting for it: a full drawing can be emulated in the time needed to send its lines
+class EmulatorClock():
+    def __init__(self, speed=1):
+        self.speed = math.inf if speed == "instant" else float(speed)
+        if self.speed <= 0:
+            raise ValueError("The emulator speed must be positive")
+        self._start = time.time()
+        self._now = self._start         # instant clock only
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv(SPEED_ENV, default="1"))
+
+    def is_real_time(self):
+        return self.speed == 1
+
+    def is_instant(self):
+        return math.isinf(self.speed)
+
+    def time(self):
+        if self.is_instant():
+            return self._now
+        return self._start + (time.time() - self._start)*self.speed
+
+    # returns the real time to wait until the emulated time "t" (the instant clock jumps directly to "t")
+    def real_delay(self, t):
+        if self.is_instant():
+            self._now = max(self._now, t)
+            return 0
+        return (t - self.time())/self.speed
+
+    # emulated time since the clock was created [s]
+    def elapsed(self):
+        return self.time() - self._start
 
 class Emulator():
-    def __init__(self):
+    def __init__(self, clock=None, model=None):
+        self.clock = clock if not clock is None else EmulatorClock.from_env()
+        self.model = model if not model is None else os.getenv(MODEL_ENV, default=SIMPLE_MODEL)
+        self.grbl = GrblModel(self.clock.time()) if self.model == GRBL_MODEL else None
         self.feedrate = 5000.0
         self.ack_buffer = deque()       # used for the standard "ok" acks timing
         self.message_buffer = deque()   # used to emulate marlin response to special commands
-        self.last_time = time.time()
-        self.xr = re.compile("[X]([0-9.]+)($|\s)")
-        self.yr = re.compile("[Y]([0-9.]+)($|\s)")
-        self.fr = re.compile("[F]([0-9.]+)($|\s)")
+        self.last_time = self.clock.time()
         self.last_x = 0.0
         self.last_y = 0.0
+        self.motion = None              # last motion command (modal)
+        self.hold = False               # grbl feed hold
+        self.feed_override = firmware.FEED_OVERRIDE_DEFAULT
+        self._condition = Condition()   # used to wake up the reading thread when a new answer is available
         self.settings = load_settings()
-        self.message_buffer.append(firmware.get_ready_message(self.settings["device"]["firmware"]["value"])+"\n")     # sends back a message to tell the board is ready and can receive commands
-
-    def get_x(self, line):
-        return float(self.xr.findall(line)[0][0])
-    
-    def get_y(self, line):
-        return float(self.yr.findall(line)[0][0])
-    
+        self.firmware = self.settings["device"]["firmware"]["value"]
+        self.message_buffer.append(firmware.get_ready_message(self.firmware)+"\n")     # sends back a message to tell the board is ready and can receive commands
+
     def _buffer_empty(self):
         return len(self.ack_buffer)<1
 
+    def _uses_grbl_model(self):
+        return not self.grbl is None and firmware.is_grbl(self.firmware)
+
     def send(self, command):
+        with self._condition:
+            send = self._send_grbl if self._uses_grbl_model() else self._send
+            if isinstance(command, bytes):
+                # several lines sent with a single write
+                for line in command.decode("latin-1").splitlines(keepends=True):   # the realtime commands are not ascii characters
+                    send(line)
+            else:
+                send(command)
+            self._condition.notify_all()
+
+    # returns the next answer of the device
+    # with a timeout will wait until an answer is available or the timeout expires (returns None in that case)
+    # the timeout is in real time while the acks are scheduled with the emulated clock
+    def readline(self, timeout=0):
+        with self._condition:
+            end_time = time.time() + timeout
+            while True:
+                if self._uses_grbl_model():
+                    self._add_messages(self.grbl.update(self.clock.time()))
+                line = self._readline()
+                now = time.time()
+                if (not line is None) or (now >= end_time):
+                    return line
+                # sleep until the next ack is due or a new command is received
+                wait_time = end_time - now
+                if self._uses_grbl_model():
+                    next_event = self.grbl.next_event_time()
+                    if not next_event is None:
+                        wait_time = min(wait_time, self.clock.real_delay(next_event))
+                elif not self._buffer_empty():
+                    wait_time = min(wait_time, self.clock.real_delay(self.ack_buffer[0]))
+                self._condition.wait(max(wait_time, 0))
+
+    def _add_messages(self, messages):
+        for m in messages:
+            self.message_buffer.append(m + "\r\n")
+
+    # grbl model: the realtime commands are handled immediately, the other lines are added to the RX buffer of the model
+    def _send_grbl(self, command):
+        now = self.clock.time()
+        realtime = command.strip("\n")
+        if realtime == firmware.GRBL.buffer_command:
+            self._add_messages(self.grbl.update(now) + [self.grbl.status_report(now)])
+        elif realtime == "!":
+            self.grbl.hold(now)
+        elif realtime == "~":
+            self.grbl.resume(now)
+        elif realtime == "\x18":
+            self.grbl.reset(now)
+            self._add_messages(["", VERSION_MESSAGE])
+        elif realtime == firmware.GRBL.jog_cancel_command:
+            self._add_messages(self.grbl.jog_cancel(now))
+        elif realtime in firmware.GRBL.realtime_commands:
+            self.grbl.feed_override_command(realtime, now)
+        else:
+            self._add_messages(self.grbl.receive(command, now))
+
+    def _send(self, command):
         if self._buffer_empty():
-            self.last_time = time.time()
+            self.last_time = self.clock.time()
+
+        # grbl realtime commands do not get an ack. The status report is the only one with an answer
+        if firmware.is_grbl(self.firmware) and command.strip("\n") in firmware.GRBL.realtime_commands:
+            if command.startswith(firmware.GRBL.buffer_command):
+                self.message_buffer.append(self._grbl_status_report())
+            elif command.startswith("!"):
+                self.hold = True        # the emulator stops immediately: the hold is already complete
+            elif command.startswith("~"):
+                self.hold = False
+            elif command.startswith(firmware.GRBL.soft_reset_command):
+                # the moves left and their acks are dropped
+                self.ack_buffer.clear()
+                self.last_time = self.clock.time()
+                self.hold = False
+                self.feed_override = firmware.FEED_OVERRIDE_DEFAULT
+                self.message_buffer.append(VERSION_MESSAGE + "\n")
+            elif command.startswith(firmware.GRBL.jog_cancel_command):
+                # the emulator does not know which moves are jogs: all the moves left are stopped
+                now = self.clock.time()
+                self.ack_buffer = deque(min(t, now) for t in self.ack_buffer)
+                self.last_time = min(self.last_time, now)
+            else:
+                self.feed_override = apply_feed_override_command(self.feed_override, command.strip("\n"))     # applied to the next moves
+            return
         # TODO introduce the response for particular commands (like feedrate request, position request and others)
 
+        # marlin feed override (applied to the next moves)
+        if "M220" in command:
+            try:
+                self.feed_override = int(command.split("M220")[1].split("*")[0].split()[0].lstrip("S"))
+            except (IndexError, ValueError):
+                pass
+
         # reset position for G28 command
         if "G28" in command:
             self.last_x = 0.0
             self.last_y = 0.0
             self.message_buffer.append(ACK)
 
+        parsed = tokenize(command)
+        if not parsed is None:
+            if command.startswith("$J="):
+                parsed.command = "G1"           # grbl jog: straight move with its own feedrate (the modal motion is not changed)
+            elif parsed.command is None and not self.motion is None:
+                parsed.command = self.motion    # modal line (coordinates only, sent by the fast mode)
+            elif parsed.command in ("G0", "G1", "G2", "G3"):
+                self.motion = parsed.command
+        arc = not parsed is None and is_arc(parsed)
+
         # when receives a line calculate the time between the line received and when the ack must be sent back with the feedrate
-        if any(code in command for code in emulated_commands_with_delay):
+        if arc or (not parsed is None and parsed.command in emulated_commands_with_delay):
             # check if should update feedrate
-            f = self.fr.findall(command)
-            if len(f) > 0:
-                self.feedrate = float(f[0][0])
+            if not parsed.f is None:
+                self.feedrate = parsed.f
 
             # get points coords
-            try:
-                x = self.get_x(command)
-            except:
-                x = self.last_x
-            try:
-                y = self.get_y(command)
-            except:
-                y = self.last_y
+            x = parsed.x if not parsed.x is None else self.last_x
+            y = parsed.y if not parsed.y is None else self.last_y
+            length = move_length(self.last_x, self.last_y, x, y, parsed)
             # calculate time
             self.feedrate = max(self.feedrate, 0.01)
-            t = max(math.sqrt((x-self.last_x)**2 + (y-self.last_y)**2) / self.feedrate * 60.0, 0.1)   # TODO need to use the max 0.005 because cannot simulate anything on the frontend otherwise... May look for a better solution
+            t = length / self.feedrate * 60.0
+            if not command.startswith("$J="):
+                t = t*100/self.feed_override
+            if self.clock.is_real_time():
+                t = max(t, MIN_MOVE_TIME)   # TODO need to use the max 0.005 because cannot simulate anything on the frontend otherwise... May look for a better solution
             
             # update positions
             self.last_x = x
@@ -73,7 +223,13 @@ class Emulator():
         else:
             self.message_buffer.append(ACK)
 
-    def readline(self):
+    def _grbl_status_report(self):
+        # the emulator does not model the planner: every move waiting for its ack is considered a planner block
+        state = "Idle" if self._buffer_empty() else ("Hold:0" if self.hold else "Run")
+        planner_free = max(firmware.GRBL.planner_buffer_size - len(self.ack_buffer), 0)
+        return "<{}|MPos:{:.3f},{:.3f},0.000|Bf:{},{}|Ov:{},100,100>\n".format(state, self.last_x, self.last_y, planner_free, firmware.GRBL.rx_buffer_size, self.feed_override)
+
+    def _readline(self):
         # special commands response
         if len(self.message_buffer) >= 1:
             return self.message_buffer.popleft()
@@ -82,7 +238,7 @@ class Emulator():
         if self._buffer_empty():
             return None
         oldest = self.ack_buffer.popleft()
-        if oldest > time.time():
+        if oldest > self.clock.time():
             self.ack_buffer.appendleft(oldest)
             return None
         else:
@@ -1,19 +1,28 @@
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, Event
 import os
 import time
+from time import perf_counter
 import traceback
+import itertools
 from collections import deque
-from copy import deepcopy
-import re
 import logging
 from dotenv import load_dotenv
 from dotmap import DotMap
-from py_expression_eval import Parser
 
-from server.utils import limited_size_dict, buffered_timeout, settings_utils
+from server.utils import buffered_timeout, settings_utils
 from server.utils.logging_utils import formatter, MultiprocessRotatingFileHandler
+from server.utils.gcode_tokenizer import GcodeCommand, tokenize
+from server.utils.ring_buffer import RingBuffer
+from server.utils.resend_history import ResendHistory
+from server.utils.metrics import metrics
+from server.utils.macros import MACRO_CHAR, evaluate_macros, compile_script
+from server.utils.drawing_checkpoint import DrawingCheckpoint, CHECKPOINT_INTERVAL
+from server.utils.feedrate_planner import load_controller_limits, save_controller_limits, GRBL_MAX_RATE_SETTINGS, GRBL_ACCELERATION_SETTINGS, GRBL_STEPS_SETTINGS
 from server.hw_controller.device_serial import DeviceSerial
-from server.hw_controller.gcode_rescalers import Fit
+from server.hw_controller.inflight_depth import InFlightDepth, RESEND, TIMEOUT
+from server.hw_controller.line_encoder import LineEncoder, checksum, get_decimals
+from server.hw_controller.jog_streamer import JogStreamer, JOG_PREFIX
+from server.hw_controller.position_tracker import PositionTracker
 import server.hw_controller.firmware_defaults as firmware
 from server.database.playlist_elements import DrawingElement, TimeElement
 from server.database.generic_playlist_element import UNKNOWN_PROGRESS
@@ -54,12 +63,44 @@ class FeederEventHandler():
     def on_grbl_error(self, code, description):
         pass
 
+    # called periodically while drawing with the position executed by the device (see "PositionTracker")
+    def on_device_position(self, position):
+        pass
+
 
 
 # List of commands that are buffered by the controller
 BUFFERED_COMMANDS   = ("G0", "G00", "G1", "G01", "G2", "G02", "G3", "G03", "G28")
-# Defines the character used to define macros
-MACRO_CHAR          = "&"
+# Number of parsed lines ready to be sent while running an element
+PIPELINE_BUFFER_SIZE = 128
+# Number of commands sent that are kept to find the last one acked when saving a checkpoint (must be larger than the lines in the device buffer)
+CHECKPOINT_HISTORY = 256
+# Period of the status requests while waiting for the device to stop [s]
+STATUS_POLL_INTERVAL = 0.1
+# Max time to wait for the device to complete a feed hold [s]
+STOP_TIMEOUT = 5
+# Number of lines sent that are kept to answer the Marlin resend requests (must be larger than the lines in the device buffer)
+RESEND_HISTORY_SIZE = 64
+# Time between the grbl feed override realtime commands (grbl merges the equal commands received in the same loop) [s]
+FEED_OVERRIDE_INTERVAL = 0.01
+
+# streaming metrics (see "/api/metrics")
+_element_read_time =    metrics.histogram("element_read_seconds", "Time to read the next command of the element (file read and coordinates transformation)")
+_line_cleanup_time =    metrics.histogram("line_cleanup_seconds", "Time to clean and parse a text line of the element")
+_feedrate_clamp_time =  metrics.histogram("feedrate_clamp_seconds", "Time to prepare a command (macros, feedrate clamp, position update)")
+_generate_line_time =   metrics.histogram("generate_line_seconds", "Time to generate the line sent to the device (without the waits for free space in the device buffer)")
+_send_mutex_wait_time = metrics.histogram("send_mutex_wait_seconds", "Time blocked on the command_send_mutex waiting for an ack (line count protocol)")
+_rx_buffer_wait_time =  metrics.histogram("rx_buffer_wait_seconds", "Time blocked waiting for free space in the device RX buffer (character counting protocol)")
+_ack_round_trip_time =  metrics.histogram("ack_round_trip_seconds", "Time between a line being generated and its ack")
+_lines_sent =           metrics.counter("lines_sent_total", "Lines sent to the device")
+_acks_received =        metrics.counter("acks_received_total", "Acks received from the device")
+
+# the lines are bytes in fast mode (see "LineEncoder")
+def _to_bytes(line):
+    return line if isinstance(line, bytes) else line.encode()
+
+def _to_str(line):
+    return line.decode() if isinstance(line, bytes) else line
 
 class Feeder():
     def __init__(self, handler = None, **kargvs):
@@ -102,10 +143,16 @@ class Feeder():
         self._current_element = None
         self._is_running = False
         self._stopped = False
-        self._is_paused = False
+        self._resume_event = Event()        # cleared while paused: the drawing thread waits on it (the hot loop checks the flag without locks)
+        self._resume_event.set()
         self._th = None
+        self._pipeline = None               # buffer between the element reader and the sender (see "_thf")
         self.serial_mutex = Lock()
         self.status_mutex = Lock()
+        self._stopped_condition = Condition(self.status_mutex)     # signalled when the drawing thread is stopped
+        self._device_state = None                                   # state of the device from the last grbl status report ("Idle", "Run", "Hold:0", ...)
+        self._device_state_condition = Condition()                  # signalled when a new status report is received
+        self._flush_reset = False                                   # "stop()" reset the device to flush its buffers and is waiting for the ready message
         if handler is None:
             self.handler = FeederEventHandler()
         else: self.handler = handler
@@ -114,22 +161,37 @@ class Feeder():
         self._timeout_last_line = self.line_number
         self.feedrate = 0
         self.max_drawing_feedrate = 2000  # Max feedrate for drawings (mm/min), 0 = no limit
+        self.feed_override = firmware.FEED_OVERRIDE_DEFAULT     # percentage of the programmed feedrate used by the device (updated by the status reports)
+        self._feed_override_mutex = Lock()
         self.last_commanded_position = DotMap({"x":0, "y":0})
-
-        # commands parser
-        self.feed_regex =   re.compile("[F]([0-9.-]+)($|\s)")           # looks for a +/- float number after an F, until the first space or the end of the line
-        self.x_regex =      re.compile("[X]([0-9.-]+)($|\s)")           # looks for a +/- float number after an X, until the first space or the end of the line
-        self.y_regex =      re.compile("[Y]([0-9.-]+)($|\s)")           # looks for a +/- float number after an Y, until the first space or the end of the line
-        self.macro_regex =  re.compile(MACRO_CHAR+"(.*?)"+MACRO_CHAR)   # looks for stuff between two "%" symbols. Used to parse macros
-        
-        self.macro_parser = Parser()                                    # macro expressions parser
+        self.jog = JogStreamer(self)        # live mode moves (see "JogStreamer")
+        self.tracker = PositionTracker(self)    # position executed by the device while drawing (see "PositionTracker")
 
         # buffer controll attrs
         self.command_buffer = deque()
         self.command_buffer_mutex = Lock()              # mutex used to modify the command buffer
         self.command_send_mutex = Lock()                # mutex used to pause the thread when the buffer is full
-        self.command_buffer_max_length = 8
-        self.command_buffer_history = limited_size_dict.LimitedSizeDict(size_limit = self.command_buffer_max_length+40)    # keep saved the last n commands
+        self._depth = InFlightDepth(*firmware.get_in_flight_limits(firmware.MARLIN.name))  # max number of lines waiting for an ack (adapted to the measured round trip)
+        # character counting protocol attrs (the command_buffer_bytes deque is filled only when the protocol is in use)
+        self.command_buffer_bytes = deque()                                     # number of bytes of each line waiting for an ack
+        self.command_buffer_condition = Condition(self.command_buffer_mutex)   # used to wait for free space in the device RX buffer
+        self._rx_buffer_bytes = 0                       # bytes sent to the device that did not receive an ack yet
+        self._rx_wait_released = False                  # set by "stop()" to release the threads waiting for free space in the RX buffer
+        self._rx_waiting = False                        # the sender is waiting for free space in the RX buffer
+        self._registered_lines = 0                      # number of lines registered in the buffer (used to validate the status reports)
+        self._status_request_mark = -1                  # value of "_registered_lines" when the last status report was requested
+        self._credit_waits = 0                          # number of times the sender had to wait for free space in the device buffer
+        self._max_in_flight_lines = 0                   # max number of lines waiting for an ack
+        self._sent_times = deque()                      # time at which the lines waiting for an ack have been generated (used for the ack round trip time)
+        self._rx_wait_time = 0                          # time spent waiting for free space in the RX buffer by the last line generated
+        self._emulated_start_time = None                # emulated device clock when the element started (None with a real device)
+        self.emulated_element_time = None               # time taken by the last element on the emulated device [s]
+        self._resend_history = ResendHistory(RESEND_HISTORY_SIZE)     # keep saved the last n lines (marlin only)
+        self._encoder = LineEncoder()                   # fast mode lines
+        # checkpoint of the drawing (used to resume it after a restart)
+        self._checkpoint = DrawingCheckpoint()
+        self._sent_cursors = deque(maxlen=CHECKPOINT_HISTORY)   # position of the last commands sent: (cursor, x, y)
+        self._last_checkpoint = 0
         self._buffered_line = ""
 
         self._timeout = buffered_timeout.BufferTimeout(30, self._on_timeout)
@@ -141,25 +203,60 @@ class Feeder():
 
     def update_settings(self, settings):
         self.settings = settings
+        if settings["device"]["firmware"]["value"] != getattr(self, "_firmware", None):
+            with self.command_buffer_mutex:
+                self._depth.set_limits(*firmware.get_in_flight_limits(settings["device"]["firmware"]["value"]))
         self._firmware = settings["device"]["firmware"]["value"]
         self._ACK = firmware.get_ACK(self._firmware)
         self._timeout.set_timeout_period(firmware.get_buffer_timeout(self._firmware))
+        is_character_counting = firmware.get_streaming_protocol(self._firmware) == firmware.CHARACTER_COUNTING
+        if is_character_counting != getattr(self, "_is_character_counting", None):
+            self._clear_command_buffer()                # the buffer accounting of the old protocol is not valid anymore
+        self._is_character_counting = is_character_counting
+        self._rx_buffer_size = firmware.get_rx_buffer_size(self._firmware)
+        # the macros of the scripts are parsed once when the settings are saved (only the evaluation runs when a script is sent)
+        for name, script in settings.get("scripts", {}).items():
+            for macro in compile_script(script["value"]):
+                self.logger.error("Cannot parse the macro '{}' of the '{}' script".format(macro, name))
         self.is_fast_mode = settings["serial"]["fast_mode"]["value"]
-        if self.is_fast_mode:
-            if settings["device"]["type"]["value"] == "Cartesian":
-                self.command_resolution = "{:.1f}"      # Cartesian do not need extra resolution because already using mm as units. (TODO maybe with inches can have problems? needs to check)
-            else: self.command_resolution = "{:.3f}"    # Polar and scara use smaller numbers, will need also decimals
+        try:
+            self.tracker.set_poll_rate(float(settings["serial"]["position_poll_rate"]["value"]))
+        except (KeyError, TypeError, ValueError):
+            self.tracker.set_poll_rate(0)
+        self._update_encoder_decimals()
     
     def close(self):
+        self.jog.stop()
+        self.tracker.stop()
         self.serial.close()
 
     def get_status(self):
         with self.status_mutex:
             return {
                 "is_running": self._is_running, 
-                "progress": self._current_element.get_progress(self.feedrate) if not self._current_element is None else UNKNOWN_PROGRESS,
-                "is_paused": self._is_paused
+                "progress": self._current_element.get_progress(self.feedrate*self.feed_override/100) if not self._current_element is None else UNKNOWN_PROGRESS,
+                "is_paused": not self._resume_event.is_set(),
+                "feed_override": self.feed_override
+            }
+
+    # returns the queue depth metrics of the stages used to stream an element (see "_thf")
+    #  * producer: lines parsed from the element and ready to be sent
+    #  * sender: lines sent to the device and waiting for an ack
+    def get_pipeline_stats(self):
+        with self.status_mutex:
+            pipeline = self._pipeline
+        with self.command_buffer_mutex:
+            sender = {
+                "in_flight_lines": len(self.command_buffer),
+                "in_flight_bytes": self._rx_buffer_bytes,
+                "max_in_flight_lines": self._max_in_flight_lines,
+                "credit_waits": self._credit_waits,
+                "depth": self._depth.get_stats()
             }
+        return {
+            "producer": pipeline.get_stats() if not pipeline is None else None,
+            "sender": sender
+        }
 
     def connect(self):
         self.logger.info("Connecting to serial device...")
@@ -191,17 +288,20 @@ class Feeder():
         else:
             if self.is_running():
                 self.stop()     # stop -> blocking function: wait until the thread is stopped for real
+            self.jog.stop()     # the live mode ends when a drawing is started
             with self.serial_mutex:
                 self._th = Thread(target = self._thf, args=(element,), daemon=True)
                 self._th.name = "drawing_feeder"
                 self._is_running = True
                 self._stopped = False
-                self._is_paused = False
+                self._resume_event.set()
                 self._current_element = element
                 if self.command_send_mutex.locked():
                     self.command_send_mutex.release()
-                with self.command_buffer_mutex:
-                    self.command_buffer.clear()
+                self._clear_command_buffer()
+                self._credit_waits = 0
+                self._max_in_flight_lines = 0
+                self._emulated_start_time = self.serial.get_emulated_time()
                 self._th.start()
             self.handler.on_element_started(element)
 
@@ -212,8 +312,7 @@ class Feeder():
 
     # ask if the feeder is paused
     def is_paused(self):
-        with self.status_mutex:
-            return self._is_paused
+        return not self._resume_event.is_set()
 
     # return the code of the drawing on the go
     def get_element(self):
@@ -232,10 +331,15 @@ class Feeder():
         if(self.is_running()):
             tmp = self._current_element
             with self.status_mutex:
-                if not self._stopped:
+                interrupted = not self._stopped         # False if the element is finished (called by the drawing thread)
+                if interrupted:
                     self.logger.info("Stopping drawing")
                 self._is_running = False
                 self._current_element = None
+            # wake up the drawing thread if paused and the element if waiting (i.e. timing elements)
+            self._resume_event.set()
+            if not tmp is None:
+                tmp.interrupt()
             
             # Release command_send_mutex if locked so the drawing thread can unblock and exit
             if self.command_send_mutex.locked():
@@ -243,30 +347,43 @@ class Feeder():
                     self.command_send_mutex.release()
                 except:
                     pass
+            # Release the drawing thread if waiting for new lines from the element
+            with self.status_mutex:
+                if not self._pipeline is None:
+                    self._pipeline.clear()
+            # Release also the threads waiting for free space in the RX buffer (character counting protocol)
+            with self.command_buffer_condition:
+                self._rx_wait_released = True
+                self.command_buffer_condition.notify_all()
 
             # block the function until the thread is stopped otherwise the thread may still be running when the new thread is started 
             # (_isrunning will turn True and the old thread will keep going)
-            while True:
-                with self.status_mutex:
-                    if self._stopped:
-                        break
-                time.sleep(0.05)
+            with self.status_mutex:
+                self._stopped_condition.wait_for(lambda: self._stopped)
+            with self.command_buffer_condition:
+                self._rx_wait_released = False
 
-            # Now that the thread has stopped, flush GRBL's planner to clear any buffered commands
-            if firmware.is_grbl(self._firmware):
+            # Now that the thread has stopped, flush GRBL's planner to clear any buffered commands (not necessary if the drawing is finished)
+            if firmware.is_grbl(self._firmware) and interrupted:
                 try:
-                    with self.serial_mutex:
-                        self.serial.send("!")       # Feed hold — stops motion immediately
-                    time.sleep(0.5)
-                    with self.serial_mutex:
-                        self.serial.send("\x85")    # Queue flush — clears planner buffer
-                    time.sleep(0.5)
-                    with self.serial_mutex:
-                        self.serial.send("~")       # Cycle start — return to idle
-                    self.logger.info("Sent GRBL feed hold + queue flush")
-                    # Clear internal command buffer since GRBL dropped everything
-                    with self.command_buffer_mutex:
-                        self.command_buffer.clear()
+                    self._send_realtime("!")        # Feed hold — stops motion
+                    # the status reports show when the device has decelerated to a stop
+                    if not self._wait_device_state(("Hold:0", "Idle"), STOP_TIMEOUT):
+                        # a soft reset while moving raises an alarm and loses the position: the device is left in feed hold
+                        # the lines left in the device are not tracked anymore (the device must be reset before the next element)
+                        self.logger.error("The device did not confirm the feed hold: left in feed hold without flushing its buffers")
+                    else:
+                        # grbl can drop the planner blocks and the lines in the RX buffer only with a soft reset (after the feed hold the position is kept)
+                        # the accounting can be cleared only after the ready message: the acks of the dropped lines will never come
+                        with self._device_state_condition:
+                            self._flush_reset = True
+                        self._send_realtime(firmware.GRBL.soft_reset_command)
+                        with self._device_state_condition:
+                            if not self._device_state_condition.wait_for(lambda: not self._flush_reset, timeout=STOP_TIMEOUT):
+                                self._flush_reset = False
+                                self.logger.warning("The device did not confirm the soft reset")
+                        self.logger.info("Sent GRBL feed hold + soft reset")
+                    self._clear_command_buffer()
                     if self.command_send_mutex.locked():
                         try:
                             self.command_send_mutex.release()
@@ -276,97 +393,107 @@ class Feeder():
                     self.logger.error(f"Error sending feed hold: {e}")
 
             # waiting command buffer to be clear before calling the "drawing ended" event
-            while True:
-                self.send_gcode_command(firmware.get_buffer_command(self._firmware), hide_command=True) 
-                time.sleep(0.5)
-                # the "buffer_command" will raise a response from the board that will be handled by the parser to empty the buffer
-
-                # wait until the buffer is empty to know that the job is done
-                with self.command_buffer_mutex:
-                    if len(self.command_buffer) == 0:
-                        break
+            self._wait_buffer_empty()
+            self.tracker.stop()
+            # with the emulator reports how long the element would take on the device
+            emulated_time = self.serial.get_emulated_time()
+            if not emulated_time is None and not self._emulated_start_time is None:
+                self.emulated_element_time = emulated_time - self._emulated_start_time
+                self.logger.info("Emulated element time: {:.1f} s".format(self.emulated_element_time))
             # resetting line number between drawings
             self._reset_line_number()
             # calling "drawing ended" event
             self.handler.on_element_ended(tmp)
     
     
+    # stops the element after an error of the device (must not run on the serial reader thread, see "_parse_device_line")
+    def _stop_on_error(self):
+        self.stop()
+        self._clear_command_buffer()
+
+    # waits until all the lines sent received an ack
+    # the "buffer_command" will raise a response from the board that will be handled by the parser to empty the buffer (in case some ack has been lost)
+    def _wait_buffer_empty(self):
+        while True:
+            with self.command_buffer_condition:
+                if len(self.command_buffer) == 0:
+                    return
+            self.send_gcode_command(firmware.get_buffer_command(self._firmware), hide_command=True)
+            with self.command_buffer_condition:
+                if self.command_buffer_condition.wait_for(lambda: len(self.command_buffer) == 0, timeout=STATUS_POLL_INTERVAL):
+                    return
+
+    # grbl: requests status reports until the state of the device is one of the given states (or the timeout expires)
+    # returns False if the timeout expired
+    def _wait_device_state(self, states, timeout):
+        end_time = time.time() + timeout
+        with self._device_state_condition:
+            self._device_state = None
+        while time.time() < end_time:
+            self.send_gcode_command(firmware.GRBL.buffer_command, hide_command=True)
+            with self._device_state_condition:
+                if self._device_state_condition.wait_for(lambda: not self._device_state is None and self._device_state.startswith(states), timeout=STATUS_POLL_INTERVAL):
+                    return True
+        return False
+
     # pauses the drawing
     # can resume with "resume()"
     def pause(self):
         with self.status_mutex:
-            self._is_paused = True
+            if self._is_running:            # a stopped drawing thread must not wait for a resume
+                self._resume_event.clear()
         self.logger.info("Paused")
     
     # resumes the drawing (only if used with "pause()" and not "stop()")
     def resume(self):
-        with self.status_mutex:
-            self._is_paused = False
+        self._resume_event.set()
         self.logger.info("Resumed")
 
     # function to prepare the command to be sent.
     #  * command: command to send
     #  * hide_command=False (optional): will hide the command from being sent also to the frontend (should be used for SW control commands)
     def send_gcode_command(self, command, hide_command=False):
-        command = self._parse_macro(command)
-
-        if "G28" in command:
-            self.last_commanded_position.x = 0
-            self.last_commanded_position.y = 0
-        # TODO add G92 check for the positioning
-
-        # clean the command a little
-        command = command.replace("\n", "").replace("\r", "").upper()
-        if command == " " or command == "":
-            return
-        
-        # some commands require to update the feeder status
-        # parse the command if necessary
-        if "M110" in command:
-            cs = command.split(" ")
-            for c in cs:
-                if c[0]=="N":
-                    self.line_number = int(c[1:]) -1
-                    self.command_buffer.clear()
+        start = perf_counter()
+        if isinstance(command, GcodeCommand) and command.is_move():
+            # drawing moves are already parsed by the element: skips the text parsing
+            command = self._prepare_move(command)
+        else:
+            command = self._prepare_command(str(command))
+            if command is None:
+                return
+        _feedrate_clamp_time.record(perf_counter() - start)
 
-        # check if the command is in the "BUFFERED_COMMANDS" list and stops if the buffer is full
-        try:
-            if any(code in command for code in BUFFERED_COMMANDS):
-                if "F" in command:
-                    parsed_feed = float(self.feed_regex.findall(command)[0][0])
-                    # Clamp feedrate when running a drawing (not live mode commands)
-                    if self._is_running and self.max_drawing_feedrate > 0 and parsed_feed > self.max_drawing_feedrate:
-                        self.logger.info(f"Clamping feedrate from {parsed_feed} to {self.max_drawing_feedrate}")
-                        command = self.feed_regex.sub("F{:.0f} ".format(self.max_drawing_feedrate), command, count=1)
-                        parsed_feed = self.max_drawing_feedrate
-                    self.feedrate = parsed_feed
-                elif self._is_running and self.max_drawing_feedrate > 0 and self.feedrate > self.max_drawing_feedrate:
-                    # No F in command but current feedrate exceeds cap — inject F to enforce the limit
-                    self.logger.info(f"Injecting F{self.max_drawing_feedrate} (current feedrate was {self.feedrate})")
-                    command = command.rstrip() + " F{:.0f}".format(self.max_drawing_feedrate)
-                    self.feedrate = self.max_drawing_feedrate
-                if "X" in command:
-                    self.last_commanded_position.x = float(self.x_regex.findall(command)[0][0])
-                if "Y" in command:
-                    self.last_commanded_position.y = float(self.y_regex.findall(command)[0][0])
-        except:
-            self.logger.error("Cannot parse something in the command: " + command)
         # wait until the lock for the buffer length is released -> means the board sent the ack for older lines and can send new ones
+        start = perf_counter()
+        blocked = self.command_send_mutex.locked()
         with self.command_send_mutex:       # wait until get some "ok" command to remove extra entries from the buffer
             pass
+        if blocked:
+            self._credit_waits += 1
+            _send_mutex_wait_time.record(perf_counter() - start)
 
         # send the command after parsing the content
         # need to use the mutex here because it is changing also the line number
         with self.serial_mutex:
+            start = perf_counter()
+            self._rx_wait_time = 0
             line = self._generate_line(command)
+            if line is None:                    # the command was dropped while waiting for free space in the buffer (the drawing has been stopped)
+                return
+            _generate_line_time.record(perf_counter() - start - self._rx_wait_time)
 
-            self.serial.send(line)              # send line
+            if firmware.is_grbl(self._firmware) and line == firmware.GRBL.buffer_command:
+                self.serial.send_realtime(line)     # the status request must not wait behind the lines already queued
+            else:
+                self.serial.send(line)              # send line
+            _lines_sent.inc()
+            line = _to_str(line)
             self.logger.log(settings_utils.LINE_SENT, line.replace("\n", "")) 
 
             # TODO fix the problem with small geometries may be with the serial port being to slow. For long (straight) segments the problem is not evident. Do not understand why it is happening
 
         with self.command_buffer_mutex:
-            if(len(self.command_buffer)>=self.command_buffer_max_length and not self.command_send_mutex.locked()):
+            if(not self._is_character_counting and len(self.command_buffer)>=self._depth.depth and not self.command_send_mutex.locked()):
                 self.command_send_mutex.acquire()     # if the buffer is full acquire the lock so that cannot send new lines until the reception of an ack. Notice that this will stop only buffered commands. The other commands will be sent anyway
 
         if not hide_command:
@@ -377,6 +504,81 @@ class Feeder():
 
 
     
+    # parses a text command and updates the feeder status (position, feedrate, line number)
+    # returns the command to send or None if the command is empty
+    def _prepare_command(self, command):
+        command = self._parse_macro(command)
+
+        if "G28" in command:
+            self.last_commanded_position.x = 0
+            self.last_commanded_position.y = 0
+        # TODO add G92 check for the positioning
+
+        # clean the command a little
+        command = command.replace("\n", "").replace("\r", "").upper()
+        if command == " " or command == "":
+            return None
+        
+        # some commands require to update the feeder status
+        # parse the command if necessary
+        if "M110" in command:
+            cs = command.split(" ")
+            for c in cs:
+                if c[0]=="N":
+                    self.line_number = int(c[1:]) -1
+                    self._clear_command_buffer()
+                    with self.command_buffer_mutex:
+                        self._resend_history.clear()
+
+        # check if the command is in the "BUFFERED_COMMANDS" list and stops if the buffer is full
+        parsed = tokenize(command)
+        if command.startswith(JOG_PREFIX) and not parsed is None:
+            # grbl jog: moves the device without changing the modal state (the feedrate is not updated)
+            if not parsed.x is None:
+                self.last_commanded_position.x = parsed.x
+            if not parsed.y is None:
+                self.last_commanded_position.y = parsed.y
+            return command
+        if not parsed is None and parsed.command in BUFFERED_COMMANDS:
+            if not parsed.f is None:
+                # Clamp feedrate when running a drawing (not live mode commands)
+                if self._is_running and self.max_drawing_feedrate > 0 and parsed.f > self.max_drawing_feedrate:
+                    self.logger.info(f"Clamping feedrate from {parsed.f} to {self.max_drawing_feedrate}")
+                    parsed = parsed.with_feedrate(self.max_drawing_feedrate)
+                    command = str(parsed)
+                self.feedrate = parsed.f
+            elif self._is_running and self.max_drawing_feedrate > 0 and self.feedrate > self.max_drawing_feedrate:
+                # No F in command but current feedrate exceeds cap — inject F to enforce the limit
+                self.logger.info(f"Injecting F{self.max_drawing_feedrate} (current feedrate was {self.feedrate})")
+                command = command.rstrip() + " F{:.0f}".format(self.max_drawing_feedrate)
+                self.feedrate = self.max_drawing_feedrate
+            if not parsed.x is None:
+                self.last_commanded_position.x = parsed.x
+            if not parsed.y is None:
+                self.last_commanded_position.y = parsed.y
+        return command
+
+    # same as _prepare_command but for an already parsed move (G0/G1 with only X, Y, F)
+    # returns the command to send (still parsed in fast mode)
+    def _prepare_move(self, command):
+        if self._is_running and self.max_drawing_feedrate > 0:
+            # clamp or inject the feedrate when running a drawing (not live mode commands)
+            if not command.f is None and command.f > self.max_drawing_feedrate:
+                self.logger.info(f"Clamping feedrate from {command.f} to {self.max_drawing_feedrate}")
+                command = command.with_feedrate(self.max_drawing_feedrate)
+            elif command.f is None and self.feedrate > self.max_drawing_feedrate:
+                self.logger.info(f"Injecting F{self.max_drawing_feedrate} (current feedrate was {self.feedrate})")
+                command = command.with_feedrate(self.max_drawing_feedrate)
+        if not command.f is None:
+            self.feedrate = command.f
+        if not command.x is None:
+            self.last_commanded_position.x = command.x
+        if not command.y is None:
+            self.last_commanded_position.y = command.y
+        if self.is_fast_mode:
+            return command                  # the encoder uses the parsed values directly
+        return str(command)
+
     # Send a multiline script
     def send_script(self, script):
         self.logger.info("Sending script")
@@ -404,19 +606,52 @@ class Feeder():
     def soft_reset(self):
         self.logger.info("Sending Soft Reset (Ctrl-X)")
         # Send 0x18 (Ctrl-X)
-        with self.serial_mutex:
-            self.serial.send("\x18")
+        self._send_realtime(firmware.GRBL.soft_reset_command)
         
         # Stop internal Drawing 
         if self.is_running():
             self.stop()
 
         # Clear local buffer to match device state
-        with self.command_buffer_mutex:
-            self.command_buffer.clear()
+        self._clear_command_buffer()
+
+    # waits until less than "max_lines" lines are waiting for an ack
+    # returns False if the timeout expired
+    def wait_in_flight_lines(self, max_lines, timeout):
+        with self.command_buffer_condition:
+            return self.command_buffer_condition.wait_for(lambda: len(self.command_buffer) < max_lines, timeout=timeout)
+
+    # grbl: cancels the jog moves (the device decelerates to a stop and drops the jog moves queued)
+    def jog_cancel(self):
+        if firmware.is_grbl(self._firmware):
+            self._send_realtime(firmware.GRBL.jog_cancel_command)
+
+    # changes the speed of the device to the given percentage of the programmed feedrate (the lines are not changed)
+    #  * grbl: realtime override commands, the moves already in the planner change speed immediately
+    #  * marlin: "M220" command, applied to the moves planned after the lines already in the buffer
+    # returns the override set (limited between FEED_OVERRIDE_MIN and FEED_OVERRIDE_MAX)
+    def set_feed_override(self, percent):
+        percent = int(min(max(round(percent), firmware.FEED_OVERRIDE_MIN), firmware.FEED_OVERRIDE_MAX))
+        with self._feed_override_mutex:
+            if firmware.is_grbl(self._firmware):
+                for command in firmware.get_grbl_feed_override_commands(self.feed_override, percent):
+                    self._send_realtime(command)
+                    time.sleep(FEED_OVERRIDE_INTERVAL)
+                self.feed_override = percent
+                self._send_realtime(firmware.GRBL.buffer_command)   # the status report confirms the new value (without waiting for the sender)
+            else:
+                self.send_gcode_command(firmware.MARLIN.feed_override_command.format(percent), hide_command=True)
+                self.feed_override = percent
+        self.logger.info("Feed override set to {}%".format(percent))
+        return percent
 
     # ----- PRIVATE METHODS -----
 
+    # grbl realtime commands: sent as single bytes (the override and jog cancel commands are not ascii characters)
+    # they skip the serial write queue and do not wait for the serial mutex (the sender may be holding it while waiting for free space in the buffer)
+    def _send_realtime(self, command):
+        self.serial.send_realtime(command.encode("latin-1"))
+
     # prepares the board
     def _on_device_ready(self):
         if firmware.is_marlin(self._firmware):
@@ -435,6 +670,7 @@ class Feeder():
             # GRBL rejects $ commands when not IDLE, causing Error 8
             if not self.is_running():
                 self.send_gcode_command("$10=6")
+                self.send_gcode_command("$$")       # reads the max rates and accelerations used by the feedrate planner
             else:
                 self.logger.info("Skipping $10 config - drawing in progress")
         
@@ -462,150 +698,83 @@ class Feeder():
 
         self.logger.info("Starting new drawing with code {}".format(element))
         
-        # TODO retrieve saved information for the gcode filter
-        # Retrieve settings for scaling and orientation
-        try:
-            width = float(self.settings['device']['width']['value'])
-            height = float(self.settings['device']['height']['value'])
-            offset_x = float(self.settings['device']['offset_x']['value'])
-            offset_y = float(self.settings['device']['offset_y']['value'])
-            
-            # Handle potential missing keys for new settings
-            orientation_origin = self.settings['device'].get('orientation_origin', {}).get('value', 'Bottom-Left')
-            orientation_swap = self.settings['device'].get('orientation_swap', {}).get('value', False)
-        except Exception as e:
-            self.logger.error(f"Error reading settings for scaling: {e}. Using defaults.")
-            width = 100
-            height = 100
-            offset_x = 0
-            offset_y = 0
-            orientation_origin = 'Bottom-Left'
-            orientation_swap = False
-
-        # Default bounds (assume normalized 0-1 if unknown)
-        d_min_x, d_max_x = 0, 1.0
-        d_min_y, d_max_y = 0, 1.0
-
-        # Try to get actual drawing dimensions to decide on scaling strategy
-        if isinstance(element, DrawingElement):
-            try:
-                # We need to import UploadedFiles here to avoid circular imports if possible, 
-                # or rely on the element having this info. 
-                # DrawingElement loads drawing_infos in execute(), but we are in _thf (before execute loop).
-                # Let's peek at the DB.
-                from server.database.models import UploadedFiles
-                drawing_infos = UploadedFiles.get_drawing(element.drawing_id)
-                if drawing_infos and drawing_infos.dimensions_info:
-                    import json
-                    dims_info = json.loads(drawing_infos.dimensions_info)
-                    xmin = dims_info.get("xmin", 0)
-                    xmax = dims_info.get("xmax", 1)
-                    ymin = dims_info.get("ymin", 0)
-                    ymax = dims_info.get("ymax", 1)
-                    
-                    # Heuristic: If dimensions are large (> 2), assume Absolute MM -> 1:1 Scale
-                    # If dimensions are small (<= 2), assume Normalized -> Stretch to Fill
-                    if (xmax - xmin > 2) or (ymax - ymin > 2) or (xmax > 2) or (ymax > 2):
-                        # Absolute MM: Set input bounds to Table Size (0 to width)
-                        # This ensures 1:1 mapping (e.g. input 250 -> norm 0.5 -> output 250)
-                        d_min_x, d_max_x = 0, width
-                        d_min_y, d_max_y = 0, height
-                    else:
-                        # Normalized: Set input bounds to actual bounds (Stretch to fill)
-                        d_min_x, d_max_x = xmin, xmax
-                        d_min_y, d_max_y = ymin, ymax
-            except Exception as e:
-                self.logger.error(f"Error determining drawing bounds: {e}")
-
-        
-        # Check for PRE-TRANSFORMED header
-        # We need to peek at the first line.
+        # the drawing elements transform the coordinates for the table before yielding the commands (see "DrawingElement.execute")
         generator = self.get_element().execute(self.logger)
         try:
             first_line = next(generator)
         except StopIteration:
             return # Empty file
 
-        if "; TYPE: PRE-TRANSFORMED" in first_line:
-            self.logger.info("Detected PRE-TRANSFORMED G-code. Disabling orientation logic.")
-            orientation_origin = "Bottom-Left"
-            orientation_swap = False
-            offset_x = 0
-            offset_y = 0
-        else:
-            self.logger.info(f"Did NOT detect PRE-TRANSFORMED tag in first line: '{first_line}'")
-        
-        dims = {
-            "table_x": width, 
-            "table_y": height, 
-            "drawing_max_x": d_max_x,
-            "drawing_max_y": d_max_y, 
-            "drawing_min_x": d_min_x, 
-            "drawing_min_y": d_min_y,
-            "offset_x": offset_x,
-            "offset_y": offset_y,
-            "orientation_origin": orientation_origin,
-            "orientation_swap": orientation_swap
-        }
-        
-        filter = Fit(dims)
-        
-        # Process first line
-        lines_to_process = [first_line]
-
         # Log the current max drawing feedrate at start
         self.logger.info(f"Drawing starting with max_drawing_feedrate={self.max_drawing_feedrate}")
-        
-        # Helper to process lines
-        def process_line(line):
-            if line is None: return
-            
-            # Strip comments and whitespace
-            line = line.strip()
-            if not line: return
-            
-            # Skip comments and headers
-            if line.startswith(";") or line.startswith("(") or line.startswith("%"):
-                return
 
-            # Remove inline comments
-            if ";" in line:
-                line = line.split(";")[0].strip()
-            if "(" in line:
-                line = line.split("(")[0].strip()
-            
-            if not line: return
+        # The element is streamed with two stages connected by a bounded buffer:
+        #  * producer: reads the element and parses the lines (runs in a separate thread)
+        #  * sender (this thread): waits for free space in the device buffer and sends the lines
+        # the sender applies the feedrate cap and updates the position while sending so that the feeder status refers to the lines actually sent
+        pipeline = RingBuffer(PIPELINE_BUFFER_SIZE)
+        with self.status_mutex:
+            self._pipeline = pipeline
 
-            # Enforce max drawing feedrate before sending
-            line_upper = line.upper()
-            if self.max_drawing_feedrate > 0 and "F" in line_upper:
-                try:
-                    f_matches = self.feed_regex.findall(line_upper)
-                    if f_matches:
-                        current_f = float(f_matches[0][0])
-                        if current_f > self.max_drawing_feedrate:
-                            self.logger.info(f"[process_line] Clamping F{current_f} -> F{self.max_drawing_feedrate}")
-                            line_upper = self.feed_regex.sub("F{:.0f} ".format(self.max_drawing_feedrate), line_upper, count=1)
-                            line = line_upper
-                except Exception as e:
-                    self.logger.error(f"Error clamping feedrate in process_line: {e}")
+        # the elements that can be resumed report the position of every command (see "DrawingElement.get_cursor")
+        get_cursor = getattr(element, "get_cursor", None)
+        self._sent_cursors.clear()
+        self._last_checkpoint = time.time()
+        if isinstance(element, DrawingElement):
+            self.tracker.start(element)
 
-            # Send raw line
-            self.send_gcode_command(line.upper())
-            
-            while self.is_paused():
-                time.sleep(0.1)
-                if not self.is_running():
-                    return
+        def produce():
+            lines = itertools.chain([first_line], generator)
+            end = object()
+            try:
+                while True:
+                    start = perf_counter()
+                    line = next(lines, end)         # execute the element (iterate over the commands or do what the element is designed for)
+                    if line is end or not self._is_running:
+                        break
+                    _element_read_time.record(perf_counter() - start)
+                    if isinstance(line, str):
+                        start = perf_counter()
+                        line = tokenize(line)       # removes comments and empty lines
+                        _line_cleanup_time.record(perf_counter() - start)
+                    if line is None:
+                        continue
+                    cursor = get_cursor() if not get_cursor is None else None
+                    if not pipeline.put((line, cursor)):      # the pipeline has been closed by the sender
+                        break
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                generator.close()
+                pipeline.close()
 
-        process_line(first_line)
+        producer = Thread(target=produce, daemon=True)
+        producer.name = "drawing_producer"
+        producer.start()
 
-        for k, line in enumerate(generator):     # execute the element (iterate over the commands or do what the element is designed for)
-            if not self.is_running():
+        # the flags are read without the status mutex: "stop()" clears "_is_running" and then wakes up this thread
+        while self._is_running:
+            try:
+                line, cursor = pipeline.get()
+            except RingBuffer.Closed:               # the element is finished or the drawing has been stopped
                 break
-            process_line(line)
+            self.send_gcode_command(line)
+            if not cursor is None:
+                self.tracker.on_commands_sent(cursor[0])
+                self._update_checkpoint(element, cursor)
+
+            if not self._resume_event.is_set():
+                self._resume_event.wait()           # woken up by "resume()" or "stop()"
+        pipeline.clear()
+        producer.join()
+        self.logger.info("Pipeline stats: {}".format(self.get_pipeline_stats()))
+        # the element is finished or has been stopped: there is nothing to resume
+        if not get_cursor is None:
+            self._checkpoint.clear()
+
         with self.status_mutex:
             self._stopped = True
+            self._stopped_condition.notify_all()
         
         # runs the script only it the element is a drawing, otherwise will skip the "after" script
         if isinstance(element, DrawingElement):
@@ -613,6 +782,24 @@ class Feeder():
         if self.is_running():
             self.stop()
 
+    # saves the position of the last command acked by the device (at most every CHECKPOINT_INTERVAL seconds)
+    def _update_checkpoint(self, element, cursor):
+        self._sent_cursors.append((cursor, self.last_commanded_position.x, self.last_commanded_position.y))
+        now = time.time()
+        if now - self._last_checkpoint < CHECKPOINT_INTERVAL:
+            return
+        self._last_checkpoint = now
+        with self.command_buffer_mutex:
+            in_flight = len(self.command_buffer)
+        if in_flight >= len(self._sent_cursors):
+            return
+        (index, offset), x, y = self._sent_cursors[-(in_flight + 1)]
+        get_path_hash = getattr(element, "get_path_hash", None)
+        try:
+            self._checkpoint.save(element.drawing_id, index, offset, x, y, get_path_hash() if not get_path_hash is None else 0)
+        except Exception as e:
+            self.logger.exception(e)
+
     # thread that keep reading the serial port
     def on_serial_read(self, l):
         if not l is None:
@@ -637,38 +824,107 @@ class Feeder():
         if (self.command_buffer_mutex.locked and self.line_number == self._timeout_last_line and not self.is_paused()):
             # self.logger.warning("!Buffer timeout. Trying to clean the buffer!")
             # to clean the buffer try to send an M114 (marlin) or ? (Grbl) message. In this way will trigger the buffer cleaning mechanism
+            # (a long move or the homing can keep the acks back: the depth is reduced only when the status report confirms the lost acks)
             command = firmware.get_buffer_command(self._firmware)
             line = self._generate_line(command, no_buffer=True)  # use the no_buffer to clean one position of the buffer after adding the command
-            self.logger.log(settings_utils.LINE_SERVICE, line)
-            with self.serial_mutex:                
-                self.serial.send(line)
+            self.logger.log(settings_utils.LINE_SERVICE, _to_str(line))
+            if firmware.is_grbl(self._firmware):
+                self.serial.send_realtime(line)
+            else:
+                with self.serial_mutex:
+                    self.serial.send(line)
         else:
             self._update_timeout()
 
     def _ack_received(self, safe_line_number=None, append_left_extra=False):
         if safe_line_number is None:
             with self.command_buffer_mutex:
+                _acks_received.inc()
                 if len(self.command_buffer) != 0:
+                    limited = len(self.command_buffer) >= self._depth.depth
                     self.command_buffer.popleft()
+                    if len(self._sent_times) != 0:
+                        now = perf_counter()
+                        rtt = now - self._sent_times.popleft()
+                        _ack_round_trip_time.record(rtt)
+                        self._depth.on_ack(rtt, now, self._is_sender_waiting(), limited)
+                if len(self.command_buffer_bytes) != 0:
+                    self._rx_buffer_bytes -= self.command_buffer_bytes.popleft()
+                self.command_buffer_condition.notify_all()
         else:
             with self.command_buffer_mutex:   
-                while True:
-                    # Remove the numbers lower than the specified safe_line_number (used in the resend line command: lines older than the one required can be deleted safely)
-                    if len(self.command_buffer) != 0:
-                        line_number = self.command_buffer.popleft()
-                        if line_number >= safe_line_number:
-                            self.command_buffer.appendleft(line_number)
-                            break
+                # Remove the numbers lower than the specified safe_line_number (used in the resend line command: lines older than the one required can be deleted safely)
+                while len(self.command_buffer) != 0:
+                    line_number = self.command_buffer.popleft()
+                    if line_number >= safe_line_number:
+                        self.command_buffer.appendleft(line_number)
+                        break
                 if append_left_extra:
                     self.command_buffer.appendleft(safe_line_number-1)
+                self._align_sent_times()
 
         self._check_buffer_mutex_status()
 
+    # the sender is waiting for a free slot in the device buffer (must be called with the "command_buffer_mutex" acquired)
+    def _is_sender_waiting(self):
+        if self._is_character_counting:
+            return self._rx_waiting
+        return self.command_send_mutex.locked()
+
+    # the lines removed from the buffer without an ack are removed also from the times used for the ack round trip (the oldest ones)
+    def _align_sent_times(self):
+        while len(self._sent_times) > len(self.command_buffer):
+            self._sent_times.popleft()
+
+    # clears the buffer of the lines waiting for an ack (the device has been reset or its buffer is empty)
+    def _clear_command_buffer(self):
+        self._encoder.reset()
+        with self.command_buffer_condition:
+            self.command_buffer.clear()
+            self._sent_times.clear()
+            self.command_buffer_bytes.clear()
+            self._rx_buffer_bytes = 0
+            self.command_buffer_condition.notify_all()
+
+    # character counting protocol: waits until the line fits in the RX buffer of the device (and the in flight depth allows a new line) and reserves the space for it
+    # returns False if the wait has been interrupted by "stop()" (the line must not be sent)
+    # must be called with the "command_buffer_condition" acquired
+    def _wait_rx_buffer_space(self, line_bytes):
+        # a line longer than the RX buffer can be sent only when the buffer is empty
+        needed = min(line_bytes, self._rx_buffer_size)
+        is_full = lambda: self._rx_buffer_bytes + needed > self._rx_buffer_size or len(self.command_buffer) >= self._depth.depth
+        if is_full():
+            self._credit_waits += 1
+            start = perf_counter()
+            self._rx_waiting = True
+            try:
+                while is_full():
+                    if self._rx_wait_released:
+                        return False
+                    if not self.command_buffer_condition.wait(timeout=firmware.get_buffer_timeout(self._firmware)):
+                        # no ack received for a while: asks for a status report to recover the acks that may have been lost
+                        self._mark_status_request()
+                        self.serial.send_realtime(firmware.GRBL.buffer_command)
+            finally:
+                self._rx_waiting = False
+            self._rx_wait_time = perf_counter() - start
+            _rx_buffer_wait_time.record(self._rx_wait_time)
+        self._rx_buffer_bytes += line_bytes
+        self.command_buffer_bytes.append(line_bytes)
+        return True
+
+
+    # marks the status report requested now as usable to recover the lost acks (see "_parse_device_line")
+    # the "?" is sent ahead of the lines still in the write queue: the report is valid only after all the registered lines have been written
+    # (otherwise the mark is not moved and the report is ignored). Must be called with the "command_buffer_mutex" acquired
+    def _mark_status_request(self):
+        if self.serial.drain():
+            self._status_request_mark = self._registered_lines
 
     # check if the buffer of the device is full or can accept more commands
     def _check_buffer_mutex_status(self):
         with self.command_buffer_mutex:
-            if self.command_send_mutex.locked() and len(self.command_buffer) < self.command_buffer_max_length:
+            if self.command_send_mutex.locked() and len(self.command_buffer) < self._depth.depth:
                 self.command_send_mutex.release()
         
 
@@ -680,10 +936,19 @@ class Feeder():
 
         if firmware.get_ACK(self._firmware) in line:  # when an "ack" is received free one place in the buffer
             self._ack_received()
+        elif self._is_character_counting and line.startswith("error:"):  # grbl answers with an error instead of the "ok": the line left the RX buffer anyway
+            self._ack_received()
+            self._encoder.reset()               # the line may have changed the modal state
         
         # check if the received line is for the device being ready
         if firmware.get_ready_message(self._firmware) in line:
-            if self.serial.is_fake:
+            self.feed_override = firmware.FEED_OVERRIDE_DEFAULT     # the override is reset with the device
+            with self._device_state_condition:
+                is_flush_reset, self._flush_reset = self._flush_reset, False
+                self._device_state_condition.notify_all()
+            if is_flush_reset:
+                pass                            # reset by "stop()": the device is not set up again (scripts, autostart)
+            elif self.serial.is_fake:
                 self._on_device_ready()
             else:
                 self._on_device_ready_delay()   # if the device is ready will allow the communication after a small delay
@@ -691,19 +956,52 @@ class Feeder():
         # check marlin specific messages
         if firmware.is_grbl(self._firmware):
             if line.startswith("<"):
+                with self._device_state_condition:
+                    self._device_state = line[1:].split("|")[0].split(",")[0].rstrip(">")
+                    self._device_state_condition.notify_all()
+                # "MPos:x,y,z" or "WPos:x,y,z" (depending on the $10 mask)
+                for key in ("|MPos:", "|WPos:"):
+                    if key in line:
+                        try:
+                            position = line.split(key)[1].split("|")[0].rstrip(">").split(",")
+                            self.tracker.on_position(float(position[0]), float(position[1]))
+                        except (IndexError, ValueError):
+                            pass
+                # "Ov:feed,rapid,spindle" is reported when the overrides change and every few status reports
+                if "|Ov:" in line:
+                    try:
+                        self.feed_override = int(line.split("|Ov:")[1].split(",")[0])
+                    except ValueError:
+                        pass
                 try:
-                    # interested in the "Bf:xx," part where xx is the content of the buffer
+                    # interested in the "Bf:xx,yy" part where xx is the number of free blocks in the planner and yy the free bytes in the RX buffer
                     # select buffer content lines 
                     res = line.split("Bf:")[1]
-                    res = int(res.split(",")[0])
-                    if res == 15: # 15 => buffer is empty on the device (should include also 14 to make it more flexible?)
-                        with self.command_buffer_mutex:
-                            self.command_buffer.clear()
-                    if res!= 0:  # 0 -> buffer is full
-                        with self.command_buffer_mutex:
-                            if len(self.command_buffer) > 0 and self.is_running():
-                                self.command_buffer.popleft()
-                    self._check_buffer_mutex_status()
+                    res = res.split("|")[0].split(">")[0].split(",")
+                    planner_free = int(res[0])
+                    if self._is_character_counting:
+                        # the acks are tracked line by line: the status report is used only to recover lost acks
+                        # if the device is idle with empty buffers and no line has been sent after the status request, the pending acks will never come
+                        rx_free = int(res[1])
+                        if line.startswith("<Idle") and planner_free == firmware.GRBL.planner_buffer_size and rx_free == self._rx_buffer_size:
+                            with self.command_buffer_mutex:
+                                is_stale = self._registered_lines == self._status_request_mark and len(self.command_buffer) > 0
+                                if is_stale:
+                                    self._depth.on_error(TIMEOUT)       # acks lost for sure: the device has nothing left to execute
+                            if is_stale:
+                                self._clear_command_buffer()
+                    else:
+                        if planner_free == 15: # 15 => buffer is empty on the device (should include also 14 to make it more flexible?)
+                            with self.command_buffer_mutex:
+                                self.command_buffer.clear()
+                                self._sent_times.clear()
+                                self.command_buffer_condition.notify_all()
+                        if planner_free != 0:  # 0 -> buffer is full
+                            with self.command_buffer_mutex:
+                                if len(self.command_buffer) > 0 and self.is_running():
+                                    self.command_buffer.popleft()
+                                    self._align_sent_times()
+                        self._check_buffer_mutex_status()
                     
                     if (self.is_running() or self.is_paused()):
                         hide_line = True
@@ -712,6 +1010,19 @@ class Feeder():
                     pass
                 return
 
+            # settings ("$$" command): saves the values used by the feedrate planner
+            elif line.startswith("$") and "=" in line:
+                try:
+                    key, value = line[1:].split("=", 1)
+                    if key in GRBL_MAX_RATE_SETTINGS + GRBL_ACCELERATION_SETTINGS + GRBL_STEPS_SETTINGS:
+                        limits = load_controller_limits()
+                        limits[key] = float(value.split(" ")[0])
+                        save_controller_limits(limits)
+                        if key in GRBL_STEPS_SETTINGS:
+                            self._update_encoder_decimals()
+                except Exception as e:
+                    self.logger.error(f"Error parsing GRBL setting: {e}")
+
             # alarms
             elif "ALARM:" in line:
                 try:
@@ -725,9 +1036,10 @@ class Feeder():
 
             # errors
             elif "error:22" in line:
-                self.stop()
-                with self.command_buffer_mutex:
-                    self.command_buffer.clear()
+                # "stop()" waits for the status reports parsed by this thread (serial reader): it must run on a separate thread
+                th = Thread(target=self._stop_on_error, daemon=True)
+                th.name = "feeder_error_stop"
+                th.start()
             elif "error:" in line:
                 try:
                     error_code = int(line.split("error:")[1].strip())
@@ -741,7 +1053,6 @@ class Feeder():
 
         # TODO divide parser between firmwares?
         # TODO set firmware type automatically on connection
-        # TODO add feedrate control with something like a knob on the user interface to make the drawing slower or faster
 
         # Marlin messages
         else:
@@ -750,25 +1061,17 @@ class Feeder():
             # TODO Should add some sort of filter that if the requested line number is older than the requested ones can send from that number to the first an empty command or the buffer_command
             # Otherwise should not put a buffer_command in the buffer and if a line with the requested number should send the buffer_command
             if "Resend: " in line:
-                line_found = False
                 line_number = int(line.replace("Resend: ", "").replace("\r\n", ""))
-                items = deepcopy(self.command_buffer_history)
-                missing_lines = True
-                first_available_line = None
-                for n, c in items.items():
-                    n_line_number = int(n.strip("N"))
-                    if n_line_number == line_number:
-                        line_found = True
-                    if n_line_number >= line_number:
-                        if first_available_line is None:
-                            first_available_line = line_number
-                        # All the lines after the required one must be resent. Cannot break the loop now
-                        self.serial.send(c)
-                        self.logger.error("Line not received correctly. Resending: {}".format(c.strip("\n")))
-
-                if (not line_found) and not(first_available_line is None):
-                    for i in range(line_number, first_available_line):
-                        self.serial.send(self._generate_line(firmware.MARLIN.buffer_command, no_buffer=True, n=i))
+                with self.command_buffer_mutex:
+                    first_available_line, lines = self._resend_history.get_from(line_number)
+                    self._depth.on_error(RESEND)
+                line_found = first_available_line == line_number
+                if not first_available_line is None:
+                    # the lines that are not in the history anymore are replaced with the buffer command to keep the numeration
+                    fillers = [_to_bytes(self._generate_line(firmware.MARLIN.buffer_command, no_buffer=True, n=i)) for i in range(line_number, first_available_line)]
+                    # All the lines after the required one must be resent: they are joined in a single write
+                    self.serial.send(b"".join(fillers + lines))
+                    self.logger.error("Line not received correctly. Resending lines from N{} to N{}".format(line_number, first_available_line + len(lines) - 1))
 
                 self._ack_received(safe_line_number=line_number-1, append_left_extra=True)
                 # the resend command is sending an ack. should add an entry to the buffer to keep the right lenght (because the line has been sent 2 times)
@@ -787,6 +1090,7 @@ class Feeder():
                     l = line.split(" ")
                     x = float(l[0][2:])     # remove "X:" from the string
                     y = float(l[1][2:])     # remove "Y:" from the string
+                    self.tracker.on_position(x, y)
                 except Exception as e:
                     self.logger.error("Error while parsing M114 result for line: {}".format(line))
                     self.logger.exception(e)
@@ -797,71 +1101,92 @@ class Feeder():
                     if self.is_running():
                         self._ack_received()
                     else:
-                        with self.command_buffer_mutex:
-                            self.command_buffer.clear()
+                        self._clear_command_buffer()
                         self._check_buffer_mutex_status()
 
                 if not self.is_running():
                     hide_line = True
                 
-        
-            # TODO check feedrate response for M220 and set feedrate
-            #elif "_______" in line: # must see the real output from marlin
-            #    self.feedrate = .... # must see the real output from marlin
+
+            # feed override ("M220" answer: "FR:100%")
+            elif line.startswith("FR:"):
+                try:
+                    self.feed_override = int(line[3:].strip().rstrip("%"))
+                except ValueError:
+                    pass
 
         self.logger.log(settings_utils.LINE_RECEIVED, line)
         if not hide_line:
             self.handler.on_message_received(line)
 
     # depending on the firmware, generates a correct line to send to the board
+    # fast mode: the coordinates use the decimals needed by the steps per unit of the controller (when known)
+    def _update_encoder_decimals(self):
+        controller = load_controller_limits()
+        steps = [float(controller[k]) for k in GRBL_STEPS_SETTINGS if float(controller.get(k, 0)) > 0]
+        decimals = get_decimals(max(steps) if len(steps) > 0 else None)
+        if decimals is None:
+            if self.settings["device"]["type"]["value"] == "Cartesian":
+                decimals = 1                # Cartesian do not need extra resolution because already using mm as units. (TODO maybe with inches can have problems? needs to check)
+            else: decimals = 3              # Polar and scara use smaller numbers, will need also decimals
+        self._encoder.set_decimals(decimals)
+        self._encoder.reset()
+
     # args: 
-    #  * command: the gcode command to send
+    #  * command: the gcode command to send (in fast mode can be a GcodeCommand)
     #  * no_buffer (def: False): will not save the line in the buffer (used to get an ack to clear the buffer after a timeout if an ack is lost)
+    # with the character counting protocol will wait until the line fits in the device RX buffer. Returns None if the wait was interrupted by "stop()"
     def _generate_line(self, command, no_buffer=False, n=None):
-        line = command
-        # TODO add a "fast mode" remove spaces from commands and reduce number of decimals
-        # removing spaces is in conflict with the emulator... Need to update the parser there also
-        # fast mode test
-        if self.is_fast_mode:
-            line = command.split(" ")
-            new_line = []
-            for l in line:
-                if l.startswith("X"):
-                    l = "X" + self.command_resolution.format(float(l[1:])).rstrip("0").rstrip(".")
-                elif l.startswith("Y"):
-                    l = "Y" + self.command_resolution.format(float(l[1:])).rstrip("0").rstrip(".")
-                new_line.append(l)
-            line = "".join(new_line)
-
         # marlin needs line numbers and checksum (grbl doesn't)
+        history_n = None
         if firmware.is_marlin(self._firmware):
             # add line number
             if n is None:   # check if the line number was specified or if must increase the number of the sequential command
                 self.line_number += 1
                 n = self.line_number
-            if self.is_fast_mode:
-                line = "N{}{}".format(n, line)
-            else: line = "N{} {} ".format(n, line)
+                history_n = n   # the lines sent again with a specified number (resend) are not saved
+        else: n = None
+
+        if isinstance(command, GcodeCommand) and not self.is_fast_mode:
+            command = str(command)
+        if firmware.is_grbl(self._firmware) and command == firmware.GRBL.buffer_command:
+            line = command                              # the status report request is sent without newline
+        elif self.is_fast_mode:
+            line = self._encoder.encode(command, n)     # bytes: shortest line (see "LineEncoder")
+        elif not n is None:
+            line = "N{} {} ".format(n, command)
             # calculate marlin checksum according to the wiki
-            cs = 0
-            for i in line:
-                cs = cs ^ ord(i)
-            cs &= 0xff
-            
-            line +="*{}\n".format(cs)                   # add checksum to the line
-
-        elif firmware.is_grbl(self._firmware):
-            if line != firmware.GRBL.buffer_command:
-                line += "\n"
-
-        else: line += "\n"
+            line +="*{}\n".format(checksum(line.encode()))     # add checksum to the line
+        else: line = command + "\n"
 
         # store the line in the buffer
+        if self._is_character_counting:
+            # only the characters reaching the RX buffer of the device are counted: the realtime commands are picked out of the stream and do not get an ack
+            if isinstance(line, bytes):
+                line_bytes = len(line)
+            else: line_bytes = len(line.encode()) - sum(line.count(c) for c in firmware.GRBL.realtime_commands)
+            with self.command_buffer_condition:
+                if line_bytes <= 0:
+                    if command == firmware.GRBL.buffer_command:
+                        self._mark_status_request()
+                    return line
+                if not self._wait_rx_buffer_space(line_bytes):
+                    return None
+                self._registered_lines += 1
+                self.command_buffer.append(self.line_number)
+                self._sent_times.append(perf_counter())
+                self._max_in_flight_lines = max(self._max_in_flight_lines, len(self.command_buffer))
+            return line
+
         with self.command_buffer_mutex:
             self.command_buffer.append(self.line_number)
-            self.command_buffer_history["N{}".format(self.line_number)] = line
+            self._sent_times.append(perf_counter())
+            self._max_in_flight_lines = max(self._max_in_flight_lines, len(self.command_buffer))
+            if not history_n is None:
+                self._resend_history.add(history_n, _to_bytes(line))
             if no_buffer:
                 self.command_buffer.popleft()   # remove an element to get a free ack from the non buffered command. Still must keep it in the buffer in the case of an error in sending the line
+                self._align_sent_times()
 
         return line
 
@@ -875,20 +1200,15 @@ class Feeder():
     def _parse_macro(self, command):
         if not MACRO_CHAR in command:
             return command
-        macros = self.macro_regex.findall(command)
-        for m in macros:
-            try:
-                # see https://pypi.org/project/py-expression-eval/ for more info about the parser
-                res = self.macro_parser.parse(m).evaluate({
-                    "X": self.last_commanded_position.x, 
-                    "x": self.last_commanded_position.x,
-                    "Y": self.last_commanded_position.y, 
-                    "y": self.last_commanded_position.y,
-                    "F": self.feedrate,
-                    "f": self.feedrate
-                })
-                command = command.replace(MACRO_CHAR + m + MACRO_CHAR, str(res))
-            except Exception as e:
-                self.logger.error("Error while parsing macro: " + m)
-                self.logger.error(e)
-        return command
\ No newline at end of file
+        return evaluate_macros(command, {
+            "X": self.last_commanded_position.x, 
+            "x": self.last_commanded_position.x,
+            "Y": self.last_commanded_position.y, 
+            "y": self.last_commanded_position.y,
+            "F": self.feedrate,
+            "f": self.feedrate
+        }, self._on_macro_error)
+
+    def _on_macro_error(self, macro, error):
+        self.logger.error("Error while parsing macro: " + macro)
+        self.logger.error(error)
@@ -41,7 +41,11 @@ class FeederEventManager(FeederEventHandler):
             # Send the line to the server
             self.app.semits.update_hw_preview(line)
 
+    def on_device_position(self, position):
+        self.app.semits.update_hw_executed_position(position)
+
     def on_device_ready(self):
+        self.app.qmanager.check_resume()
         self.app.qmanager.check_autostart()
         self.app.qmanager.send_queue_status()
 
@@ -1,5 +1,17 @@
 from dotmap import DotMap
 
+# Streaming protocols used to decide when a new line can be sent to the device
+#  * line_count: keeps a fixed number of lines in the device buffer and relies on the acks (and the buffer status command) to free the slots
+#  * character_counting: keeps track of the bytes sent to the device RX buffer and frees them as soon as the "ok" of each line is received
+#    (see https://github.com/gnea/grbl/wiki/Grbl-v1.1-Interface#streaming-a-g-code-program-to-grbl)
+LINE_COUNT = "line_count"
+CHARACTER_COUNTING = "character_counting"
+
+# feed override: percentage of the programmed feedrate used by the device (grbl limits)
+FEED_OVERRIDE_DEFAULT = 100
+FEED_OVERRIDE_MIN = 10
+FEED_OVERRIDE_MAX = 200
+
 MARLIN = DotMap()
 MARLIN.name = "Marlin"
 MARLIN.ACK = "ok"
@@ -8,6 +20,12 @@ MARLIN.emergency_stop = "M112"
 MARLIN.buffer_timeout = 30
 MARLIN.ready_message = "start"
 MARLIN.position_tolerance = 0.01
+MARLIN.streaming_protocol = LINE_COUNT
+# bounds of the number of lines waiting for an ack (the depth is adapted while streaming, see "InFlightDepth")
+MARLIN.min_in_flight_lines = 2
+MARLIN.initial_in_flight_lines = 8
+MARLIN.max_in_flight_lines = 12                           # the serial RX buffer of marlin is small (128 bytes by default): keep the lines queued there limited
+MARLIN.feed_override_command = "M220 S{}"                 # applied to the moves planned after the command (marlin has no realtime override)
 
 def is_marlin(val):
     return val == MARLIN.name
@@ -18,8 +36,22 @@ GRBL.name = "Grbl"
 GRBL.ACK = "ok"
 GRBL.buffer_command = "?"
 GRBL.emergency_stop = "!"
+GRBL.jog_cancel_command = "\x85"                          # stops the "$J=" jog moves (the other moves are not affected)
+GRBL.soft_reset_command = "\x18"                          # drops the planner blocks and the RX buffer (keeps the position if sent after a completed feed hold)
 GRBL.buffer_timeout = 5
 GRBL.ready_message = "Grbl"
+GRBL.streaming_protocol = CHARACTER_COUNTING
+GRBL.rx_buffer_size = 128                                   # serial RX buffer size of the controller (bytes)
+GRBL.planner_buffer_size = 15                               # number of blocks in the planner buffer of the controller (Bf:15 -> planner empty)
+GRBL.realtime_commands = ("?", "!", "~", "\x18", "\x85", "\x90", "\x91", "\x92", "\x93", "\x94")   # these characters are picked out of the stream by the controller and never reach the RX buffer
+# feed override realtime commands: reset to 100% and steps (the override changes also the moves already in the planner)
+GRBL.feed_override_reset = "\x90"
+GRBL.feed_override_coarse = ("\x91", "\x92")             # +10%, -10%
+GRBL.feed_override_fine = ("\x93", "\x94")               # +1%, -1%
+# the RX buffer is the hard limit with the character counting protocol: the line limit can only reduce the lines queued in the controller
+GRBL.min_in_flight_lines = 4
+GRBL.initial_in_flight_lines = 32
+GRBL.max_in_flight_lines = 32
 
 def is_grbl(val):
     return val == GRBL.name
@@ -48,4 +80,35 @@ def get_emergency_stop_command(firmware):
 def get_ready_message(firmware):
     if firmware == MARLIN.name:
         return MARLIN.ready_message
-    else: return GRBL.ready_message
\ No newline at end of file
+    else: return GRBL.ready_message
+
+def get_streaming_protocol(firmware):
+    if firmware == MARLIN.name:
+        return MARLIN.streaming_protocol
+    else: return GRBL.streaming_protocol
+
+def get_rx_buffer_size(firmware):
+    if firmware == MARLIN.name:
+        return None                 # marlin does not expose the RX buffer size, uses the line count protocol
+    else: return GRBL.rx_buffer_size
+
+# returns the grbl realtime commands that change the feed override from "current" to "target" [%] (the shortest sequence)
+# grbl keeps the override commands received between two runs of its main loop as flags: the commands must be sent one at a time
+def get_grbl_feed_override_commands(current, target):
+    def steps(current):
+        diff = target - current
+        coarse = round(diff/10)
+        if not FEED_OVERRIDE_MIN <= current + coarse*10 <= FEED_OVERRIDE_MAX:
+            coarse = int(diff/10)       # grbl clamps the override: must not go over the limits
+        fine = diff - coarse*10
+        return [GRBL.feed_override_coarse[coarse < 0]]*abs(coarse) + [GRBL.feed_override_fine[fine < 0]]*abs(fine)
+    from_current = steps(current)
+    from_reset = [GRBL.feed_override_reset] + steps(FEED_OVERRIDE_DEFAULT)
+    return from_current if len(from_current) <= len(from_reset) else from_reset
+
+# returns the bounds of the number of lines waiting for an ack: (min, initial, max)
+def get_in_flight_limits(firmware):
+    if firmware == MARLIN.name:
+        f = MARLIN
+    else: f = GRBL
+    return f.min_in_flight_lines, f.initial_in_flight_lines, f.max_in_flight_lines
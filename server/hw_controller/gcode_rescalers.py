@@ -1,4 +1,10 @@
 import math
+import json
+import hashlib
+from array import array
+
+from server.utils.gcode_tokenizer import GcodeCommand, tokenize, STRAIGHT_MOTION_COMMANDS
+from server.utils.arc_fitting import is_arc, interpolate_arc
 
 # This class is the base class to create different types of stretching/clipping of the drawing to fit it on the table (because the drawing may be for a different table size)
 # The base class can be extended to get different results
@@ -23,26 +29,10 @@ class GcodeFilter():
         self.last_y = 0
 
     def get_coords(self, line):
-        l = line.split(" ")
-        if "G0" in l[0] or "G1" in l[0]:
-            x = None
-            y = None
-            for i in l:
-                if len(i) > 1:
-                    if i[0].upper()=="X":
-                        try:
-                            x = float(i[1:])
-                        except: pass
-                    elif i[0].upper()=="Y":
-                        try:
-                            y = float(i[1:])
-                        except: pass
-            
-            if x is None:
-                x = self.last_x
-            if y is None:
-                y = self.last_y
-                
+        command = tokenize(line)
+        if not command is None and command.command in STRAIGHT_MOTION_COMMANDS:
+            x = command.x if not command.x is None else self.last_x
+            y = command.y if not command.y is None else self.last_y
             self.last_x = x
             self.last_y = y
             return x, y
@@ -65,6 +55,33 @@ class GcodeFilter():
         return "G1 X{:.3f} Y{:.3f}".format(x,y)
 
 
+# Returns the dimensions for the Fit filter given the bounds of the drawing and the device settings (values only)
+# Heuristic: if the drawing is larger than 2 units it is considered in mm (1:1 scale, the input bounds are the table size)
+# otherwise it is considered normalized and is stretched to fill the table
+def get_fit_dimensions(xmin, xmax, ymin, ymax, device, pre_transformed=False):
+    width = float(device.get("width", 500))
+    height = float(device.get("height", 500))
+    if (xmax - xmin > 2) or (ymax - ymin > 2) or (xmax > 2) or (ymax > 2):
+        d_min_x, d_max_x = 0, width
+        d_min_y, d_max_y = 0, height
+    else:
+        d_min_x, d_max_x = xmin, xmax
+        d_min_y, d_max_y = ymin, ymax
+    return {
+        "table_x": width,
+        "table_y": height,
+        "drawing_max_x": d_max_x,
+        "drawing_max_y": d_max_y,
+        "drawing_min_x": d_min_x,
+        "drawing_min_y": d_min_y,
+        "offset_x": float(device.get("offset_x", 0)),
+        "offset_y": float(device.get("offset_y", 0)),
+        # pre-transformed drawings are already oriented for the table
+        "orientation_origin": "Bottom-Left" if pre_transformed else device.get("orientation_origin", "Bottom-Left"),
+        "orientation_swap": False if pre_transformed else device.get("orientation_swap", False)
+    }
+
+
 class Fit(GcodeFilter):
     def __init__(self, dimensions, angle = 0):
         super().__init__(dimensions, angle)
@@ -121,6 +138,56 @@ class Fit(GcodeFilter):
             return self.return_line(x_final, y_final)
         return line
 
+    # The transformation is affine: x' = a*x + b*y + c, y' = d*x + e*y + f
+    # returns (a, b, c, d, e, f)
+    def get_affine_matrix(self):
+        c, f = self.transform_point(0, 0)
+        a, d = self.transform_point(1, 0)
+        b, e = self.transform_point(0, 1)
+        return a - c, b - c, c, d - f, e - f, f
+
+    # transforms all the coordinates at once (arrays or lists of x and y values)
+    # returns two arrays of doubles
+    def transform_arrays(self, xs, ys):
+        a, b, c, d, e, f = self.get_affine_matrix()
+        return array("d", [a*x + b*y + c for x, y in zip(xs, ys)]), array("d", [d*x + e*y + f for x, y in zip(xs, ys)])
+
+    # True if the transformation keeps the circles: same scale on both the axes (rotations and mirroring are allowed)
+    def keeps_arcs(self):
+        a, b, _, d, e, _ = self.get_affine_matrix()
+        scale_x, scale_y = a*a + d*d, b*b + e*e
+        return math.isclose(scale_x, scale_y, rel_tol=1e-9) and abs(a*b + d*e) <= 1e-9*scale_x
+
+    # transforms an already parsed command that is not a simple move (arcs or commands with additional parameters)
+    # the transformed position is passed directly (comes from "transform_arrays")
+    # returns the list of the commands to send: with a different scale on the two axes an arc would not be a circle anymore and is
+    # interpolated with short G1 segments instead (needs the starting point of the arc in the drawing coordinates)
+    def transform_command(self, command, x, y, start=(0, 0)):
+        if is_arc(command) and not self.keeps_arcs():
+            x0, y0 = start
+            x1 = command.x if not command.x is None else x0
+            y1 = command.y if not command.y is None else y0
+            points = interpolate_arc(x0, y0, x1, y1, command.i or 0, command.j or 0, command.command == "G2")
+            xs, ys = self.transform_arrays([p[0] for p in points], [p[1] for p in points])
+            xs[-1], ys[-1] = x, y
+            return [GcodeCommand("G1", px, py, command.f if n == 0 else None) for n, (px, py) in enumerate(zip(xs, ys))]
+        a, b, _, d, e, _ = self.get_affine_matrix()
+        i = j = None
+        if not command.i is None or not command.j is None:
+            ci = command.i if not command.i is None else 0
+            cj = command.j if not command.j is None else 0
+            i, j = a*ci + b*cj, d*ci + e*cj                 # the arc center is relative: only the linear part is applied
+        code = command.command
+        if a*e - b*d < 0 and code in ("G2", "G3"):          # a mirrored drawing inverts the arcs direction
+            code = "G3" if code == "G2" else "G2"
+        return [command.with_position(x, y, i, j, code)]
+
+    # returns an hash of the filter parameters (can be used to cache the transformed drawings)
+    def get_hash(self):
+        params = [self.table_x, self.table_y, self.drawing_min_x, self.drawing_max_x, self.drawing_min_y, self.drawing_max_y,
+                  self.offset_x, self.offset_y, self.orientation_origin, self.orientation_swap, self.angle]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()[:12]
+
 class FitNoStretch(GcodeFilter):
     def __init__(self, dimensions, angle = 0):
         super().__init__(dimensions, angle)
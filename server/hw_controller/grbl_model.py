@@ -0,0 +1,341 @@
+from collections import deque
+from math import sqrt, hypot
+
+from server.utils.gcode_tokenizer import tokenize
+from server.utils.arc_fitting import is_arc, interpolate_arc
+from server.utils.feedrate_planner import junction_speed, DEFAULT_ACCELERATION, DEFAULT_MAX_FEEDRATE, GRBL_MAX_RATE_SETTINGS, GRBL_ACCELERATION_SETTINGS
+import server.hw_controller.firmware_defaults as firmware
+
+# Model of a Grbl controller used by the emulator (see "Emulator", "grbl" model)
+#  * RX buffer: the lines wait in the serial buffer (128 bytes) until the parser reads them. The bytes are freed as soon as the line is read
+#  * planner: the moves are added as blocks to a queue of 15 blocks. The "ok" of a line is sent when all its blocks are in the planner:
+#    when the planner is full the parser waits for the block being executed to finish, like grbl does
+#  * the speed at the junctions is limited with the junction deviation model and the blocks are executed with trapezoidal speed profiles
+#  * "?" status reports with the state, the machine position (along the block being executed) and the usage of the buffers ("Bf:")
+#  * the lines are parsed with the tokenizer: the compact format of the fast mode ("G1X10Y2.5F3000") and the modal moves ("X10Y2") are supported
+#  * "$J=" jog moves (do not change the modal state) and the jog cancel: the jog stops immediately and the jog blocks in the planner are dropped
+#  * feed override realtime commands: reported in the status reports ("Ov:") and applied to the blocks planned after the change
+# When a block is added the block being executed is planned again from its current position and speed (its exit speed can increase).
+# Simplifications: the feed hold stops the motion immediately, arcs are split with the same interpolation used by the previews and relative moves (G91) are not supported.
+
+# grbl default junction deviation ($11) [mm]
+JUNCTION_DEVIATION = 0.01
+VERSION_MESSAGE = "Grbl 1.1h ['$' for help]"
+# "error:22": feed rate has not yet been set or is undefined
+UNDEFINED_FEEDRATE_ERROR = "error:22"
+# "error:16": jog command has no '=' or contains prohibited g-code (the feedrate is mandatory)
+JOG_ERROR = "error:16"
+JOG_PREFIX = "$J="
+MOTION_MODES = ("G0", "G1", "G2", "G3")
+
+# returns the feed override after a grbl feed override realtime command
+def apply_feed_override_command(value, command):
+    if command == firmware.GRBL.feed_override_reset:
+        return firmware.FEED_OVERRIDE_DEFAULT
+    for steps, step in ((firmware.GRBL.feed_override_coarse, 10), (firmware.GRBL.feed_override_fine, 1)):
+        if command in steps:
+            value += step if command == steps[0] else -step
+    return min(max(value, firmware.FEED_OVERRIDE_MIN), firmware.FEED_OVERRIDE_MAX)
+
+class Block():
+    __slots__ = ("x", "y", "length", "ux", "uy", "nominal", "max_entry", "entry")
+
+    def __init__(self, x, y, length, ux, uy, nominal):
+        self.x = x
+        self.y = y
+        self.length = length
+        self.ux = ux
+        self.uy = uy
+        self.nominal = nominal          # max speed along the block [mm/s]
+        self.max_entry = 0              # max speed at the beginning of the block (junction limit) [mm/s]
+        self.entry = 0                  # planned speed at the beginning of the block [mm/s]
+
+def trapezoid(v0, v1, nominal, acceleration, length):
+    """Returns the acceleration, cruise and deceleration times and the peak speed of a block starting at v0 and ending at v1"""
+    a = acceleration
+    accel_distance = (nominal**2 - v0**2)/(2*a)
+    decel_distance = (nominal**2 - v1**2)/(2*a)
+    if accel_distance + decel_distance <= length:
+        return (nominal - v0)/a, (length - accel_distance - decel_distance)/nominal, (nominal - v1)/a, nominal
+    # the nominal speed cannot be reached: triangular profile
+    peak = min(sqrt(max((v0**2 + v1**2)/2 + a*length, 0)), nominal)
+    return max(peak - v0, 0)/a, 0, max(peak - v1, 0)/a, peak
+
+def trapezoid_distance(profile, v0, acceleration, t):
+    """Returns the distance travelled and the speed after the time t along a block with the given profile"""
+    t_accel, t_cruise, t_decel, peak = profile
+    a = acceleration
+    if t <= t_accel:
+        return v0*t + a*t*t/2, v0 + a*t
+    d = v0*t_accel + a*t_accel*t_accel/2
+    t -= t_accel
+    if t <= t_cruise:
+        return d + peak*t, peak
+    d += peak*t_cruise
+    t = min(t - t_cruise, t_decel)
+    return d + peak*t - a*t*t/2, peak - a*t
+
+class GrblModel():
+    def __init__(self, now, acceleration=DEFAULT_ACCELERATION, max_rate=DEFAULT_MAX_FEEDRATE, junction_deviation=JUNCTION_DEVIATION, rx_buffer_size=firmware.GRBL.rx_buffer_size, planner_size=firmware.GRBL.planner_buffer_size):
+        self.acceleration = acceleration            # mm/s^2
+        self.max_rate = max_rate                    # mm/min
+        self.junction_deviation = junction_deviation
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+        self.starved_time = 0                       # time spent with the planner empty (not in hold) [s]
+        self.reset(now)
+
+    # soft reset: the buffers are cleared and the position is kept
+    def reset(self, now):
+        if len(getattr(self, "_planner", ())) > 0:
+            self.update(now)
+            if not self._block_start is None:
+                self._split_block(now)              # the device stops where it is
+        self._rx = deque()                          # lines waiting to be read by the parser
+        self._rx_bytes = 0
+        self.rx_overflows = 0                       # number of lines received when the RX buffer was full (the real device would lose them)
+        self._line_blocks = deque()                 # blocks of the line being parsed that are waiting for free space in the planner
+        self._line_waiting = False                  # True if the line being parsed did not get its "ok" yet
+        self._planner = deque()
+        self._time = now                            # time reached by the simulation
+        self._block_start = None                    # time at which the block being executed started (None if the planner is not running)
+        self._block_profile = None
+        self._hold_start = None
+        self.mx, self.my = getattr(self, "mx", 0.0), getattr(self, "my", 0.0)      # end of the last block executed
+        self.x, self.y = self.mx, self.my           # end of the last move parsed (the moves not executed are dropped by the reset)
+        self.motion = "G0"
+        self.feedrate = 0
+        self.jogging = False                        # the planner contains jog moves
+        self.feed_override = firmware.FEED_OVERRIDE_DEFAULT
+
+    def is_idle(self):
+        return len(self._planner) == 0 and len(self._rx) == 0 and not self._line_waiting
+
+    def rx_free(self):
+        return self.rx_buffer_size - self._rx_bytes
+
+    def planner_free(self):
+        return self.planner_size - len(self._planner)
+
+    # a line received from the serial port: returns the messages sent back by the device
+    def receive(self, line, now):
+        messages = self.update(now)
+        size = len(line.encode())
+        if self._rx_bytes + size > self.rx_buffer_size:
+            self.rx_overflows += 1
+        self._rx.append(line)
+        self._rx_bytes += size
+        messages += self._parse(now)
+        return messages
+
+    # runs the planner until the given time: returns the messages sent back by the device
+    def update(self, now):
+        messages = []
+        while self._hold_start is None and len(self._planner) > 0:
+            end = self._start_block()
+            if end > now:
+                break
+            block = self._planner.popleft()
+            self.mx, self.my = block.x, block.y
+            self._time = end
+            self._block_start = None
+            messages += self._parse(end)            # the parser may be waiting for free space in the planner
+        if len(self._planner) == 0 and len(self._line_blocks) == 0:
+            self.jogging = False
+        if len(self._planner) == 0 and self._hold_start is None:
+            self.starved_time += max(now - self._time, 0)
+            self._time = max(self._time, now)       # the device is idle
+        return messages
+
+    # returns the time of the next event (the end of the block being executed) or None if the planner is not running
+    def next_event_time(self):
+        if not self._hold_start is None or len(self._planner) == 0:
+            return None
+        return self._start_block()
+
+    def hold(self, now):
+        if self._hold_start is None:
+            self.update(now)
+            self._hold_start = now
+
+    def resume(self, now):
+        if not self._hold_start is None:
+            if self._block_start is None:
+                self._time = max(self._time, now)
+            else: self._block_start += now - self._hold_start
+            self._hold_start = None
+
+    # jog cancel: the jog stops where it is (the real device decelerates) and the jog moves left are dropped
+    # returns the messages sent back by the device (the "ok" of the line waiting for free space in the planner)
+    def jog_cancel(self, now):
+        messages = self.update(now)
+        if not self.jogging:
+            return messages
+        if not self._block_start is None:
+            self._split_block(now)
+        self._planner.clear()
+        self._line_blocks.clear()
+        self._block_start = None
+        self._time = max(self._time, now)
+        self.x, self.y = self.mx, self.my
+        self.jogging = False
+        return messages + self._parse(now)
+
+    def feed_override_command(self, command, now):
+        self.update(now)
+        self.feed_override = apply_feed_override_command(self.feed_override, command)
+
+    def status_report(self, now):
+        x, y, speed = self.mx, self.my, 0
+        if not self._block_start is None:
+            distance, speed = self._block_progress(now)
+            block = self._planner[0]
+            x, y = self.mx + block.ux*distance, self.my + block.uy*distance
+            if not self._hold_start is None:
+                speed = 0
+        if self.is_idle():
+            state = "Idle"
+        elif not self._hold_start is None:
+            state = "Hold:0"
+        else: state = "Jog" if self.jogging else "Run"
+        return "<{}|MPos:{:.3f},{:.3f},0.000|Bf:{},{}|FS:{:.0f},0|Ov:{},100,100>".format(state, x, y, self.planner_free(), self.rx_free(), speed*60, self.feed_override)
+
+    # answer to the "$$" command (only the settings used by the feeder)
+    def settings_report(self):
+        values = {"11": self.junction_deviation}
+        for k in GRBL_MAX_RATE_SETTINGS:
+            values[k] = self.max_rate
+        for k in GRBL_ACCELERATION_SETTINGS:
+            values[k] = self.acceleration
+        return ["${}={:.3f}".format(k, v) for k, v in values.items()]
+
+    # starts the first block of the planner (if not running yet) and returns the time at which it will be completed
+    def _start_block(self):
+        if self._block_start is None:
+            self._block_start = self._time
+            self._update_profile()
+        t_accel, t_cruise, t_decel, _ = self._block_profile
+        return self._block_start + t_accel + t_cruise + t_decel
+
+    def _update_profile(self):
+        block = self._planner[0]
+        exit_speed = self._planner[1].entry if len(self._planner) > 1 else 0
+        self._block_profile = trapezoid(block.entry, exit_speed, block.nominal, self.acceleration, block.length)
+
+    # distance travelled and speed along the block being executed
+    def _block_progress(self, now):
+        block = self._planner[0]
+        t = (now if self._hold_start is None else self._hold_start) - self._block_start
+        distance, speed = trapezoid_distance(self._block_profile, block.entry, self.acceleration, t)
+        return min(distance, block.length), speed
+
+    # the part of the block being executed that is already done is removed: the rest of the block can be planned again
+    def _split_block(self, now):
+        block = self._planner[0]
+        distance, speed = self._block_progress(now)
+        self.mx, self.my = self.mx + block.ux*distance, self.my + block.uy*distance
+        block.length -= distance
+        block.entry = speed
+        self._block_start = now if self._hold_start is None else self._hold_start
+
+    # reads the lines from the RX buffer while the planner has space for their blocks
+    def _parse(self, now):
+        messages = []
+        while True:
+            if self._line_waiting:
+                while len(self._line_blocks) > 0 and len(self._planner) < self.planner_size:
+                    self._add_block(self._line_blocks.popleft(), now)
+                if len(self._line_blocks) > 0:
+                    return messages             # waits for a free block
+                self._line_waiting = False
+                messages.append(firmware.GRBL.ACK)
+            if len(self._rx) == 0:
+                return messages
+            line = self._rx.popleft()
+            self._rx_bytes -= len(line.encode())
+            answer = self._execute(line)
+            if answer is None:
+                self._line_waiting = True       # the "ok" is sent when the blocks are in the planner
+            else:
+                messages += answer
+
+    # executes a line: returns the messages to send back or None if the line generated some blocks (added to "_line_blocks")
+    def _execute(self, line):
+        if line.strip() == "$$":
+            return self.settings_report() + [firmware.GRBL.ACK]
+        command = tokenize(line)
+        if line.lstrip().startswith(JOG_PREFIX):
+            return self._jog(command, "G91" in line)
+        if command is None or command.extra and (command.command is None or line.lstrip().startswith("$")):
+            return [firmware.GRBL.ACK]          # empty lines, comments and "$" commands
+        if not command.f is None:
+            self.feedrate = command.f
+        if command.command == "G28":
+            x, y, motion = 0, 0, "G0"
+        else:
+            if command.command in MOTION_MODES:
+                self.motion = command.command
+            elif not command.command is None or (command.x is None and command.y is None):
+                return [firmware.GRBL.ACK]      # not a move
+            x = command.x if not command.x is None else self.x
+            y = command.y if not command.y is None else self.y
+            motion = self.motion
+        if motion == "G0":
+            nominal = self.max_rate
+        else:
+            if self.feedrate <= 0:
+                return [UNDEFINED_FEEDRATE_ERROR]
+            nominal = min(self.feedrate*self.feed_override/100, self.max_rate)
+        if motion in ("G2", "G3") and is_arc(command):
+            points = interpolate_arc(self.x, self.y, x, y, command.i or 0, command.j or 0, motion == "G2")
+        else: points = [(x, y)]
+        return self._add_line_blocks(points, nominal)
+
+    # jog move: uses its own feedrate and does not change the modal state
+    def _jog(self, command, relative):
+        if command is None or command.f is None or command.f <= 0:
+            return [JOG_ERROR]
+        if relative:
+            x, y = self.x + (command.x or 0), self.y + (command.y or 0)
+        else:
+            x = command.x if not command.x is None else self.x
+            y = command.y if not command.y is None else self.y
+        self.jogging = True
+        return self._add_line_blocks([(x, y)], min(command.f, self.max_rate))
+
+    # splits the line in blocks through the given points: returns the messages to send back or None if some blocks have been added
+    def _add_line_blocks(self, points, nominal):
+        px, py = self.x, self.y
+        for bx, by in points:
+            length = hypot(bx - px, by - py)
+            if length > 0:                      # zero length moves are dropped by the planner
+                self._line_blocks.append(Block(bx, by, length, (bx - px)/length, (by - py)/length, nominal/60))
+            px, py = bx, by
+        self.x, self.y = px, py
+        if len(self._line_blocks) == 0:
+            return [firmware.GRBL.ACK]
+        return None
+
+    def _add_block(self, block, now):
+        if len(self._planner) > 0:
+            last = self._planner[-1]
+            block.max_entry = min(junction_speed(last.ux, last.uy, block.ux, block.uy, self.acceleration, self.junction_deviation), last.nominal, block.nominal)
+        if not self._block_start is None:
+            self._split_block(now)
+        self._planner.append(block)
+        self._recalculate()
+        if not self._block_start is None:
+            self._update_profile()
+
+    # the blocks must be able to stop at the end of the planner and to reach the planned speeds with the acceleration limit
+    def _recalculate(self):
+        a = self.acceleration
+        first = 1 if not self._block_start is None else 0       # the entry speed of the block being executed cannot change
+        next_entry = 0
+        for k in range(len(self._planner) - 1, first - 1, -1):
+            block = self._planner[k]
+            block.entry = min(block.max_entry, sqrt(next_entry**2 + 2*a*block.length))
+            next_entry = block.entry
+        for k in range(max(first, 1), len(self._planner)):
+            previous = self._planner[k-1]
+            self._planner[k].entry = min(self._planner[k].entry, sqrt(previous.entry**2 + 2*a*previous.length))
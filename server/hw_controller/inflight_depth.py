@@ -0,0 +1,111 @@
+from collections import deque
+from math import ceil
+from time import time
+
+from server.utils.metrics import metrics
+
+# Adaptive number of lines waiting for an ack ("in flight depth")
+# The lines in flight must cover the round trip of a line (serial transfer, parsing, ack) otherwise the planner of the controller runs dry.
+# More lines than that are only queued in the controller: they slow down the reaction to pause/stop and increase the risk of overflowing its serial buffer.
+# The depth is evaluated every WINDOW acks:
+#  * round trip: the minimum ack round trip of the window is the latency without lines queued in the controller
+#  * segment time: interval between the acks received while the sender is waiting (the controller is consuming the lines at its own pace)
+#  * starved: the depth was limiting the sender and the lines were not queued in the controller (round trip close to the minimum) -> depth + 1
+#  * queueing: the lines are queued in the controller (round trip much longer than the minimum) and the depth is more than the one needed to cover the round trip -> depth - 1
+#  * resend, timeout: the controller lost or did not answer some lines -> depth halved
+# Not thread safe: must be used with the buffer mutex of the feeder acquired
+
+WINDOW = 32
+QUEUE_FACTOR = 2            # the lines are considered queued in the controller when the median round trip is longer than QUEUE_FACTOR times the minimum
+HEADROOM = 2                # lines added to the ones needed to cover the round trip
+LIMITED_FRACTION = 0.5      # fraction of the acks of the window received with the depth limiting the sender needed to grow the depth
+SEGMENT_TIME_WEIGHT = 0.1   # weight of the new samples in the moving average of the segment time
+HISTORY_SIZE = 20           # number of changes kept for the pipeline stats
+
+STARVED = "starved"
+QUEUEING = "queueing"
+RESEND = "resend"
+TIMEOUT = "timeout"
+LIMITS = "limits"
+REASONS = (STARVED, QUEUEING, RESEND, TIMEOUT, LIMITS)
+
+_depth_gauge = metrics.gauge("in_flight_depth", "Max number of lines waiting for an ack allowed by the feeder")
+_needed_gauge = metrics.gauge("in_flight_depth_needed", "Number of lines needed to cover the ack round trip (0 if unknown)")
+_changes = {r: metrics.counter("in_flight_depth_{}_total".format(r), "Changes of the in flight depth with reason '{}'".format(r)) for r in REASONS}
+
+class InFlightDepth():
+    def __init__(self, min_depth, initial_depth, max_depth):
+        self.history = deque(maxlen=HISTORY_SIZE)   # last changes: (time, old depth, new depth, reason)
+        self.depth = initial_depth
+        self.set_limits(min_depth, initial_depth, max_depth)
+
+    # sets the bounds of the depth (the firmware has been changed)
+    def set_limits(self, min_depth, initial_depth, max_depth):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.segment_time = None
+        self.needed = None
+        self._last_ack = None
+        self._reset_window()
+        self._set(initial_depth, LIMITS)
+
+    def _reset_window(self):
+        self._rtts = []
+        self._limited = 0
+
+    def _set(self, depth, reason):
+        depth = max(self.min_depth, min(self.max_depth, depth))
+        if depth != self.depth:
+            self.history.append((time(), self.depth, depth, reason))
+            _changes[reason].inc()
+            self.depth = depth
+        _depth_gauge.set(self.depth)
+
+    # registers an ack
+    #  * rtt: round trip time of the line [s]
+    #  * now: time of the ack [s]
+    #  * waiting: the sender was waiting for a free slot in the device buffer
+    #  * limited: the number of lines in flight was at the depth limit
+    def on_ack(self, rtt, now, waiting, limited):
+        if waiting and not self._last_ack is None:
+            interval = now - self._last_ack
+            if self.segment_time is None:
+                self.segment_time = interval
+            else: self.segment_time += SEGMENT_TIME_WEIGHT*(interval - self.segment_time)
+        self._last_ack = now if waiting else None
+        self._rtts.append(rtt)
+        if limited:
+            self._limited += 1
+        if len(self._rtts) >= WINDOW:
+            self._evaluate()
+
+    def _evaluate(self):
+        rtts = sorted(self._rtts)
+        rtt_min, rtt_median = rtts[0], rtts[len(rtts)//2]
+        if not self.segment_time:
+            self.needed = None
+        else: self.needed = ceil(rtt_min/self.segment_time) + HEADROOM
+        _needed_gauge.set(self.needed or 0)
+
+        is_queueing = rtt_median > QUEUE_FACTOR*rtt_min
+        if not is_queueing and self._limited >= LIMITED_FRACTION*len(rtts):
+            self._set(self.depth + 1, STARVED)
+        elif is_queueing and not self.needed is None and self.depth > self.needed:
+            self._set(self.depth - 1, QUEUEING)
+        self._reset_window()
+
+    # the device lost some lines (resend request) or did not answer for a while (timeout)
+    def on_error(self, reason):
+        self._set(self.depth//2, reason)
+        self._last_ack = None
+        self._reset_window()
+
+    def get_stats(self):
+        return {
+            "depth": self.depth,
+            "min_depth": self.min_depth,
+            "max_depth": self.max_depth,
+            "needed": self.needed,
+            "segment_time": self.segment_time,
+            "changes": [{"time": t, "from": old, "to": new, "reason": reason} for t, old, new, reason in self.history]
+        }
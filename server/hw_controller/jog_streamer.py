@@ -0,0 +1,135 @@
+import time
+from math import hypot
+from threading import Thread, Condition, Lock
+
+from server.utils.gcode_tokenizer import format_number
+from server.utils.metrics import metrics
+from server.utils.feedrate_planner import get_max_feedrate
+from server.utils.settings_utils import get_only_values
+import server.hw_controller.firmware_defaults as firmware
+
+# Live jog streaming (live mode, Etch-a-Sketch)
+# The frontend sends the position of the cursor as often as it wants: the points are coalesced to the latest target and the device is moved
+# toward it with short steps sent at a fixed rate (JOG_RATE). Every step is as long as the distance covered at the jog feedrate in one period,
+# so the device never has more than a couple of periods of motion queued: the reaction to a new target does not depend on how fast the user drags
+# (the cursor may run ahead of the device but the device always heads to the latest target).
+# At most JOG_MAX_IN_FLIGHT lines are waiting for an ack: the steps are not queued in the serial buffer if the device slows down.
+# The feedrate of the targets must be positive and is limited to the max rate of the controller.
+#  * grbl: "$J=" jog commands. "cancel" sends the jog cancel realtime command (0x85): the device decelerates and drops the queued jog moves
+#  * marlin: G1 moves (there is no jog cancel: the queued steps are completed)
+
+JOG_RATE = 25                   # steps per second [Hz]
+JOG_INTERVAL = 1/JOG_RATE
+JOG_MAX_IN_FLIGHT = 2           # max number of jog lines waiting for an ack
+JOG_MIN_DISTANCE = 0.01         # targets closer than this to the last step are not sent [mm]
+JOG_PREFIX = "$J="
+JOG_STOP_TIMEOUT = 1             # max time waited for the streaming thread when stopping [s]
+
+_points_received = metrics.counter("jog_points_total", "Live jog targets received from the frontend")
+_steps_sent = metrics.counter("jog_steps_total", "Live jog lines sent to the device")
+_jog_latency = metrics.histogram("jog_latency_seconds", "Time between a live jog target being received and the first step sent toward it")
+
+def jog_line(x, y, feedrate, is_grbl):
+    """Returns the line moving to the given absolute position (grbl jog command or marlin move)"""
+    words = "X{} Y{} F{}".format(format_number(x), format_number(y), format_number(feedrate))
+    if is_grbl:
+        return JOG_PREFIX + "G90 G21 " + words
+    return "G1 " + words
+
+class JogStreamer():
+    def __init__(self, feeder):
+        self.feeder = feeder
+        self._condition = Condition()       # signalled when a new target is received or the streamer is stopped
+        self._send_mutex = Lock()           # a step cannot be sent while the jog is being cancelled
+        self._is_running = False
+        self._th = None
+        self._target = None                 # latest target: (x, y, feedrate)
+        self._received_time = None          # time at which the first target received after the last step was received
+        self._position = None               # end of the last step sent
+        self._max_feedrate = None           # max rate of the controller [mm/min] (read when the streaming starts)
+
+    def is_running(self):
+        return self._is_running
+
+    # starts the streaming from the last position commanded to the device
+    def start(self):
+        with self._condition:
+            if self._is_running:
+                return
+            self._is_running = True
+            self._target = None
+            self._received_time = None
+            self._position = (self.feeder.last_commanded_position.x, self.feeder.last_commanded_position.y)
+            self._max_feedrate = get_max_feedrate(get_only_values(self.feeder.settings["device"]))
+        self._th = Thread(target=self._thf, daemon=True)
+        self._th.name = "jog_streamer"
+        self._th.start()
+
+    # stops the streaming and cancels the motion left
+    def stop(self):
+        with self._condition:
+            if not self._is_running:
+                return
+            self._is_running = False
+            self._condition.notify_all()
+        self._th.join(timeout=JOG_STOP_TIMEOUT)
+        if self._th.is_alive():
+            self.feeder.logger.warning("The jog streaming thread did not stop in time")
+        self.cancel()
+
+    # new target of the jog [mm, mm/min]: replaces the previous one if not reached yet
+    def move_to(self, x, y, feedrate):
+        feedrate = float(feedrate)
+        if not feedrate > 0:
+            self.feeder.logger.warning("Live jog target ignored: the feedrate must be positive (received {})".format(feedrate))
+            return
+        with self._condition:
+            if not self._is_running:
+                return
+            _points_received.inc()
+            self._target = (float(x), float(y), min(feedrate, self._max_feedrate))
+            if self._received_time is None:
+                self._received_time = time.perf_counter()
+            self._condition.notify_all()
+
+    # stops the device where it is (grbl only) and drops the target
+    def cancel(self):
+        with self._send_mutex:
+            with self._condition:
+                self._target = None
+                self._received_time = None
+            self.feeder.jog_cancel()        # the device stops before the end of the last step: the steps are absolute, only the length of the next one changes a bit
+
+    def _has_target(self):
+        return not self._target is None and hypot(self._target[0] - self._position[0], self._target[1] - self._position[1]) > JOG_MIN_DISTANCE
+
+    def _thf(self):
+        next_time = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: not self._is_running or self._has_target())
+                # fixed rate: the targets received until the next step are coalesced
+                self._condition.wait_for(lambda: not self._is_running, timeout=max(next_time - time.perf_counter(), 0))
+                if not self._is_running:
+                    return
+            if not self.feeder.wait_in_flight_lines(JOG_MAX_IN_FLIGHT, timeout=JOG_INTERVAL):
+                continue
+            next_time = time.perf_counter() + JOG_INTERVAL
+            with self._send_mutex:
+                with self._condition:
+                    if not self._has_target():      # cancelled while waiting
+                        continue
+                    x, y, feedrate = self._target
+                    received_time, self._received_time = self._received_time, None
+                # the step is the distance covered in a period at the jog feedrate
+                px, py = self._position
+                distance = hypot(x - px, y - py)
+                step = feedrate/60*JOG_INTERVAL
+                if distance > step:
+                    x, y = px + (x - px)*step/distance, py + (y - py)*step/distance
+                is_grbl = firmware.is_grbl(self.feeder.settings["device"]["firmware"]["value"])
+                self.feeder.send_gcode_command(jog_line(x, y, feedrate, is_grbl))
+                self._position = (x, y)
+            _steps_sent.inc()
+            if not received_time is None:
+                _jog_latency.record(next_time - JOG_INTERVAL - received_time)
@@ -0,0 +1,89 @@
+from math import ceil, log10
+from functools import reduce
+from operator import xor
+
+from server.utils.gcode_tokenizer import GcodeCommand, tokenize
+
+# Fast mode line encoder: makes the lines as short as possible to send more segments per second at the same baudrate
+#  * spaces removed
+#  * modal words dropped: the motion command (G0, G1, G2, G3) and the feedrate are sent only when they change
+#    (grbl only for the motion command: marlin built without GCODE_MOTION_MODES rejects the lines with coordinates only)
+#  * X, Y, I, J with the decimals needed by the resolution of the motors (derived from the steps per unit) and without trailing zeros
+#  * marlin: line number and checksum (computed on the bytes of the line)
+# The modal state must be reset when the controller may have lost it (reset, stop, errors): the next line will have all the words again
+# Lines that are not simple moves are sent without spaces and reset the modal state (they may change it)
+
+MAX_DECIMALS = 4
+FEEDRATE_FORMAT = "%.1f"
+_FOLD_SHIFTS = (512, 256, 128, 64, 32, 16, 8)
+_MOTION_COMMANDS = ("G0", "G1", "G2", "G3")
+
+def get_decimals(steps_per_unit):
+    """Returns the number of decimals needed to address every step (the rounding error is less than half step)"""
+    if steps_per_unit is None or steps_per_unit <= 1:
+        return None
+    return min(ceil(log10(steps_per_unit) - 1e-9), MAX_DECIMALS)
+
+def checksum(data):
+    """Marlin checksum (xor of all the bytes of the line)"""
+    if len(data) > 128:
+        return reduce(xor, data, 0)
+    # xor of the bytes by folding the line as a single integer (faster than a loop over the bytes)
+    value = int.from_bytes(data, "little")
+    for s in _FOLD_SHIFTS:
+        value ^= value >> s
+    return value & 0xff
+
+def _format_number(value, number_format):
+    res = (number_format % value).rstrip("0").rstrip(".")
+    return res if res != "-0" else "0"
+
+class LineEncoder():
+    def __init__(self, decimals=3):
+        self.set_decimals(decimals)
+        self.reset()
+
+    def set_decimals(self, decimals):
+        self.decimals = decimals
+        self._number_format = "%.{}f".format(decimals)
+
+    # the controller state is unknown: the next line will contain all its words
+    def reset(self):
+        self._motion = None
+        self._feedrate = None
+
+    # returns the body of the line (without line number, checksum and newline)
+    #  * command: text or GcodeCommand (the drawings are already parsed)
+    #  * keep_motion: the motion command is sent on every line (marlin)
+    def encode_body(self, command, keep_motion=False):
+        parsed = command if isinstance(command, GcodeCommand) else tokenize(command)
+        if parsed is None:
+            return ""
+        if parsed.extra or not parsed.command in _MOTION_COMMANDS:
+            self.reset()
+            return str(parsed).replace(" ", "")
+        number_format = self._number_format
+        words = parsed.command if parsed.command != self._motion or keep_motion else ""
+        self._motion = parsed.command
+        if not parsed.x is None:
+            words += "X" + _format_number(parsed.x, number_format)
+        if not parsed.y is None:
+            words += "Y" + _format_number(parsed.y, number_format)
+        if not parsed.i is None:
+            words += "I" + _format_number(parsed.i, number_format)
+        if not parsed.j is None:
+            words += "J" + _format_number(parsed.j, number_format)
+        if not parsed.f is None and parsed.f != self._feedrate:
+            words += "F" + _format_number(parsed.f, FEEDRATE_FORMAT)
+            self._feedrate = parsed.f
+        if words == "":
+            return parsed.command       # the line must not be empty (the device needs a line to send an ack)
+        return words
+
+    # returns the bytes to send
+    #  * n: line number (marlin only, adds also the checksum and keeps the motion command)
+    def encode(self, command, n=None):
+        if n is None:
+            return (self.encode_body(command) + "\n").encode()
+        data = ("N{}".format(n) + self.encode_body(command, keep_motion=True)).encode()
+        return data + b"*%d\n" % checksum(data)
@@ -0,0 +1,142 @@
+import math
+import time
+from threading import Thread, Condition
+
+from server.utils.metrics import metrics
+import server.hw_controller.firmware_defaults as firmware
+
+# Executed position of the device
+# The lines sent are ahead of the device by the whole planner buffer: the progress of a drawing must be measured on the position reported by the device
+#  * grbl: the position is requested at a fixed rate (serial.position_poll_rate setting) with the "?" realtime command (not counted in the RX buffer, no ack)
+#  * marlin: there is no position request outside of the line protocol ("M114" is a numbered line with an ack and reports the position at the end
+#    of the planner): the answers to the "M114" sent by the feeder are used, the progress is approximate
+#  * the reported position is located on the cumulative length index of the drawing (see "PathIndex"), searching forward from the last match
+#    and not further than the last command sent
+#  * the executed length and the interpolated ball position (the length moves on at the speed measured between the last reports) are published
+#    at PUBLISH_RATE through the feeder handler ("on_device_position")
+
+PUBLISH_RATE = 10               # Hz
+MATCH_TOLERANCE = 0.5           # max distance between the reported position and the path to consider the device on a command [mm]
+MAX_SEARCH_COMMANDS = 2048      # max number of commands checked after the last match for every report
+SPEED_WEIGHT = 0.5              # weight of the new samples in the moving average of the speed
+
+_reports = metrics.counter("position_reports_total", "Positions reported by the device while tracking a drawing")
+_unmatched = metrics.counter("position_unmatched_total", "Reported positions farther than the tolerance from the path of the drawing")
+
+class PositionTracker():
+    def __init__(self, feeder):
+        self.feeder = feeder
+        self._condition = Condition()
+        self._is_running = False
+        self._th = None
+        self._poll_interval = 0
+        self._element = None
+        self._sent = 0                  # number of commands of the element sent to the device
+        self._reset()
+
+    def _reset(self):
+        self._index = None              # cumulative length index of the element (loaded when available)
+        self._command = 0               # command on which the device was located by the last report
+        self._length = 0                # executed length at the last report [mm]
+        self._report_time = None
+        self._speed = 0                 # [mm/s]
+        self._position = None           # last position reported (x, y)
+
+    # poll rate of the position [Hz], 0 to disable the tracking
+    def set_poll_rate(self, rate):
+        with self._condition:
+            self._poll_interval = 1/rate if rate > 0 else 0
+            self._condition.notify_all()
+
+    def is_enabled(self):
+        return self._poll_interval > 0
+
+    # starts tracking the given element. The element can provide a cumulative length index ("get_path_index") to map the positions on the drawing
+    def start(self, element):
+        self.stop()
+        if not self.is_enabled():
+            return
+        with self._condition:
+            self._reset()
+            self._element = element
+            self._sent = 0
+            self._is_running = True
+        self._th = Thread(target=self._thf, daemon=True)
+        self._th.name = "position_tracker"
+        self._th.start()
+
+    def stop(self):
+        with self._condition:
+            if not self._is_running:
+                return
+            self._is_running = False
+            self._condition.notify_all()
+        self._th.join()
+
+    # the commands of the element before "count" have been sent to the device (the device cannot be beyond them)
+    def on_commands_sent(self, count):
+        self._sent = count
+
+    # position reported by the device
+    def on_position(self, x, y):
+        now = time.time()
+        with self._condition:
+            if not self._is_running:
+                return
+            _reports.inc()
+            self._position = (x, y)
+            if self._index is None:
+                get_index = getattr(self._element, "get_path_index", None)
+                self._index = get_index() if not get_index is None else None
+                if self._index is None:
+                    return
+            res = self._index.locate(x, y, self._command, min(self._sent, self._command + MAX_SEARCH_COMMANDS), MATCH_TOLERANCE)
+            if res is None:
+                return
+            command, length = res
+            _, px, py = self._index.position_at(length)
+            if math.hypot(px - x, py - y) > MATCH_TOLERANCE:
+                _unmatched.inc()                    # not on the path (yet): the position of the last match is kept
+                return
+            length = max(length, self._length)      # the device moves only forward along the path
+            if not self._report_time is None and now > self._report_time:
+                speed = (length - self._length)/(now - self._report_time)
+                self._speed = SPEED_WEIGHT*speed + (1 - SPEED_WEIGHT)*self._speed
+            self._command, self._length, self._report_time = command, length, now
+
+    # returns the executed length, the interpolated ball position and the total length of the path (None if the index is not available)
+    def get_state(self):
+        with self._condition:
+            if self._index is None:
+                if self._position is None:
+                    return None
+                return {"x": self._position[0], "y": self._position[1], "length": None, "total_length": None}
+            length = self._length
+            if not self._report_time is None:
+                # the ball keeps moving between the reports (at most until the next report and not beyond the commands sent)
+                elapsed = min(time.time() - self._report_time, self._poll_interval)
+                length = min(length + self._speed*elapsed, self._index.get_length(self._sent))
+                length = max(length, self._length)
+            _, x, y = self._index.position_at(length)
+            return {"x": x, "y": y, "length": length, "total_length": self._index.get_total_length()}
+
+    def _thf(self):
+        next_poll = 0
+        while True:
+            with self._condition:
+                if not self._is_running:
+                    return
+            now = time.time()
+            if now >= next_poll and self.is_enabled() and firmware.is_grbl(self.feeder._firmware):
+                next_poll = now + self._poll_interval
+                try:
+                    self.feeder._send_realtime(firmware.GRBL.buffer_command)
+                except Exception as e:
+                    self.feeder.logger.exception(e)
+            state = self.get_state()
+            if not state is None:
+                if not state["length"] is None:
+                    self._element.set_executed_length(state["length"])
+                self.feeder.handler.on_device_position(state)
+            with self._condition:
+                self._condition.wait_for(lambda: not self._is_running, timeout=1/PUBLISH_RATE)
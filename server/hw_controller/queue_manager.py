@@ -5,7 +5,9 @@ import time
 import random
 
 from server.utils import settings_utils
-from server.database.playlist_elements import ShuffleElement, TimeElement
+from server.database.playlist_elements import ShuffleElement, TimeElement, DrawingElement
+from server.database.models import UploadedFiles
+from server.utils.drawing_checkpoint import DrawingCheckpoint
 
 TIME_CONVERSION_FACTOR = 60*60      # hours to seconds
 
@@ -274,6 +276,22 @@ class QueueManager():
             except Exception as e:
                 self.app.logger.exception(e)
 
+    # resumes the drawing that was running when the device was turned off (can be disabled in the settings page)
+    def check_resume(self):
+        if self.is_drawing() or not settings_utils.get_only_values(settings_utils.load_settings()["autostart"])["resume_drawing"]:
+            return False
+        checkpoint = DrawingCheckpoint().load()
+        if checkpoint is None:
+            return False
+        if UploadedFiles.get_drawing(checkpoint.drawing_id) is None:
+            self.app.logger.warning("Cannot resume drawing {}: the drawing is not available anymore".format(checkpoint.drawing_id))
+            return False
+        self.app.logger.info("Resuming drawing {}".format(checkpoint.drawing_id))
+        element = DrawingElement(drawing_id=checkpoint.drawing_id)
+        element.set_resume_point(checkpoint)
+        self.start_element(element)
+        return True
+
     # periodically updates the queue status, used by the thread
     def _thf(self):
         while(True):
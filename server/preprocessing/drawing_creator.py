@@ -3,6 +3,10 @@ from server import app, db
 from server.database.models import IdsSequences, UploadedFiles
 from werkzeug.utils import secure_filename
 from server.utils.gcode_converter import ImageFactory
+from server.utils.gcode_sidecar import build_sidecar, open_sidecar, load_transformed_path, get_drawing_fit_dimensions
+from server.utils.path_simplification import get_tolerance, get_arc_tolerance
+from server.utils.feedrate_planner import get_planner_limits
+from server.hw_controller.gcode_rescalers import Fit
 
 import traceback
 import json
@@ -55,6 +59,20 @@ def preprocess_drawing(filename, file):
         shutil.copy2(app.config["UPLOAD_FOLDER"]+"/placeholder.jpg", os.path.join(folder, str(new_file.id)+".jpg"))
         # TODO create a better placeholder? or add a routine to fix missing images?
 
+    # create the precompiled version of the drawing used during the playback (if it fails the .gcode file will be used)
+    # the drawing is also transformed for the table (simplified, fitted with arcs and with the feedrate planned if enabled) so that it is ready to be played
+    # together with the cumulative length and estimated time of the path used for the progress and the ETA (see "PathIndex")
+    try:
+        gcode_path = os.path.join(folder, str(new_file.id)+".gcode")
+        if not build_sidecar(gcode_path) is None:
+            device = settings_utils.get_only_values(settings["device"])
+            with open_sidecar(gcode_path) as sidecar:
+                fit = Fit(get_drawing_fit_dimensions(sidecar, device))
+                load_transformed_path(gcode_path, sidecar, fit, get_tolerance(device), get_arc_tolerance(device), get_planner_limits(device), app.logger)
+    except:
+        app.logger.error("Error during the drawing precompilation")
+        app.logger.error(traceback.print_exc())
+
     app.logger.info("File added")
 
     return new_file.id
\ No newline at end of file
@@ -1,6 +1,10 @@
 from server import app
 from server.utils import settings_utils
 from server.utils.gcode_converter import ImageFactory
+from server.utils.gcode_sidecar import build_sidecar, open_sidecar, load_transformed_path, get_drawing_fit_dimensions
+from server.utils.path_simplification import get_tolerance, get_arc_tolerance
+from server.utils.feedrate_planner import get_planner_limits
+from server.hw_controller.gcode_rescalers import Fit
 import os
 
 def regenerate_all():
@@ -31,6 +35,15 @@ def regenerate_all():
                         count += 1
                 except Exception as e:
                     print(f"Failed to regenerate {drawing_id}: {e}")
+                # precompiled drawing, transformed path and length/time index (back-filled for the drawings uploaded before they existed)
+                try:
+                    if not build_sidecar(gcode_path) is None:
+                        with open_sidecar(gcode_path) as sidecar:
+                            fit = Fit(get_drawing_fit_dimensions(sidecar, device_settings))
+                            path = load_transformed_path(gcode_path, sidecar, fit, get_tolerance(device_settings), get_arc_tolerance(device_settings), get_planner_limits(device_settings))
+                            print(f"Estimated time for {drawing_id}: {path.index.get_total_time():.0f} s")
+                except Exception as e:
+                    print(f"Failed to precompile {drawing_id}: {e}")
 
     print(f"Done. Regenerated {count} thumbnails.")
 
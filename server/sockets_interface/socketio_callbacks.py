@@ -131,15 +131,27 @@ def live_mode_start():
     if app.feeder.is_running():
         app.qmanager.stop()
     app.qmanager.pause()
+    app.feeder.jog.start()
     app.semits.show_toast_on_UI("Live mode activated — queue paused")
     app.logger.info("Live mode started")
 
 @socketio.on("live_mode_stop")
 def live_mode_stop():
     """Exit live mode. Queue remains paused for manual restart."""
+    app.feeder.jog.stop()
     app.semits.show_toast_on_UI("Live mode off — resume queue manually")
     app.logger.info("Live mode stopped")
 
+@socketio.on("live_jog")
+def live_jog(x, y, feedrate):
+    """New target of the live mode [mm, mm/min]: the points are coalesced and streamed as jog moves."""
+    app.feeder.jog.move_to(x, y, feedrate)
+
+@socketio.on("live_jog_cancel")
+def live_jog_cancel():
+    """Stop the live mode motion where it is (grbl only)."""
+    app.feeder.jog.cancel()
+
 @socketio.on("set_max_drawing_feedrate")
 def set_max_drawing_feedrate(value):
     """Set the maximum feedrate for drawings (mm/min). 0 = no limit."""
@@ -150,6 +162,15 @@ def set_max_drawing_feedrate(value):
     except Exception as e:
         app.logger.error(f"Error setting max drawing feedrate: {e}")
 
+@socketio.on("set_feed_override")
+def set_feed_override(value):
+    """Set the speed of the device as a percentage of the programmed feedrate (applied immediately, the lines are not changed)."""
+    try:
+        app.feeder.set_feed_override(int(value))
+        app.qmanager.send_queue_status()
+    except Exception as e:
+        app.logger.error(f"Error setting the feed override: {e}")
+
 @socketio.on("settings_shutdown_system")
 def settings_shutdown_system():
     app.semits.show_toast_on_UI("Shutting down the device")
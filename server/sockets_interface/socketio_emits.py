@@ -1,3 +1,6 @@
+from server.utils.metrics import metrics
+
+_socket_emit_time = metrics.histogram("socket_emit_seconds", "Time spent emitting the socketio messages")
 
 class SocketioEmits():
     def __init__(self, app, socketio, db):
@@ -19,9 +22,14 @@ class SocketioEmits():
     def update_hw_preview(self, line):
         self.emit("preview_new_position", line)
 
+    # sends the position executed by the device and the progress along the drawing (see "PositionTracker")
+    def update_hw_executed_position(self, position):
+        self.emit("preview_executed_position", position)
+
     # general emit
     def emit(self, topic, line):
-        self.socketio.emit(topic, line)
+        with _socket_emit_time.time():
+            self.socketio.emit(topic, line)
 
     # emit GRBL alarm notification
     def grbl_alarm(self, code, description):
@@ -0,0 +1,80 @@
+import os
+import tty
+import time
+from threading import Thread
+
+import server.hw_controller.device_serial as device_serial
+from server.hw_controller.device_serial import DeviceSerial
+from server.hw_controller.emulator import Emulator
+
+# uses a pty pair as a fake serial device: the master side is used as the controller
+
+def open_pty_device():
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    device = DeviceSerial(os.ttyname(slave), 115200)
+    return master, device
+
+def wait_for(condition, timeout=2):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+def test_reader_returns_only_complete_lines():
+    master, device = open_pty_device()
+    lines = []
+    device.set_onreadline_callback(lines.append)
+    device.start_reading()
+    os.write(master, b"ok\nok\npar")
+    assert wait_for(lambda: len(lines) == 2)
+    time.sleep(0.1)
+    assert lines == ["ok\n", "ok\n"]
+    os.write(master, b"tial\n")
+    assert wait_for(lambda: len(lines) == 3)
+    assert lines[2] == "partial\n"
+    device.close()
+    os.close(master)
+
+def test_emulator_readline_waits_for_answers():
+    emulator = Emulator()
+    emulator.readline()                                     # ready message
+    start = time.time()
+    assert emulator.readline(timeout=0.2) is None
+    assert time.time() - start >= 0.2
+    emulator.send("M114\n")
+    assert not emulator.readline(timeout=0.2) is None
+
+def test_writer_sends_queued_lines_in_order():
+    master, device = open_pty_device()
+    lines = ["G1 X{} Y{}\n".format(i, i) for i in range(100)]
+    for l in lines:
+        device.send(l)
+    assert device.drain(timeout=2)
+    received = b""
+    while len(received) < len("".join(lines)):
+        received += os.read(master, 4096)
+    assert received.decode() == "".join(lines)
+    device.close()
+    os.close(master)
+
+def test_full_write_queue_does_not_drop_lines(monkeypatch):
+    monkeypatch.setattr(device_serial, "WRITE_TIMEOUT", 0.05)
+    master, device = open_pty_device()
+    lines = ["G1 X{} Y{}\n".format(i, i) for i in range(device_serial.WRITE_QUEUE_SIZE*2)]
+    with device._mutex:                                     # the write thread is blocked: the queue fills up
+        th = Thread(target=lambda: [device.send(l) for l in lines], daemon=True)
+        th.start()
+        assert wait_for(lambda: device._write_queue.full())
+        time.sleep(0.2)
+        assert th.is_alive()                                # "send" waits instead of dropping the line
+    th.join(timeout=2)
+    device.send_realtime("?")                               # realtime commands are written without waiting for the queue
+    assert device.drain(timeout=2)
+    received = b""
+    while len(received) < len("".join(lines)) + 1:
+        received += os.read(master, 4096)
+    assert received.replace(b"?", b"").decode() == "".join(lines) and b"?" in received
+    device.close()
+    os.close(master)
@@ -0,0 +1,432 @@
+from threading import Thread
+import os
+import time
+
+import pytest
+
+import server.hw_controller.feeder as feeder_module
+from server.hw_controller.feeder import Feeder, FeederEventHandler
+from server.hw_controller.device_serial import DeviceSerial
+from server.hw_controller.emulator import Emulator, EmulatorClock, GRBL_MODEL
+from server.hw_controller.grbl_model import VERSION_MESSAGE
+from server.hw_controller.line_encoder import LineEncoder, checksum, get_decimals
+from server.hw_controller.jog_streamer import JOG_MAX_IN_FLIGHT
+import server.hw_controller.firmware_defaults as firmware
+from server.utils import settings_utils
+from server.utils.gcode_tokenizer import tokenize
+from server.database.playlist_elements import CommandElement, TimeElement, DrawingElement
+from server.utils.gcode_sidecar import TransformedPath
+from server.utils.path_index import PathIndex
+from server.utils.drawing_checkpoint import DrawingCheckpoint
+
+# the feeder is tested with a fake serial device that keeps track of the lines sent
+# the device answers are simulated calling the parser directly
+
+class SerialStub():
+    is_fake = True
+
+    def __init__(self):
+        self.lines = []
+        self.drained = True                 # all the lines sent have been written to the device
+
+    def send(self, line):
+        self.lines.append(line)
+
+    def send_realtime(self, command):
+        self.lines.append(command)
+
+    def drain(self):
+        return self.drained
+
+    def close(self):
+        pass
+
+    def is_connected(self):
+        return False
+
+    def get_emulated_time(self):
+        return None
+
+def grbl_feeder(firmware_name=firmware.GRBL.name):
+    settings = settings_utils.load_settings()
+    settings["device"]["firmware"]["value"] = firmware_name
+    feeder = Feeder()
+    feeder.update_settings(settings)
+    feeder.serial = SerialStub()
+    return feeder
+
+def wait_for(condition, timeout=1):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+# the acks received when there are no lines in flight are ignored: waits for the sender before acking the next line
+def ack_in_flight_line(feeder):
+    assert wait_for(lambda: len(feeder.command_buffer) > 0)
+    feeder._parse_device_line("ok")
+
+def send_in_thread(feeder, commands):
+    th = Thread(target=lambda: [feeder.send_gcode_command(c, hide_command=True) for c in commands], daemon=True)
+    th.start()
+    return th
+
+
+COMMAND = "G1 X100.000 Y100.000"    # 21 bytes with the newline
+
+def test_character_counting_fills_rx_buffer():
+    feeder = grbl_feeder()
+    th = send_in_thread(feeder, [COMMAND]*10)
+    lines_in_buffer = firmware.GRBL.rx_buffer_size // (len(COMMAND)+1)
+    assert wait_for(lambda: len(feeder.serial.lines) == lines_in_buffer)
+    time.sleep(0.1)
+    assert len(feeder.serial.lines) == lines_in_buffer                  # the next line does not fit in the RX buffer
+    feeder._parse_device_line("ok")
+    assert wait_for(lambda: len(feeder.serial.lines) == lines_in_buffer + 1)
+    for i in range(9):
+        ack_in_flight_line(feeder)
+    th.join(timeout=1)
+    assert len(feeder.serial.lines) == 10
+    assert feeder._rx_buffer_bytes == 0
+
+def test_character_counting_errors_free_the_buffer():
+    feeder = grbl_feeder()
+    th = send_in_thread(feeder, [COMMAND]*7)
+    assert wait_for(lambda: len(feeder.serial.lines) == 6)
+    feeder._parse_device_line("error:20")
+    th.join(timeout=1)
+    assert len(feeder.serial.lines) == 7
+
+def test_character_counting_ignores_realtime_commands():
+    feeder = grbl_feeder()
+    feeder.send_gcode_command(COMMAND, hide_command=True)
+    feeder.send_gcode_command(firmware.GRBL.buffer_command, hide_command=True)
+    assert feeder._rx_buffer_bytes == len(COMMAND) + 1
+    assert len(feeder.command_buffer) == 1
+
+def test_character_counting_recovers_lost_acks():
+    feeder = grbl_feeder()
+    feeder.send_gcode_command(COMMAND, hide_command=True)
+    # the report is not valid if a line is sent after the status request
+    feeder._status_request_mark = -1
+    feeder._parse_device_line("<Idle|MPos:0.000,0.000,0.000|Bf:15,128|FS:0,0>")
+    assert feeder._rx_buffer_bytes == len(COMMAND) + 1
+    # the lines still in the write queue may reach the device after the report
+    feeder.serial.drained = False
+    feeder.send_gcode_command(firmware.GRBL.buffer_command, hide_command=True)
+    feeder._parse_device_line("<Idle|MPos:0.000,0.000,0.000|Bf:15,128|FS:0,0>")
+    assert feeder._rx_buffer_bytes == len(COMMAND) + 1
+    feeder.serial.drained = True
+    depth = feeder._depth.depth
+    feeder.send_gcode_command(firmware.GRBL.buffer_command, hide_command=True)
+    feeder._parse_device_line("<Run|MPos:0.000,0.000,0.000|Bf:10,128|FS:0,0>")      # long move: the acks are late, not lost
+    assert feeder._depth.depth == depth
+    feeder._parse_device_line("<Idle|MPos:0.000,0.000,0.000|Bf:15,128|FS:0,0>")
+    assert feeder._rx_buffer_bytes == 0
+    assert feeder._depth.depth < depth
+
+def test_parsed_moves_are_clamped():
+    feeder = grbl_feeder()
+    feeder._is_running = True
+    feeder.max_drawing_feedrate = 1000
+    feeder.send_gcode_command(tokenize("G1 X10 Y20 F3000"), hide_command=True)
+    feeder.send_gcode_command(tokenize("G1 X15"), hide_command=True)
+    assert [l.strip() for l in feeder.serial.lines] == ["G1 X10 Y20 F1000", "G1 X15"]
+    assert (feeder.last_commanded_position.x, feeder.last_commanded_position.y) == (15, 20)
+    assert feeder.feedrate == 1000
+
+def test_text_commands_are_clamped():
+    feeder = grbl_feeder()
+    feeder._is_running = True
+    feeder.max_drawing_feedrate = 1000
+    feeder.send_gcode_command("G1X-5Y-7.5F3000", hide_command=True)     # compact line with negative values
+    assert feeder.serial.lines[-1].strip() == "G1 X-5 Y-7.5 F1000"
+    assert (feeder.last_commanded_position.x, feeder.last_commanded_position.y) == (-5, -7.5)
+
+def test_lines_with_several_commands_are_clamped():
+    assert tokenize("G90 G1 X10 F5000").command == "G1" and tokenize("G90G01X10").command == "G1"
+    feeder = grbl_feeder()
+    feeder._is_running = True
+    feeder.max_drawing_feedrate = 1000
+    feeder.send_gcode_command("G90 G1 X10 Y3 F5000", hide_command=True)
+    assert feeder.serial.lines[-1].strip() == "G90 G1 X10 Y3 F1000"
+    assert (feeder.last_commanded_position.x, feeder.last_commanded_position.y) == (10, 3)
+
+def test_emulator_negative_coordinates():
+    emulator = Emulator(EmulatorClock("instant"))
+    emulator.firmware = firmware.GRBL.name
+    emulator.send("G1 X-30 Y-40 F6000\n")
+    emulator.send("?")
+    assert "MPos:-30.000,-40.000" in [emulator.readline(1) for i in range(2)][-1]
+
+def test_fast_mode_encoder():
+    assert get_decimals(80) == 2 and get_decimals(100) == 2 and get_decimals(400) == 3
+    encoder = LineEncoder(decimals=2)
+    lines = [encoder.encode(c) for c in ("G1 X10.000 Y-0.001 F3000", "G1 X10.5 Y2 F3000", "G2 X1 Y1 I0.5 J0", "M114", "G1 X1 Y1")]
+    assert lines == [b"G1X10Y0F3000\n", b"X10.5Y2\n", b"G2X1Y1I0.5J0\n", b"M114\n", b"G1X1Y1\n"]
+    line = encoder.encode("G1 X2", n=12)
+    assert line == b"N12G1X2*%d\n" % checksum(b"N12G1X2")
+    assert checksum(b"N12X2") == ord("N") ^ ord("1") ^ ord("2") ^ ord("X") ^ ord("2")
+
+def test_fast_mode_marlin_lines():
+    feeder = grbl_feeder(firmware.MARLIN.name)
+    feeder.is_fast_mode = True
+    feeder.send_gcode_command("G1 X10.123456 Y5 F2000", hide_command=True)
+    feeder.send_gcode_command("G1 X11 Y5 F2000", hide_command=True)
+    first, second = feeder.serial.lines[-2:]
+    assert isinstance(second, bytes)
+    body = second.split(b"*")[0]
+    assert body.endswith(b"G1X11Y5") and second == body + b"*%d\n" % checksum(body)     # marlin needs the motion command on every line
+    assert feeder._resend_history.get(feeder.line_number) == second
+    feeder.send_gcode_command(tokenize("G1 X12 Y5"), hide_command=True)       # parsed moves are encoded without converting them to text
+    assert feeder.serial.lines[-1].split(b"*")[0].endswith(b"G1X12Y5")
+
+def test_marlin_resend():
+    feeder = grbl_feeder(firmware.MARLIN.name)
+    for i in range(5):
+        feeder.send_gcode_command("G1 X{}".format(i), hide_command=True)
+    numbers = [l.split(" ")[0] for l in feeder.serial.lines[-5:]]
+    feeder._parse_device_line("Resend: {}".format(numbers[2][1:]))
+    # the lines from the required one are resent with a single write
+    assert feeder.serial.lines[-1] == "".join(feeder.serial.lines[-4:-1]).encode()
+
+def test_pipeline_streams_element():
+    feeder = grbl_feeder()
+    feeder.max_drawing_feedrate = 1000
+    feeder.start_element(CommandElement("\n".join(["; comment", "G1 X1 Y1 F3000"] + [COMMAND]*20)))
+    sent = lambda: [l.strip() for l in feeder.serial.lines if l.startswith("G1")]
+    for i in range(21):
+        assert wait_for(lambda: len(sent()) > i)
+        feeder._parse_device_line("ok")
+    assert sent() == ["G1 X1 Y1 F1000"] + [COMMAND]*20
+    assert wait_for(lambda: not feeder.is_running(), timeout=5)
+    stats = feeder.get_pipeline_stats()
+    assert stats["producer"]["depth"] == 0
+    assert stats["sender"]["credit_waits"] > 0
+
+class ResumableElement(CommandElement):
+    drawing_id = 5
+
+    def execute(self, logger):
+        self._index = 0
+        for c in super().execute(logger):
+            self._index += 1
+            yield c
+
+    def get_cursor(self):
+        return self._index, 0
+
+def test_checkpoint_saves_acked_command(tmp_path, monkeypatch):
+    monkeypatch.setattr(feeder_module, "CHECKPOINT_INTERVAL", 0)
+    feeder = grbl_feeder()
+    feeder._checkpoint = DrawingCheckpoint(os.path.join(tmp_path, "checkpoint.bin"))
+    commands = ["G1 X{}.000 Y100.000".format(100 + i) for i in range(20)]       # same length of COMMAND
+    feeder.start_element(ResumableElement("\n".join(commands)))
+    lines_in_buffer = firmware.GRBL.rx_buffer_size // (len(COMMAND)+1)
+    assert wait_for(lambda: len(feeder.serial.lines) == lines_in_buffer)
+    assert feeder._checkpoint.load() is None                           # no ack received yet
+    feeder._parse_device_line("ok")
+    assert wait_for(lambda: not feeder._checkpoint.load() is None)
+    checkpoint = feeder._checkpoint.load()
+    assert (checkpoint.drawing_id, checkpoint.index, checkpoint.x) == (5, 1, 100)
+    for i in range(19):
+        ack_in_flight_line(feeder)
+    assert wait_for(lambda: not feeder.is_running(), timeout=5)
+    assert feeder._checkpoint.load() is None                           # the drawing is finished
+
+def emulated_grbl_feeder(clock=None, model=None):
+    feeder = grbl_feeder()
+    feeder.serial = DeviceSerial(logger_name=__name__, emulator_clock=clock, emulator_model=model)      # no port: uses the emulator
+    feeder.serial._emulator.firmware = firmware.GRBL.name
+    feeder.serial.set_onreadline_callback(feeder.on_serial_read)
+    feeder.serial.start_reading()
+    return feeder
+
+class StartTimesHandler(FeederEventHandler):
+    def __init__(self):
+        self.started = []
+
+    def on_element_started(self, element):
+        self.started.append(time.time())
+
+def test_stop_to_next_start_latency():
+    feeder = emulated_grbl_feeder()
+    handler = StartTimesHandler()
+    feeder.set_event_handler(handler)
+    feeder.start_element(CommandElement("\n".join([COMMAND]*1000)))
+    assert wait_for(lambda: len(feeder.command_buffer) > 3)
+    start_time = time.time()
+    feeder.start_element(CommandElement(COMMAND), force_stop=True)
+    latency = handler.started[-1] - start_time
+    assert latency < 0.5
+    assert wait_for(lambda: not feeder.is_running(), timeout=5)
+
+def test_stop_flushes_the_device_buffers():
+    feeder = emulated_grbl_feeder(model=GRBL_MODEL)
+    feeder.start_element(CommandElement("G1 X0 Y0 F600\n" + "\n".join("G1 X{} Y0".format(10*((i + 1) % 2)) for i in range(100))))
+    assert wait_for(lambda: feeder._rx_buffer_bytes > 100)
+    feeder.stop()
+    # the soft reset dropped the lines in the device: the accounting starts again from an empty buffer and no stale ack is received
+    model = feeder.serial._emulator.grbl
+    assert feeder._rx_buffer_bytes == 0 and model.rx_free() == firmware.GRBL.rx_buffer_size and model.is_idle()
+    feeder.start_element(CommandElement("\n".join(["G1 X5 Y5 F600"] + ["G1 X{} Y5".format(5 + i % 2) for i in range(20)])))
+    assert wait_for(lambda: not feeder.is_running(), timeout=10)
+    assert model.rx_overflows == 0
+
+def test_stop_without_feed_hold_confirmation(monkeypatch):
+    monkeypatch.setattr(feeder_module, "STOP_TIMEOUT", 0.2)
+    feeder = grbl_feeder()
+    feeder.start_element(CommandElement("\n".join("G1 X{} Y0".format(i) for i in range(20))))
+    assert wait_for(lambda: len(feeder.serial.lines) > 0)
+    feeder.stop()                                           # no status report: the device may still be moving
+    assert b"!" in feeder.serial.lines and not firmware.GRBL.soft_reset_command.encode() in feeder.serial.lines
+    assert not feeder.is_running() and feeder._rx_buffer_bytes == 0
+
+def test_error_stops_from_the_reader_thread():
+    feeder = grbl_feeder()
+    feeder.start_element(CommandElement("\n".join("G1 X{} Y0".format(i) for i in range(20))))
+    assert wait_for(lambda: len(feeder.serial.lines) > 0)
+    start = time.time()
+    feeder._parse_device_line("error:22")                   # returns at once: the stop waits for the status reports parsed by the reader
+    assert time.time() - start < 0.1
+    assert wait_for(lambda: b"!" in feeder.serial.lines)
+    feeder._parse_device_line("<Hold:0|MPos:0.000,0.000,0.000|Bf:15,0|FS:0,0>")
+    assert wait_for(lambda: firmware.GRBL.soft_reset_command.encode() in feeder.serial.lines)
+    feeder._parse_device_line(VERSION_MESSAGE)
+    assert wait_for(lambda: not feeder.is_running())
+
+def test_instant_emulator_reports_drawing_time():
+    feeder = emulated_grbl_feeder(EmulatorClock("instant"))
+    feeder.max_drawing_feedrate = 0
+    # 600 moves of 10 mm at 600 mm/min: 10 minutes on the device
+    commands = ["G1 X0 Y0 F600"] + ["G1 X{} Y0".format(10*((i + 1) % 2)) for i in range(600)]
+    start_time = time.time()
+    feeder.start_element(CommandElement("\n".join(commands)))
+    assert wait_for(lambda: not feeder.emulated_element_time is None, timeout=10)     # set when all the lines are acked
+    assert time.time() - start_time < 10
+    assert feeder.emulated_element_time == pytest.approx(600, rel=0.01)
+
+def test_pause_resume_and_stop_while_paused():
+    feeder = emulated_grbl_feeder(EmulatorClock("instant"))
+    feeder.max_drawing_feedrate = 0
+    feeder.start_element(CommandElement("\n".join(["G1 X{} Y0 F6000".format(i % 2) for i in range(5000)])))
+    assert wait_for(lambda: feeder._registered_lines > 10)
+    feeder.pause()
+    time.sleep(0.1)
+    sent = feeder._registered_lines
+    time.sleep(0.1)
+    assert feeder._registered_lines == sent                # no lines sent while paused
+    feeder.resume()
+    assert wait_for(lambda: feeder._registered_lines > sent)
+    feeder.pause()
+    start_time = time.time()
+    feeder.stop()                                           # the paused thread is woken up immediately
+    assert time.time() - start_time < 0.5
+    assert not feeder.is_running() and not feeder.is_paused()
+
+def test_timing_element_stops_immediately():
+    feeder = emulated_grbl_feeder(EmulatorClock("instant"))
+    feeder.start_element(TimeElement(delay=60, type="delay"))
+    assert wait_for(lambda: feeder.get_status()["progress"]["eta"] > 50)
+    start_time = time.time()
+    feeder.stop()
+    assert time.time() - start_time < 0.5
+
+def test_live_jog_coalesces_points():
+    feeder = grbl_feeder()
+    feeder.settings["device"]["planner_max_feedrate"]["value"] = 6000
+    feeder.jog.start()
+    for i in range(100):
+        feeder.jog.move_to(i*0.1, 0, 6000)                  # dragged faster than the device can move
+    assert wait_for(lambda: len(feeder.serial.lines) == JOG_MAX_IN_FLIGHT)
+    time.sleep(0.1)
+    assert len(feeder.serial.lines) == JOG_MAX_IN_FLIGHT   # no more lines until an ack is received
+    while not feeder.serial.lines[-1].endswith("X9.9 Y0 F6000\n"):
+        ack_in_flight_line(feeder)
+    # at most 4 mm per step (6000 mm/min for a period of 40 ms) toward the latest target: the points received meanwhile are skipped
+    assert all(l.startswith("$J=G90 G21 X") for l in feeder.serial.lines)
+    steps = [tokenize(l[3:]).x for l in feeder.serial.lines]
+    assert len(steps) <= 4
+    assert all(0 < b - a <= 4 + 1e-6 for a, b in zip([0] + steps, steps))
+    assert feeder.last_commanded_position.x == pytest.approx(9.9)
+    feeder.jog.stop()
+    assert feeder.serial.lines[-1] == b"\x85"              # sent as a single byte
+
+def test_live_jog_feedrate_limits():
+    feeder = grbl_feeder()
+    feeder.settings["device"]["planner_max_feedrate"]["value"] = 2000
+    feeder.jog.start()
+    feeder.jog.move_to(10, 0, 0)                            # not positive: ignored
+    time.sleep(0.1)
+    assert feeder.serial.lines == []
+    feeder.jog.move_to(10, 0, 9000)                         # limited to the max rate of the controller
+    assert wait_for(lambda: len(feeder.serial.lines) == 1)
+    assert feeder.serial.lines[0].endswith(" F2000\n")
+    feeder.jog.stop()
+
+def test_feed_override():
+    feeder = grbl_feeder()
+    assert feeder.set_feed_override(125) == 125
+    assert feeder.serial.lines == [b"\x91"]*2 + [b"\x93"]*5 + [b"?"]    # +10% and +1% realtime commands, then a status request
+    assert feeder.get_status()["feed_override"] == 125
+    feeder.serial.lines.clear()
+    with feeder.serial_mutex:                               # the sender may be waiting for space in the RX buffer: the override does not wait for it
+        th = Thread(target=feeder.set_feed_override, args=(100,), daemon=True)
+        th.start()
+        th.join(timeout=1)
+        assert not th.is_alive()
+    assert feeder.serial.lines == [b"\x90", b"?"]
+    assert feeder.set_feed_override(500) == firmware.FEED_OVERRIDE_MAX
+    feeder._parse_device_line("<Run|MPos:1.000,2.000,0.000|Bf:10,100|Ov:90,100,100>")
+    assert feeder.feed_override == 90                       # tracked from the status reports
+    # marlin: "M220" command
+    feeder = grbl_feeder(firmware.MARLIN.name)
+    th = Thread(target=feeder.set_feed_override, args=(50,), daemon=True)
+    th.start()
+    th.join(timeout=1)
+    assert "M220 S50" in feeder.serial.lines[-1]
+    feeder._parse_device_line("FR:60%")
+    assert feeder.feed_override == 60
+
+class TrackedElement(DrawingElement):
+    def __init__(self, x, y):
+        super().__init__(drawing_id=5)
+        self._path = TransformedPath(x, y)
+
+    def execute(self, logger):
+        self._path_index = PathIndex.from_path(self._path)
+        self._total_distance = self._path_index.get_total_length()
+        for x, y in zip(self._path.x, self._path.y):
+            self._index += 1
+            yield "G1 X{} Y{}".format(x, y)
+
+class PositionsHandler(FeederEventHandler):
+    def __init__(self):
+        self.positions = []
+
+    def on_device_position(self, position):
+        self.positions.append(position)
+
+def test_executed_position_tracking():
+    feeder = grbl_feeder()
+    feeder.tracker.set_poll_rate(20)
+    feeder.handler = PositionsHandler()
+    element = TrackedElement([0, 100, 100, 0], [0, 0, 100, 100])
+    feeder.start_element(element)
+    assert wait_for(lambda: len(feeder.command_buffer) == 4)
+    assert wait_for(lambda: b"?" in feeder.serial.lines)       # realtime status request, outside of the RX buffer accounting
+    assert len(feeder.command_buffer) == 4
+    # all the lines have been sent but the device is still on the second one
+    feeder._parse_device_line("<Run|MPos:100.000,40.000,0.000|Bf:10,100>")
+    assert wait_for(lambda: len(feeder.handler.positions) > 0 and feeder.handler.positions[-1]["length"] >= 140)
+    assert element.get_progress(0)["eta"] == pytest.approx(140/300*100, abs=1)
+    # positions out of the path and behind the last one are ignored
+    feeder._parse_device_line("<Run|MPos:50.000,50.000,0.000|Bf:10,100>")
+    feeder._parse_device_line("<Run|MPos:50.000,0.000,0.000|Bf:10,100>")
+    assert feeder.tracker.get_state()["length"] >= 140
+    position = feeder.handler.positions[-1]
+    assert position["x"] == pytest.approx(100) and position["total_length"] == pytest.approx(300)
+    for i in range(4):
+        ack_in_flight_line(feeder)
+    assert wait_for(lambda: not feeder.is_running(), timeout=5)
+    assert wait_for(lambda: not feeder.tracker._is_running)    # stopped at the end of "stop()", after the running flag is cleared
@@ -0,0 +1,61 @@
+import os
+import math
+
+from server.utils import feedrate_planner
+from server.utils.feedrate_planner import plan_feedrates, get_planner_limits, FEEDRATE_STEP
+from server.utils.gcode_sidecar import build_sidecar, open_sidecar, load_transformed_path
+from server.hw_controller.gcode_rescalers import Fit
+from server.tests.test_feeder import grbl_feeder
+
+def test_planner_turns_and_straights():
+    # long straight line, tight turn, long straight line with dense points
+    xs = [0, 200, 200] + [200 - k for k in range(1, 201)]
+    ys = [0, 0, 1] + [1]*200
+    plannable = bytes([1])*len(xs)
+    feedrates = plan_feedrates(xs, ys, None, {}, plannable, 100, 6000)
+    assert math.isnan(feedrates[0])
+    assert feedrates[1] == 6000                         # reaches the max feedrate on the long straight line
+    assert feedrates[2] < 1000                          # almost a U-turn
+    assert feedrates[100] == 6000
+    assert feedrates[2] < feedrates[4] < feedrates[100]     # accelerates after the turn
+    assert feedrates[-1] < feedrates[-20]               # slows down before the end
+    assert all(f % FEEDRATE_STEP == 0 for f in feedrates[1:])
+    # the path stops before the points that cannot be planned
+    plannable = bytearray(plannable)
+    plannable[100] = 0
+    feedrates = plan_feedrates(xs, ys, None, {}, plannable, 100, 6000)
+    assert math.isnan(feedrates[100]) and feedrates[99] < feedrates[90]
+
+def test_planner_arcs():
+    # half circle with a 10 mm radius: the centripetal acceleration limits the speed
+    feedrates = plan_feedrates([0, 10, -10, -10], [-10, -10, -10, -100], None, {2: (0, 10, False)}, bytes([1])*4, 100, 6000)
+    assert feedrates[2] <= math.sqrt(100*10)*60
+
+def test_planner_limits():
+    device = {"feedrate_planner": True, "planner_acceleration": 0, "planner_max_feedrate": 4000}
+    assert get_planner_limits(device, {"120": 50, "121": 30}) == (30, 4000)
+    assert get_planner_limits(device, {}) == (feedrate_planner.DEFAULT_ACCELERATION, 4000)
+    assert get_planner_limits({"feedrate_planner": False}) is None
+
+def test_grbl_settings_are_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(feedrate_planner, "CONTROLLER_LIMITS_PATH", os.path.join(tmp_path, "limits.json"))
+    feeder = grbl_feeder()
+    feeder._parse_device_line("$110=5000.000")
+    feeder._parse_device_line("$120=25.000")
+    feeder._parse_device_line("$1=25")
+    assert feedrate_planner.load_controller_limits() == {"110": 5000, "120": 25}
+
+def test_planned_drawing(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G0 X0 Y0\nG1 X0.5 Y0 F1000\nG1 X0.5 Y0.5\nG1 X0.5 Y0.6\nG1 X0.5 Y0.7\nG1 X0 Y0\n")
+    build_sidecar(gcode_path)
+    fit = Fit({"table_x": 100, "table_y": 100, "drawing_min_x": 0, "drawing_max_x": 1, "drawing_min_y": 0, "drawing_max_y": 1})
+    with open_sidecar(gcode_path) as sidecar:
+        path = load_transformed_path(gcode_path, sidecar, fit, planner_limits=(100, 3000))
+        assert load_transformed_path(gcode_path, sidecar, fit, planner_limits=(100, 3000)).feedrates.tobytes() == path.feedrates.tobytes()
+        commands = [c for _, _, c in sidecar.iterate(path, fit)]
+    assert commands[0].f is None                        # rapid move
+    assert commands[1].f == path.feedrates[1] != 1000   # the feedrate of the drawing is replaced
+    # the feedrate is sent only when it changes
+    assert commands[3].f is None and path.feedrates[3] == path.feedrates[2]
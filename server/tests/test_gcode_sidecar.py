@@ -0,0 +1,284 @@
+import os
+import io
+import math
+from array import array
+
+import pytest
+
+from server.utils.gcode_tokenizer import tokenize, tokenize_all, format_number
+from server.utils.gcode_sidecar import build_sidecar, open_sidecar, load_transformed_path, TransformedPath
+from server.utils.path_index import PathIndex
+from server.utils.drawing_checkpoint import get_path_hash
+from server.database.playlist_elements import DrawingElement
+from server.utils.path_simplification import simplify, simplify_path, get_tolerance, MAX_SECTION_LENGTH
+from server.utils.arc_fitting import fit_arcs, arc_length, interpolate_arc
+from server.utils.gcode_converter import ImageFactory
+from server.hw_controller.gcode_rescalers import Fit
+
+DRAWING = """; TYPE: PRE-TRANSFORMED
+; comment
+G28
+G0 X-10.5 Y20
+G1 X30 F2000 ; inline comment
+Y-5.25
+G2 X10 Y10 I5 J5
+$H
+G01 X1 Y2
+"""
+
+def test_tokenizer():
+    c = tokenize("g01 x-1.5 y.25 f3000 ; comment")
+    assert (c.command, c.x, c.y, c.f) == ("G1", -1.5, 0.25, 3000)
+    assert c.is_move()
+    assert tokenize("; only comment") is None
+    assert not tokenize("G1 X10 Z5").is_move()
+    assert not tokenize("G1 X&x+1& Y10").is_move()
+    assert str(tokenize("G1 X10").with_feedrate(1000)) == "G1 X10 F1000"
+    assert str(tokenize("G2 X10 I1 F5000").with_feedrate(1000)) == "G2 X10 I1 F1000"
+    assert str(tokenize("G2 X10 I1 Z5").with_position(1, 2, 3, 4, "G3")) == "G3 X1 I3 Z5 Y2 J4"
+    # compact lines are parsed as the ones with spaces
+    c = tokenize("G1X-10Y.5F600")
+    assert (c.command, c.x, c.y, c.f, c.extra) == ("G1", -10, 0.5, 600, False)
+    assert tokenize("G28.1").command == "G28.1"
+    assert tokenize("$H").extra and tokenize("G1 X1E5").extra
+
+def test_tokenize_all():
+    parsed = tokenize_all(DRAWING.splitlines())
+    assert parsed.commands[:3] == ["G28", "G0", "G1"]
+    assert list(parsed.x[1:3]) == [-10.5, 30]
+    assert parsed.y[2] != parsed.y[2]                       # missing values are nan
+    assert parsed.line_numbers[0] == 2                      # the comments are skipped
+    assert str(parsed.get_command(2)) == "G1 X30 F2000"
+
+def test_sidecar_round_trip(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write(DRAWING)
+    build_sidecar(gcode_path)
+    with open_sidecar(gcode_path) as sidecar:
+        assert sidecar.is_pre_transformed()
+        records = [(x, y, str(c)) for x, y, c in sidecar]
+    assert records == [
+        (0, 0, "G28"),
+        (-10.5, 20, "G0 X-10.5 Y20"),
+        (30, 20, "G1 X30 F2000"),
+        (30, -5.25, "G1 Y-5.25"),
+        (10, 10, "G2 X10 Y10 I5 J5"),
+        (10, 10, "$H"),
+        (1, 2, "G1 X1 Y2"),
+    ]
+
+def test_stale_or_relative_sidecar(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write(DRAWING)
+    build_sidecar(gcode_path)
+    with open(gcode_path, "a") as f:
+        f.write("G1 X5\n")
+    assert open_sidecar(gcode_path) is None             # the gcode file changed after the sidecar creation
+    with open(gcode_path, "w") as f:
+        f.write("G91\nG1 X10\n")
+    assert build_sidecar(gcode_path) is None
+
+DIMENSIONS = {"table_x": 500, "table_y": 300, "drawing_min_x": 0, "drawing_max_x": 1, "drawing_min_y": 0, "drawing_max_y": 1,
+              "offset_x": 10, "offset_y": 20, "orientation_origin": "Top-Right", "orientation_swap": True}
+
+def test_fit_transform_arrays():
+    fit = Fit(DIMENSIONS)
+    xs, ys = [0, 0.25, 1], [0, 0.5, 0.75]
+    tx, ty = fit.transform_arrays(xs, ys)
+    for x, y, x1, y1 in zip(xs, ys, tx, ty):
+        assert (x1, y1) == pytest.approx(fit.transform_point(x, y))
+    # mirrored drawing with the same scale on both the axes: the arcs direction changes
+    square = Fit(dict(DIMENSIONS, table_y=500))
+    assert square.keeps_arcs()
+    arc, = square.transform_command(tokenize("G2 X1 Y0.5 I0.5 J0"), *square.transform_point(1, 0.5), start=(0, 0.5))
+    assert arc.command == "G3"
+    assert (arc.i, arc.j) == pytest.approx((0, -250))
+    # different scales: the arc would be an ellipse and is interpolated with segments
+    assert not fit.keeps_arcs()
+    segments = fit.transform_command(tokenize("G2 X1 Y0.5 I0.5 J0 F2000"), *fit.transform_point(1, 0.5), start=(0, 0.5))
+    points = interpolate_arc(0, 0.5, 1, 0.5, 0.5, 0, True)
+    assert len(segments) == len(points) > 2
+    assert all(c.command == "G1" for c in segments) and segments[0].f == 2000 and segments[1].f is None
+    for c, (x, y) in zip(segments, points):
+        assert (c.x, c.y) == pytest.approx(fit.transform_point(x, y))
+
+def test_transformed_path_cache(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G1 X0 Y0\nG1 X0.5 Y1\nG1 X1 Y0.5\n")
+    build_sidecar(gcode_path)
+    fit = Fit(DIMENSIONS)
+    with open_sidecar(gcode_path) as sidecar:
+        assert sidecar.bounds == [0, 1, 0, 1]
+        path = load_transformed_path(gcode_path, sidecar, fit)
+        xs, ys = path.x, path.y
+        assert os.path.isfile(os.path.join(tmp_path, "1_{}.xy".format(fit.get_hash())))
+        cached = load_transformed_path(gcode_path, sidecar, fit)
+        assert (cached.x, cached.y, cached.indices, cached.arcs) == (xs, ys, None, {})
+        commands = [str(c) for _, _, c in sidecar.iterate(path, fit)]
+    assert commands[1] == "G1 X{} Y{}".format(format_number(xs[1]), format_number(ys[1]))
+    assert (xs[1], ys[1]) == pytest.approx(fit.transform_point(0.5, 1))
+
+def test_simplification():
+    # straight line with a small noise and a corner
+    n = 3000
+    xs = [i/n*100 for i in range(n)] + [100]*10
+    ys = [(i % 2)*0.01 for i in range(n)] + [k*10 for k in range(1, 11)]
+    fixed = [False]*len(xs)
+    fixed[n//2] = True
+    indices, report = simplify_path(xs, ys, [float("nan")]*len(xs), 0.1, fixed)
+    assert len(indices) == 4 and (indices[0], indices[1], indices[3]) == (0, n//2, len(xs)-1)
+    assert indices[2] >= n-2                            # the corner
+    assert (report["points_in"], report["points_out"]) == (len(xs), 4)
+    assert report["estimated_time_saved"] > 0
+    # long drawings: no recursion limit, at least a point every MAX_SECTION_LENGTH points
+    n = 1000000
+    indices = simplify(array("d", [i/n*500 for i in range(n)]), array("d", [(i % 2)*0.01 for i in range(n)]), 0.1)
+    assert len(indices) == math.ceil((n-1)/MAX_SECTION_LENGTH) + 1
+    assert get_tolerance({"path_simplification": True, "simplification_tolerance": 0, "ball_diameter": 10}) == 0.5
+
+def test_simplified_transformed_path(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G0 X0 Y0\nG1 X0.1 Y0.1\nG1 X0.2 Y0.2 F1000\nG1 X0.3 Y0.3\nG1 X0.4 Y0.4\nG1 X0.5 Y0.1\n")
+    build_sidecar(gcode_path)
+    fit = Fit(DIMENSIONS)
+    with open_sidecar(gcode_path) as sidecar:
+        path = load_transformed_path(gcode_path, sidecar, fit, tolerance=1)
+        assert list(path.indices) == [0, 2, 4, 5]     # the feedrate change is kept
+        assert load_transformed_path(gcode_path, sidecar, fit, tolerance=1).indices == path.indices
+        assert len(list(sidecar.iterate(path, fit))) == 4
+
+def circle_points(cx, cy, r, n, start=0, sweep=2*math.pi):
+    return [(cx + r*math.cos(start + sweep*k/n), cy + r*math.sin(start + sweep*k/n)) for k in range(n + 1)]
+
+def test_arc_geometry():
+    # quarter circle counterclockwise from (10, 0) to (0, 10) around the origin
+    assert arc_length(10, 0, 0, 10, -10, 0, False) == pytest.approx(math.pi*5)
+    assert arc_length(10, 0, 0, 10, -10, 0, True) == pytest.approx(math.pi*15)
+    assert arc_length(10, 0, 10, 0, -10, 0, True) == pytest.approx(math.pi*20)      # full circle
+    points = interpolate_arc(10, 0, 0, 10, -10, 0, False)
+    assert points[-1] == (0, 10)
+    assert all(math.hypot(x, y) == pytest.approx(10) for x, y in points)
+
+def test_arc_fitting():
+    # half circle followed by a straight line
+    points = circle_points(50, 50, 20, 200, sweep=math.pi) + [(30 - k, 50) for k in range(1, 11)]
+    xs, ys = [p[0] for p in points], [p[1] for p in points]
+    keep, arcs = fit_arcs(xs, ys, None, bytes([1])*len(xs), 0.01)
+    assert len(arcs) == 1 and list(keep[:2]) == [0, 200]
+    i, j, clockwise = arcs[200]
+    assert (i, j, clockwise) == (pytest.approx(-20), pytest.approx(0, abs=1e-9), False)
+    assert list(keep[2:]) == list(range(201, len(xs)))
+    # the points that cannot be removed split the arcs
+    removable = bytearray([1])*len(xs)
+    removable[100] = 0
+    keep, arcs = fit_arcs(xs, ys, None, removable, 0.01)
+    assert sorted(arcs.keys()) == [99, 200]
+
+def test_arcs_transformed_path(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    points = circle_points(0.5, 0.5, 0.4, 100, sweep=math.pi)
+    with open(gcode_path, "w") as f:
+        f.write("G0 X{} Y{} F1000\n".format(*points[0]))
+        for x, y in points[1:]:
+            f.write("G1 X{:.6f} Y{:.6f}\n".format(x, y))
+    build_sidecar(gcode_path)
+    fit = Fit(dict(DIMENSIONS, table_x=300))               # same scale on both the axes: the circle is not stretched
+    with open_sidecar(gcode_path) as sidecar:
+        path = load_transformed_path(gcode_path, sidecar, fit, arc_tolerance=0.05)
+        commands = [c for _, _, c in sidecar.iterate(path, fit)]
+        assert [c.command for c in commands] == ["G0", "G2"]       # mirrored by the fit filter
+        cached = load_transformed_path(gcode_path, sidecar, fit, arc_tolerance=0.05)
+        assert (cached.indices, cached.arcs) == (path.indices, path.arcs)
+    # the arc length is close to the original polyline length
+    x0, y0 = fit.transform_point(*points[0])
+    arc = commands[1]
+    assert arc_length(x0, y0, arc.x, arc.y, arc.i, arc.j, arc.command == "G2") == pytest.approx(math.pi*0.4*300, rel=1e-3)
+
+def test_stretched_arcs_are_interpolated(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G0 X0 Y0.5\nG2 X1 Y0.5 I0.5 J0 F1000\nG1 X1 Y0\n")
+    build_sidecar(gcode_path)
+    fit = Fit(DIMENSIONS)                                   # different scales on the two axes
+    with open_sidecar(gcode_path) as sidecar:
+        path = load_transformed_path(gcode_path, sidecar, fit)
+        records = list(sidecar.iterate(path, fit))
+    # the arc is replaced by segments: only the last one ends the record
+    assert [c.command for _, _, c in records] == ["G0"] + ["G1"]*(len(records) - 1)
+    assert sum(1 for x, _, _ in records if not x is None) == 3
+    assert (records[-2][2].x, records[-2][2].y) == pytest.approx(fit.transform_point(1, 0.5))
+
+def test_preview_arcs():
+    factory = ImageFactory({"type": "Cartesian", "width": 100, "height": 100})
+    infos, coords = factory.gcode_to_coords(io.StringIO("G0 X20 Y0\nG3 X0 Y20 I-20 J0\n"))
+    assert len(coords) > 10
+    assert infos["total_lenght"] == pytest.approx(math.pi*10, rel=1e-2)     # quarter circle instead of the chord
+
+def test_resume_from_record(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G0 X0 Y0\nG1 X0.1 Y0 F1000\nG1 X0.1 Y0.1\nG1 X0 Y0.1\n")
+    build_sidecar(gcode_path)
+    fit = Fit(dict(DIMENSIONS, table_x=300))
+    with open_sidecar(gcode_path) as sidecar:
+        path = load_transformed_path(gcode_path, sidecar, fit)
+        commands = [str(c) for _, _, c in sidecar.iterate(path, fit)]
+        assert [str(c) for _, _, c in sidecar.iterate(path, fit, 2)] == commands[2:]
+        assert sidecar.get_feedrate(3) == 1000 and sidecar.get_feedrate(0) is None
+        # the checkpoints of the path are valid only while the same path is loaded
+        assert get_path_hash(load_transformed_path(gcode_path, sidecar, fit).key) == get_path_hash(path.key) != 0
+        assert get_path_hash(load_transformed_path(gcode_path, sidecar, fit, tolerance=0.1).key) != get_path_hash(path.key)
+    origin = math.hypot(*fit.transform_point(0, 0))
+    assert path.get_length(2) == pytest.approx(origin + 30)
+    assert path.get_length() == pytest.approx(origin + 90)
+
+def test_path_index():
+    # square with a side of 10 mm starting from the origin, then back along the first side
+    path = TransformedPath(array("d", [0, 10, 10, 0, 0, 10]), array("d", [0, 0, 10, 10, 0, 0]))
+    index = PathIndex.from_path(path)
+    assert len(index) == 6 and index.get_total_length() == pytest.approx(50)
+    assert index.get_length(3) == pytest.approx(path.get_length(3))
+    assert index.position_at(25) == (3, 5, 10)
+    assert index.locate(10.1, 5, 0, 6, 0.5) == (2, pytest.approx(15))
+    # the first side is passed twice: the first run close to the point after the start is used
+    assert index.locate(5, 0.1, 0, 6, 0.5) == (1, pytest.approx(5))
+    assert index.locate(5, 0.1, 3, 6, 0.5) == (5, pytest.approx(45))
+    assert index.locate(5, 0.1, 3, 3, 0.5) is None
+
+def test_path_index_cache_and_eta(tmp_path):
+    gcode_path = os.path.join(tmp_path, "1.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G0 X0 Y0\nG1 X1 Y0 F600\nG1 X1 Y1 F1200\n")
+        # short zigzag: the acceleration does not allow to reach the feedrate
+        f.write("G1 X0.998 Y1 F3000\n" + "".join("G1 X{} Y1\n".format(0.998 if i % 2 else 1) for i in range(20)))
+    build_sidecar(gcode_path)
+    fit = Fit(DIMENSIONS)
+    with open_sidecar(gcode_path) as sidecar:
+        index = load_transformed_path(gcode_path, sidecar, fit).index
+        index_path = os.path.join(tmp_path, "1_{}.idx".format(fit.get_hash()))
+        assert os.path.isfile(index_path)
+        cached = load_transformed_path(gcode_path, sidecar, fit).index
+        assert (cached.length, cached.time, cached.x) == (index.length, index.time, index.x)
+        # back-filled when missing (drawings uploaded before the index)
+        os.remove(index_path)
+        load_transformed_path(gcode_path, sidecar, fit)
+        assert os.path.isfile(index_path)
+    # every segment at its own feedrate: the feedrate changes are part of the ETA
+    segments = [index.length[k] - index.length[k-1] for k in range(1, 3)]
+    assert index.time[2] - index.time[0] == pytest.approx(segments[0]*60/600 + segments[1]*60/1200)
+    zigzag = index.get_total_length() - index.length[2]
+    assert index.get_total_time() - index.time[2] > 2*zigzag*60/3000
+    assert index.get_time_at(index.length[1]) == pytest.approx(index.time[1])
+
+    # the progress is a lookup in the index, the ETA is scaled by the actual feedrate of the device (i.e. feed override)
+    element = DrawingElement(drawing_id=1)
+    element._path_index, element._index, element._feedrate = index, 2, 600
+    assert element.get_path_lenght_done() == index.length[1]
+    assert element.get_progress(600)["eta"] == pytest.approx(index.get_total_time() - index.time[1])
+    assert element.get_progress(1200)["eta"] == pytest.approx((index.get_total_time() - index.time[1])/2)
+    element.set_executed_length(index.length[0])
+    assert element.get_progress(0)["eta"] == pytest.approx(index.length[0]/index.get_total_length()*100)
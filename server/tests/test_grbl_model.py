@@ -0,0 +1,79 @@
+import pytest
+
+from server.hw_controller.grbl_model import GrblModel, UNDEFINED_FEEDRATE_ERROR, JOG_ERROR
+from server.hw_controller.emulator import Emulator, EmulatorClock, GRBL_MODEL
+import server.hw_controller.firmware_defaults as firmware
+
+# the model is driven with explicit times: the tests do not depend on the real clock
+
+def test_trapezoidal_profile():
+    model = GrblModel(0, acceleration=100, max_rate=6000)
+    assert model.receive("G1 X100 Y0 F6000\n", 0) == ["ok"]
+    # accelerates to 100 mm/s in 50 mm and decelerates in the last 50 mm
+    assert model.next_event_time() == pytest.approx(2)
+    assert model.status_report(1).startswith("<Run|MPos:50.000,0.000,0.000|Bf:14,128|FS:6000")
+    model.update(2)
+    assert model.status_report(2).startswith("<Idle|MPos:100.000,0.000,0.000|Bf:15,128")
+
+def test_planner_and_rx_buffer_limits():
+    model = GrblModel(0)
+    lines = ["G1 X{} Y0 F1000\n".format(10*(i + 1)) for i in range(20)]
+    acks = sum([model.receive(l, 0) for l in lines], [])
+    assert len(acks) == 15                                  # the planner is full
+    # the 16th line is waiting for a free block: the following lines are still in the RX buffer
+    rx_used = sum(len(l) for l in lines[16:])
+    assert "|Bf:0,{}|".format(128 - rx_used) in model.status_report(0)
+    assert model.update(model.next_event_time()) == ["ok"]  # the first block is done
+
+def test_junction_speed():
+    model = GrblModel(0, acceleration=100, max_rate=6000)
+    model.receive("G1 X100 Y0 F6000\n", 0)
+    model.receive("G1 X200 Y0\n", 0)
+    model.receive("G1 X200 Y100\n", 0)
+    straight, corner = model._planner[1].entry, model._planner[2].entry
+    assert straight == pytest.approx(100)                   # collinear blocks: no need to slow down
+    assert corner < 5
+
+def test_compact_and_modal_lines():
+    model = GrblModel(0)
+    assert model.receive("G1X10Y0F600\n", 0) == ["ok"]
+    assert model.receive("X10Y-10\n", 0) == ["ok"]
+    assert [(b.x, b.y) for b in model._planner] == [(10, 0), (10, -10)]
+    assert model.receive("$$\n", 0)[-1] == "ok"
+    assert GrblModel(0).receive("G1 X10\n", 0) == [UNDEFINED_FEEDRATE_ERROR]
+
+def test_jog_and_jog_cancel():
+    model = GrblModel(0, acceleration=100, max_rate=6000)
+    assert model.receive("$J=G90 G21 X100 Y0 F6000\n", 0) == ["ok"]
+    assert model.receive("$J=G91X0Y10F6000\n", 0) == ["ok"]
+    assert model.status_report(1).startswith("<Jog|MPos:50.000,0.000")
+    assert model.feedrate == 0                              # the jog does not change the modal state
+    model.jog_cancel(1)
+    assert model.status_report(1).startswith("<Idle|MPos:50.000,0.000,0.000|Bf:15,128")
+    assert model.receive("$J=G90 X10 Y0\n", 1) == [JOG_ERROR]     # the feedrate is mandatory
+    model.receive("G1 X100 Y0 F6000\n", 1)
+    model.jog_cancel(2)                                     # the other moves are not cancelled
+    assert model.status_report(2).startswith("<Run|")
+
+def test_feed_override():
+    model = GrblModel(0, acceleration=100, max_rate=6000)
+    for i in range(5):
+        model.feed_override_command(firmware.GRBL.feed_override_coarse[1], 0)      # -10%
+    model.receive("G1 X100 Y0 F6000\n", 0)
+    assert model.next_event_time() == pytest.approx(2.5)   # 50 mm/s
+    assert model.status_report(0).endswith("|Ov:50,100,100>")
+    model.feed_override_command(firmware.GRBL.feed_override_reset, 0)
+    assert model.feed_override == 100
+
+def test_emulator_grbl_model():
+    emulator = Emulator(EmulatorClock("instant"), model=GRBL_MODEL)
+    emulator.firmware = firmware.GRBL.name
+    emulator.readline()                                     # ready message
+    emulator.send(b"G1 X100 Y0 F6000\nG1 X200 Y0\n")
+    emulator.send("?")
+    assert emulator.readline(1).strip() == "ok"
+    assert emulator.readline(1).strip() == "ok"
+    assert "|Bf:13,128|" in emulator.readline(1)
+    assert emulator.readline(0.1) is None                   # the instant clock runs until the planner is empty
+    emulator.send("?")
+    assert emulator.readline(1).startswith("<Idle|MPos:200.000,0.000")
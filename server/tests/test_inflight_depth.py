@@ -0,0 +1,35 @@
+from server.hw_controller.inflight_depth import InFlightDepth, WINDOW, STARVED, QUEUEING, RESEND
+from server.utils.metrics import metrics
+
+# feeds a window of acks with the given round trip and interval between the acks
+def feed_window(depth, rtt, interval, waiting=True, limited=True, start=0):
+    for i in range(WINDOW):
+        depth.on_ack(rtt, start + i*interval, waiting, limited)
+    return start + WINDOW*interval
+
+def test_depth_grows_when_starved():
+    depth = InFlightDepth(2, 8, 16)
+    feed_window(depth, rtt=0.002, interval=0.0005)     # acks come back immediately: the controller can take more lines
+    assert depth.depth == 9
+    assert depth.history[-1][1:] == (8, 9, STARVED)
+    assert metrics.snapshot()["gauges"]["in_flight_depth"] == 9
+
+def test_depth_shrinks_when_lines_are_queued():
+    depth = InFlightDepth(2, 8, 16)
+    t = 0
+    for i in range(10):
+        # 5 ms to transfer the line and 50 ms per segment: the lines are queued in the controller
+        for j in range(WINDOW):
+            depth.on_ack(0.005 if j == 0 else 0.050*depth.depth, t, True, True)
+            t += 0.050
+    assert depth.needed == 3                            # 1 line covers the round trip + headroom
+    assert depth.depth == 3
+    assert all(reason == QUEUEING for _, _, _, reason in depth.history)
+
+def test_depth_halved_on_errors():
+    depth = InFlightDepth(2, 8, 16)
+    depth.on_error(RESEND)
+    depth.on_error(RESEND)
+    depth.on_error(RESEND)
+    assert depth.depth == 2                             # never below the min depth
+    assert [c["reason"] for c in depth.get_stats()["changes"]] == [RESEND, RESEND]
@@ -3,3 +3,10 @@ def test_index(client):
     rv = client.get('/')
 
     assert rv.default_status == 200
+
+def test_metrics(client):
+    rv = client.get('/api/metrics')
+    assert rv.status_code == 200
+    assert b"sandypi_generate_line_seconds_count" in rv.data
+    rv = client.get('/api/metrics/json')
+    assert "ack_round_trip_seconds" in rv.get_json()["histograms"]
@@ -1,4 +1,14 @@
+from threading import Thread
+import os
+
+import pytest
+
 from server.utils.settings_utils import get_only_values, match_dict
+from server.utils.ring_buffer import RingBuffer
+from server.utils.drawing_checkpoint import DrawingCheckpoint, get_path_hash
+from server.utils.resend_history import ResendHistory
+from server.utils.metrics import Metrics
+from server.utils.macros import compile_macros, compile_script, evaluate_macros
 
 
 def test_settings_match_dict():
@@ -7,6 +17,75 @@ def test_settings_match_dict():
     c = match_dict(a,b)
     assert(c=={"a":0, "b":{"c":2, "d":4, "e":5}, "d":5, "c":3})
 
+
 def test_get_only_values():
     d = {"a":500, "b":{"asf":3, "value":10}, "c":{"d":{"fds":29, "value":32}}}
-    assert({"b": 10, "c": {"d": 32}}==get_only_values(d))
\ No newline at end of file
+    assert({"b": 10, "c": {"d": 32}}==get_only_values(d))
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(2)
+    assert buffer.put(1) and buffer.put(2)
+    th = Thread(target=buffer.put, args=(3,), daemon=True)      # must wait for free space
+    th.start()
+    assert buffer.get() == 1
+    th.join(timeout=1)
+    assert buffer.get_stats()["full_waits"] == 1
+    buffer.close()
+    assert not buffer.put(4)
+    assert [buffer.get(), buffer.get()] == [2, 3]
+    with pytest.raises(RingBuffer.Closed):
+        buffer.get()
+
+
+def test_drawing_checkpoint(tmp_path):
+    path = os.path.join(tmp_path, "checkpoint.bin")
+    checkpoint = DrawingCheckpoint(path)
+    assert checkpoint.load() is None
+    checkpoint.save(12, 345, 6789, 10.5, -2, get_path_hash("abc_s0.1"))
+    saved = DrawingCheckpoint(path).load()          # the file is readable while it is mapped
+    assert (saved.drawing_id, saved.index, saved.offset, saved.x, saved.y) == (12, 345, 6789, 10.5, -2)
+    assert saved.path_hash == get_path_hash("abc_s0.1") != get_path_hash("abc")
+    checkpoint.clear()
+    assert checkpoint.load() is None
+    checkpoint.close()
+
+
+def test_resend_history():
+    history = ResendHistory(4)
+    for n in range(1, 7):
+        history.add(n, "N{}".format(n).encode())
+    assert history.get(6) == b"N6" and history.get(2) is None
+    assert history.get_from(4) == (4, [b"N4", b"N5", b"N6"])
+    assert history.get_from(1) == (3, [b"N3", b"N4", b"N5", b"N6"])     # the oldest lines are not available anymore
+    assert history.get_from(7) == (None, [])
+    # the numeration restarts: the stale lines are not sent
+    history.add(2, b"new N2")
+    assert history.get_from(1) == (2, [b"new N2"])
+
+
+def test_metrics_histogram():
+    metrics = Metrics()
+    histogram = metrics.histogram("test_seconds", "Test histogram")
+    for i in range(1, 1001):
+        histogram.record(i*1e-6)                    # 1 us to 1 ms
+    assert histogram.count == 1000
+    assert histogram.quantile(0.5) == pytest.approx(500e-6, rel=0.125)
+    assert histogram.quantile(0.99) == pytest.approx(990e-6, rel=0.125)
+    assert histogram.quantile(1) == 1e-3
+    metrics.counter("test_total").inc(3)
+    text = metrics.to_prometheus()
+    assert 'sandypi_test_seconds{quantile="0.5"}' in text
+    assert "sandypi_test_seconds_count 1000" in text and "sandypi_test_total 3" in text
+    assert metrics.snapshot()["counters"]["test_total"] == 3
+
+
+def test_macros():
+    compile_macros.cache_clear()
+    for x in range(10):
+        assert evaluate_macros("G1 X&x+1& Y&y*2&", {"x": x, "y": 1}) == "G1 X{} Y2".format(x + 1)
+    assert compile_macros.cache_info().misses == 1           # the command is parsed only once
+    errors = []
+    assert evaluate_macros("G1 X&x+& Y&z&", {"x": 1}, lambda m, e: errors.append(m)) == "G1 X&x+& Y&z&"
+    assert errors == ["x+", "z"]                             # parse error and unknown variable
+    assert compile_script("G28\nG1 X&x*& Y0") == ["x*"]
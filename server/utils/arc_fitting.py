@@ -0,0 +1,148 @@
+from math import sqrt, atan2, ceil, cos, sin, pi, hypot
+from array import array
+
+# Arcs (G2/G3) utilities
+#  * geometry of the arcs (length, interpolation) used by the previews, the emulator and the progress of the drawings
+#  * arc fitting: the runs of points lying on a circle are replaced with a single arc command
+# The arcs are in the XY plane with the center relative to the starting point (I, J), as used by Marlin and Grbl.
+
+# min number of segments that can be replaced by an arc
+MIN_ARC_SEGMENTS = 4
+# arcs with a larger radius are considered straight lines
+MAX_ARC_RADIUS = 1000
+# max angle of an arc fitted in the drawing (full circles are split in two arcs)
+MAX_ARC_SWEEP = 1.5*pi
+# angle of the segments used to interpolate the arcs
+ARC_INTERPOLATION_ANGLE = pi/36
+
+def is_arc(command):
+    """Returns True if the parsed command is an arc with the center specified (I, J)"""
+    return command.command in ("G2", "G3") and (not command.i is None or not command.j is None)
+
+def arc_sweep(x0, y0, x1, y1, i, j, clockwise):
+    """Returns the center, the radius, the starting angle and the (signed) angle of the arc"""
+    cx, cy = x0 + i, y0 + j
+    start = atan2(y0 - cy, x0 - cx)
+    end = atan2(y1 - cy, x1 - cx)
+    sweep = (start - end) if clockwise else (end - start)
+    sweep %= 2*pi
+    if sweep < 1e-9:
+        sweep = 2*pi            # same starting and ending point: full circle
+    return cx, cy, hypot(i, j), start, -sweep if clockwise else sweep
+
+def arc_length(x0, y0, x1, y1, i, j, clockwise):
+    _, _, r, _, sweep = arc_sweep(x0, y0, x1, y1, i, j, clockwise)
+    return abs(sweep)*r
+
+def move_length(x0, y0, x1, y1, command):
+    """Returns the length of the path followed by the parsed command from (x0, y0) to (x1, y1)"""
+    if is_arc(command):
+        return arc_length(x0, y0, x1, y1, command.i or 0, command.j or 0, command.command == "G2")
+    return hypot(x1 - x0, y1 - y0)
+
+def interpolate_arc(x0, y0, x1, y1, i, j, clockwise):
+    """Returns the points along the arc (without the starting point)"""
+    cx, cy, r, start, sweep = arc_sweep(x0, y0, x1, y1, i, j, clockwise)
+    steps = max(2, ceil(abs(sweep)/ARC_INTERPOLATION_ANGLE))
+    points = [(cx + r*cos(start + sweep*k/steps), cy + r*sin(start + sweep*k/steps)) for k in range(1, steps)]
+    points.append((x1, y1))
+    return points
+
+
+def _fit_circle(px, py, first, last, tolerance):
+    """
+        Checks if the points between first and last lie on a circle (within the tolerance)
+        Returns the center relative to the first point and the direction (i, j, clockwise) or None
+    """
+    x0, y0 = px[first], py[first]
+    middle = (first + last)//2
+    ax, ay = px[middle] - x0, py[middle] - y0
+    bx, by = px[last] - x0, py[last] - y0
+    d = 2*(ax*by - ay*bx)
+    if abs(d) < 1e-12:                      # collinear points
+        return None
+    a2, b2 = ax*ax + ay*ay, bx*bx + by*by
+    i = (by*a2 - ay*b2)/d
+    j = (ax*b2 - bx*a2)/d
+    r = hypot(i, j)
+    if r > MAX_ARC_RADIUS:
+        return None
+    cx, cy = x0 + i, y0 + j
+    clockwise = d < 0
+    sweep = 0
+    last_x, last_y = x0 - cx, y0 - cy
+    for k in range(first + 1, last + 1):
+        x, y = px[k] - cx, py[k] - cy
+        # the point and the middle of the segment must be on the circle
+        if abs(sqrt(x*x + y*y) - r) > tolerance or abs(hypot((x + last_x)/2, (y + last_y)/2) - r) > tolerance:
+            return None
+        # the points must move always in the same direction
+        step = atan2(last_x*y - last_y*x, last_x*x + last_y*y)
+        if (step < 0) != clockwise or step == 0:
+            return None
+        sweep += abs(step)
+        last_x, last_y = x, y
+    if sweep > MAX_ARC_SWEEP:
+        return None
+    return i, j, clockwise
+
+def fit_arcs(xs, ys, indices, removable, tolerance):
+    """
+        Replaces the runs of points lying on a circle with arcs
+         * xs, ys: coordinates of all the points
+         * indices: points of the path (None for all the points)
+         * removable: flags of the points that can be part of an arc (the others are kept as they are)
+        Returns the indices of the points to keep (array of uint32) and a dict with the arcs ending in the kept points: {index: (i, j, clockwise)}
+    """
+    if indices is None:
+        indices = range(len(xs))
+    px = [xs[k] for k in indices]
+    py = [ys[k] for k in indices]
+    n = len(px)
+    # last point of the run of removable points starting from every point (k-1 if the point is not removable)
+    run_end = [0]*n
+    end = n - 1
+    for k in range(n - 1, -1, -1):
+        if not removable[indices[k]]:
+            end = k - 1
+        run_end[k] = end
+    keep = array("I")
+    arcs = {}
+    if n > 0:
+        keep.append(indices[0])
+    s = 0
+    while s < n - 1:
+        max_last = run_end[s + 1] if run_end[s + 1] > s else s
+        arc = None
+        last = s + MIN_ARC_SEGMENTS
+        if last <= max_last:
+            arc = _fit_circle(px, py, s, last, tolerance)
+        if not arc is None:
+            # doubles the arc length until it is not valid anymore and then uses a binary search to find the longest arc
+            good, bad = last, None
+            while bad is None:
+                candidate = s + 2*(good - s)
+                if candidate > max_last:
+                    candidate = max_last
+                    if candidate == good:
+                        break
+                result = _fit_circle(px, py, s, candidate, tolerance)
+                if result is None:
+                    bad = candidate
+                else:
+                    good, arc = candidate, result
+            if not bad is None:
+                while bad - good > 1:
+                    candidate = (good + bad)//2
+                    result = _fit_circle(px, py, s, candidate, tolerance)
+                    if result is None:
+                        bad = candidate
+                    else:
+                        good, arc = candidate, result
+            arcs[indices[good]] = arc
+            keep.append(indices[good])
+            s = good
+        else:
+            keep.append(indices[s + 1])
+            s += 1
+    return keep, arcs
@@ -0,0 +1,76 @@
+import os
+import mmap
+import struct
+import hashlib
+from time import time
+from threading import Lock
+from dotmap import DotMap
+
+# Checkpoint of the drawing being played, used to resume the drawing after a restart or a power loss
+# The checkpoint is a small fixed size file mapped in memory: saving it is a memory copy and a flush of a single page (no database commits)
+# Layout (little endian): magic, version, active flag, drawing id, index of the last command acked by the device (in the element commands),
+# byte offset of the next line in the .gcode file (used when the drawing is played without the sidecar), position of the last acked command, timestamp,
+# hash of the transformed path the index refers to (the index is valid only with the same device settings, see "get_path_hash")
+
+CHECKPOINT_PATH = "./server/saves/checkpoint.bin"
+CHECKPOINT_MAGIC = b"SPCK"
+CHECKPOINT_VERSION = 2
+# min time between two checkpoints (s)
+CHECKPOINT_INTERVAL = 1
+
+_layout = struct.Struct("<4sHHQQQdddQ")
+
+# returns the hash of the cache key of a transformed path (see "load_transformed_path"), 0 if the drawing is played without the sidecar
+def get_path_hash(key):
+    if key is None:
+        return 0
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "little")
+
+class DrawingCheckpoint():
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self._mutex = Lock()
+        self._mmap = None
+
+    def _open(self):
+        if self._mmap is None:
+            if not os.path.isfile(self.path) or os.path.getsize(self.path) != _layout.size:
+                with open(self.path, "wb") as f:
+                    f.write(bytes(_layout.size))
+            self._file = open(self.path, "r+b")
+            self._mmap = mmap.mmap(self._file.fileno(), _layout.size)
+        return self._mmap
+
+    def save(self, drawing_id, index, offset, x, y, path_hash=0):
+        with self._mutex:
+            m = self._open()
+            _layout.pack_into(m, 0, CHECKPOINT_MAGIC, CHECKPOINT_VERSION, 1, drawing_id, index, offset, x, y, time(), path_hash)
+            m.flush()
+
+    def clear(self):
+        with self._mutex:
+            if self._mmap is None and not os.path.isfile(self.path):
+                return
+            m = self._open()
+            m[:] = bytes(_layout.size)
+            m.flush()
+
+    # returns the last checkpoint saved or None if no drawing was running
+    def load(self):
+        with self._mutex:
+            try:
+                with open(self.path, "rb") as f:
+                    data = f.read(_layout.size)
+                magic, version, active, drawing_id, index, offset, x, y, timestamp, path_hash = _layout.unpack(data)
+            except (OSError, struct.error):
+                return None
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION or not active:
+            return None
+        return DotMap({"drawing_id": drawing_id, "index": index, "offset": offset, "x": x, "y": y, "timestamp": timestamp, "path_hash": path_hash})
+
+    def close(self):
+        with self._mutex:
+            if not self._mmap is None:
+                self._mmap.close()
+                self._file.close()
+                self._mmap = None
@@ -0,0 +1,148 @@
+import os
+import json
+from math import sqrt, hypot, inf
+from array import array
+
+from server.utils.arc_fitting import arc_sweep
+
+# Look-ahead feedrate planner for the precompiled drawings
+# The controller plans only the few blocks in its buffer (15 on grbl): on dense drawings it cannot reach the feedrate on the straight parts and
+# the ball arrives too fast in the tight turns, where the sand piles up.
+# The planner works on the whole transformed path and assigns a feedrate to every segment:
+#  * the speed at every junction is limited by the angle between the segments (same junction deviation model used by grbl)
+#  * the speed along an arc is limited by the centripetal acceleration
+#  * the speeds are propagated backward and forward with the acceleration limit (the ball must be able to slow down before the turns)
+#  * every segment gets the max speed it can reach between its entry and exit speeds
+# The feedrate cap of the feeder ("max_drawing_feedrate") is applied while sending the lines: it is still a hard ceiling.
+
+# used when the acceleration is not set and cannot be read from the controller (mm/s^2)
+DEFAULT_ACCELERATION = 100
+# used when the max feedrate is not set and cannot be read from the controller (mm/min)
+DEFAULT_MAX_FEEDRATE = 3000
+# max distance between the path and the junction point (mm). Larger values make the ball faster in the turns
+JUNCTION_DEVIATION = 0.02
+# the planned feedrates are rounded down to this step (mm/min): the F word is sent only when the feedrate changes
+FEEDRATE_STEP = 50
+MIN_FEEDRATE = 100
+# values read from the controller (grbl "$$" command)
+CONTROLLER_LIMITS_PATH = "./server/saves/controller_limits.json"
+# grbl settings used by the planner: max rate (mm/min) and acceleration (mm/s^2) of the X and Y axes
+GRBL_MAX_RATE_SETTINGS = ("110", "111")
+GRBL_ACCELERATION_SETTINGS = ("120", "121")
+# steps per unit of the X and Y axes (used by the fast mode encoder of the feeder)
+GRBL_STEPS_SETTINGS = ("100", "101")
+
+def load_controller_limits():
+    if not os.path.isfile(CONTROLLER_LIMITS_PATH):
+        return {}
+    try:
+        with open(CONTROLLER_LIMITS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_controller_limits(limits):
+    with open(CONTROLLER_LIMITS_PATH, "w") as f:
+        f.write(json.dumps(limits, indent=4))
+
+def get_planner_limits(device, controller=None):
+    """
+        Returns the acceleration (mm/s^2) and the max feedrate (mm/min) used by the planner or None if the planner is disabled
+        The values from the device settings are used when set (> 0), otherwise the values read from the controller (slowest axis) or the defaults
+    """
+    if not device.get("feedrate_planner", False):
+        return None
+    controller = load_controller_limits() if controller is None else controller
+    return _get_limit(device, controller, "planner_acceleration", GRBL_ACCELERATION_SETTINGS, DEFAULT_ACCELERATION), get_max_feedrate(device, controller)
+
+def get_max_feedrate(device, controller=None):
+    """Returns the max feedrate of the device (mm/min): the device setting when set (> 0), otherwise the value read from the controller (slowest axis) or the default"""
+    controller = load_controller_limits() if controller is None else controller
+    return _get_limit(device, controller, "planner_max_feedrate", GRBL_MAX_RATE_SETTINGS, DEFAULT_MAX_FEEDRATE)
+
+def _get_limit(device, controller, setting, keys, default):
+    value = float(device.get(setting, 0) or 0)
+    if value > 0:
+        return value
+    values = [float(controller[k]) for k in keys if float(controller.get(k, 0)) > 0]
+    return min(values) if len(values) > 0 else default
+
+def junction_speed(ux, uy, wx, wy, acceleration, junction_deviation):
+    # same approximation used by grbl: circle tangent to both the segments, deviating from the junction point by "junction_deviation"
+    cos_theta = -(ux*wx + uy*wy)
+    sin_half = sqrt(max(0.5*(1 - cos_theta), 0))
+    if sin_half > 0.999999:
+        return inf                                  # straight junction
+    return sqrt(acceleration*junction_deviation*sin_half/(1 - sin_half))
+
+def plan_feedrates(xs, ys, indices, arcs, plannable, acceleration, max_feedrate, junction_deviation=JUNCTION_DEVIATION):
+    """
+        Returns the feedrate (mm/min) of every point of the path (array of float32, NaN for the points that are not planned)
+         * xs, ys: coordinates of all the points
+         * indices: points of the path (None for all the points)
+         * arcs: arcs ending in the points of the path: {index: (i, j, clockwise)}
+         * plannable: flags of the points reached with a feed move (the path stops before and after the other points)
+    """
+    if indices is None:
+        indices = range(len(xs))
+    n = len(indices)
+    nan = float("nan")
+    result = array("f", [nan])*n
+    if n < 2:
+        return result
+    a = acceleration
+    vmax = max_feedrate/60
+    lengths = [0.0]*n                   # length of the segment ending in every point
+    nominal = [0.0]*n                   # max speed along the segment
+    limits = [0.0]*n                    # max speed at the end of the segment (0 where the path stops)
+    last = None                         # direction at the end of the previous segment
+    px, py = xs[indices[0]], ys[indices[0]]
+    for k in range(1, n):
+        r = indices[k]
+        x, y = xs[r], ys[r]
+        if not plannable[r]:
+            px, py = x, y
+            last = None
+            continue
+        arc = arcs.get(r)
+        if arc is None:
+            length = hypot(x - px, y - py)
+            if length == 0:
+                # zero length segments do not change the direction
+                nominal[k] = vmax
+                limits[k-1] = inf if not last is None else 0
+                px, py = x, y
+                continue
+            sx, sy = (x - px)/length, (y - py)/length
+            ex, ey = sx, sy
+            speed = vmax
+        else:
+            i, j, clockwise = arc
+            cx, cy, radius, _, sweep = arc_sweep(px, py, x, y, i, j, clockwise)
+            length = abs(sweep)*radius
+            # tangents at the starting and ending points
+            d = -1 if clockwise else 1
+            sx, sy = -d*(py - cy)/radius, d*(px - cx)/radius
+            ex, ey = -d*(y - cy)/radius, d*(x - cx)/radius
+            speed = min(vmax, sqrt(a*radius))
+        lengths[k] = length
+        nominal[k] = speed
+        if not last is None:
+            limits[k-1] = min(junction_speed(last[0], last[1], sx, sy, a, junction_deviation), nominal[k-1], speed)
+        last = (ex, ey)
+        px, py = x, y
+
+    # the ball must be able to slow down before every junction and to reach the speed after it
+    for k in range(n - 2, -1, -1):
+        limits[k] = min(limits[k], sqrt(limits[k+1]**2 + 2*a*lengths[k+1]))
+    for k in range(1, n):
+        limits[k] = min(limits[k], sqrt(limits[k-1]**2 + 2*a*lengths[k]))
+
+    for k in range(1, n):
+        if nominal[k] == 0:
+            continue
+        # highest speed reachable in the segment accelerating from the entry speed and decelerating to the exit speed
+        peak = sqrt((limits[k-1]**2 + limits[k]**2)/2 + a*lengths[k])
+        feedrate = min(nominal[k], peak)*60
+        result[k] = max((feedrate//FEEDRATE_STEP)*FEEDRATE_STEP, MIN_FEEDRATE)
+    return result
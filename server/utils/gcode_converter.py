@@ -1,11 +1,14 @@
 from PIL import Image, ImageDraw
 from math import cos, sin, pi, sqrt
 from dotmap import DotMap
-from server.hw_controller.gcode_rescalers import Fit
+from server.hw_controller.gcode_rescalers import Fit, get_fit_dimensions
+from server.utils.gcode_tokenizer import tokenize_all
+from server.utils.arc_fitting import is_arc, interpolate_arc
 
 class ImageFactory:
-    # straight lines gcode commands
-    straight_lines = ["G01", "G1", "G0", "G00"]
+    # straight lines gcode commands (as normalized by the tokenizer)
+    straight_lines = ("G0", "G1")
+    arc_lines = ("G2", "G3")
 
     # Args:
     #  - device: dict with the following values
@@ -78,37 +81,26 @@ class ImageFactory:
         
         # Read file content once
         lines = file.readlines()
-        
-        for line in lines:
-            # skipping comments
-            if line.startswith(";"):  
-                continue
-            
-            # remove inline comments
-            if ";" in line:
-                line = line.split(";")[0]
+        parsed = tokenize_all(lines)
+        xs, ys = parsed.x, parsed.y
 
-            if len(line) <3:
+        for n, command in enumerate(parsed.commands):
+            if command in self.arc_lines:
+                # arcs are interpolated with short segments (the bounds are computed on the straight moves only: the arcs do not update them)
+                arc = parsed.get_command(n)
+                if is_arc(arc):
+                    com_X = arc.x if not arc.x is None else old_X
+                    com_Y = arc.y if not arc.y is None else old_Y
+                    raw_coords.extend(interpolate_arc(old_X, old_Y, com_X, com_Y, arc.i or 0, arc.j or 0, arc.command == "G2"))
+                    old_X = com_X
+                    old_Y = com_Y
                 continue
-
-            # parsing line
-            params = line.split(" ")
-            if not (params[0] in self.straight_lines):       # TODO include also G2 and other curves command?
+            if not command in self.straight_lines:
                 continue
 
-            com_X = old_X               # command X value
-            com_Y = old_Y               # command Y value
-            # selecting values
-            for p in params:
-                if len(p) > 1:
-                    if p[0].upper()=="X":
-                        try:
-                            com_X = float(p[1:])
-                        except: pass
-                    if p[0].upper()=="Y":
-                        try:
-                            com_Y = float(p[1:])
-                        except: pass
+            # selecting values (nan if the value is not in the line)
+            com_X = xs[n] if xs[n] == xs[n] else old_X
+            com_Y = ys[n] if ys[n] == ys[n] else old_Y
             
             # Store raw coord
             raw_coords.append((com_X, com_Y))
@@ -121,45 +113,19 @@ class ImageFactory:
             old_X = com_X
             old_Y = com_Y
 
-        # Setup Fit filter
-        
-        # Heuristic: If dimensions are large (> 2), assume Absolute MM -> 1:1 Scale
-        # If dimensions are small (<= 2), assume Normalized -> Stretch to Fill
-        if (xmax - xmin > 2) or (ymax - ymin > 2) or (xmax > 2) or (ymax > 2):
-            # Absolute MM: Set input bounds to Table Size (0 to width)
-            d_min_x, d_max_x = 0, self.width
-            d_min_y, d_max_y = 0, self.height
-        else:
-            # Normalized: Set input bounds to actual bounds (Stretch to fill)
-            d_min_x, d_max_x = xmin if xmin != 100000 else 0, xmax if xmax != -100000 else 1
-            d_min_y, d_max_y = ymin if ymin != 100000 else 0, ymax if ymax != -100000 else 1
-
         # Check for PRE-TRANSFORMED tag
         is_pre_transformed = False
         for line in lines:
             if "TYPE: PRE-TRANSFORMED" in line:
                 is_pre_transformed = True
                 break
+        if is_pre_transformed and self.verbose:
+            print("Detected PRE-TRANSFORMED G-code. Disabling orientation mapping.")
 
-        dims = {
-            "table_x": self.width,
-            "table_y": self.height,
-            "drawing_max_x": d_max_x,
-            "drawing_max_y": d_max_y,
-            "drawing_min_x": d_min_x,
-            "drawing_min_y": d_min_y,
-            "offset_x": self.offset_x,
-            "offset_y": self.offset_y,
-            "orientation_origin": self.orientation_origin,
-            "orientation_swap": self.orientation_swap
-        }
-
-        if is_pre_transformed:
-            if self.verbose:
-                print("Detected PRE-TRANSFORMED G-code. Disabling orientation mapping.")
-            dims["orientation_origin"] = "Bottom-Left"
-            dims["orientation_swap"] = False
-
+        # Setup Fit filter (same dimensions used to transform the drawing during the playback)
+        if not raw_coords:
+            xmin, xmax, ymin, ymax = 0, 1, 0, 1
+        dims = get_fit_dimensions(xmin, xmax, ymin, ymax, self.device, is_pre_transformed)
         
         fit = Fit(dims)
         
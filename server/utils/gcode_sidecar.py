@@ -0,0 +1,532 @@
+import os
+import mmap
+import glob
+import math
+import struct
+from array import array
+
+from server.utils.gcode_tokenizer import GcodeCommand, tokenize, format_number
+from server.utils.path_simplification import simplify_path, DEFAULT_FEEDRATE
+from server.utils.arc_fitting import fit_arcs, arc_length
+from server.utils.feedrate_planner import plan_feedrates, DEFAULT_ACCELERATION, DEFAULT_MAX_FEEDRATE
+from server.utils.path_index import PathIndex
+from server.hw_controller.gcode_rescalers import get_fit_dimensions
+
+"""
+    Precompiled binary version of a drawing (sidecar file saved next to the .gcode file)
+
+    The drawing is parsed once when it is uploaded and saved as packed arrays so that the playback can stream the commands from the file (through mmap) without parsing the text again.
+
+    File format (little endian):
+     * header: magic, version, flags, number of records, number of raw commands, size and modification time of the source .gcode file (used to detect stale sidecars), bounds of the straight moves (xmin, xmax, ymin, ymax)
+     * codes (uint8): record type and parameters available in the original line (see the OP_ and HAS_ constants)
+     * x, y (float64): absolute position after the record (the last position is used when the line does not change it)
+     * f (float32): feedrate of the record (NaN if the line does not set the feedrate)
+     * raw commands table: records index (uint32), text offsets (uint32) and utf-8 text of the commands that are not simple straight moves
+    Every array starts at an offset multiple of 8 bytes.
+
+    The sidecar is not created for drawings using relative coordinates (G91): in that case the playback will use the .gcode file.
+
+    The coordinates transformed for the table (see "Fit" filter) are cached in a second file (<id>_<filter hash>.xy) with a similar header followed by:
+     * x, y (float64): transformed coordinates of all the records
+     * indices (uint32): records to play, if the path has been simplified
+     * arcs table: records (uint32), I and J (float64), direction (uint8, 1 for clockwise) of the arcs replacing the records before them
+     * feedrates (float32): feedrate planned for every record to play (NaN if not planned), if the feedrate planner is enabled
+
+    The cumulative length and estimated time of the transformed path (see "PathIndex") are cached in a third file (<id>_<filter hash>.idx):
+     * header: magic, version, flags, number of records, size and modification time of the source .gcode file, number of records to play
+     * length, time (float64): length [mm] and estimated time [s] of the path at the end of every record to play
+"""
+
+SIDECAR_EXTENSION = ".bin"
+SIDECAR_MAGIC = b"SPGC"
+SIDECAR_VERSION = 2
+TRANSFORMED_EXTENSION = ".xy"
+TRANSFORMED_MAGIC = b"SPXY"
+TRANSFORMED_VERSION = 3
+INDEX_EXTENSION = ".idx"
+INDEX_MAGIC = b"SPIX"
+INDEX_VERSION = 1
+
+PRE_TRANSFORMED_TAG = "; TYPE: PRE-TRANSFORMED"
+
+# header: magic, version, flags, records, raw commands, source size, source mtime (ns), xmin, xmax, ymin, ymax
+_header = struct.Struct("<4sHHIIQQdddd")
+# transformed coordinates header: magic, version, flags, records, source size, source mtime (ns), records to play, arcs
+_transformed_header = struct.Struct("<4sHHQQQQQ")
+# path index header: magic, version, flags, records, source size, source mtime (ns), records to play
+_index_header = struct.Struct("<4sHHQQQQ")
+
+# header flags
+FLAG_PRE_TRANSFORMED = 1
+# transformed coordinates header flags
+FLAG_HAS_INDICES = 1
+FLAG_HAS_FEEDRATES = 2
+
+# record codes
+OP_G0       = 0
+OP_G1       = 1
+OP_RAW      = 3
+OP_MASK     = 3
+HAS_X       = 4
+HAS_Y       = 8
+HAS_F       = 16
+
+_op_commands = {OP_G0: "G0", OP_G1: "G1"}
+
+def is_removable(code):
+    """Returns True if the record is a straight move that does not change the feedrate (can be removed by the path simplification)"""
+    return code & OP_MASK == OP_G1 and not code & HAS_F
+
+def get_sidecar_path(gcode_path):
+    return os.path.splitext(gcode_path)[0] + SIDECAR_EXTENSION
+
+def _source_signature(gcode_path):
+    stats = os.stat(gcode_path)
+    return stats.st_size, stats.st_mtime_ns
+
+def _padding(size):
+    return (-size) % 8
+
+def build_sidecar(gcode_path):
+    """
+        Parses the .gcode file and saves the sidecar file next to it
+        Returns the sidecar path or None if the drawing cannot be converted (relative coordinates)
+    """
+    codes = array("B")
+    xs = array("d")
+    ys = array("d")
+    fs = array("f")
+    raw_records = array("I")
+    raw_texts = []
+    flags = 0
+    x = 0.0
+    y = 0.0
+    bounds = [math.inf, -math.inf, math.inf, -math.inf]
+    motion = None
+    nan = float("nan")
+
+    with open(gcode_path) as f:
+        for line in f:
+            if PRE_TRANSFORMED_TAG in line:
+                flags |= FLAG_PRE_TRANSFORMED
+                continue
+            command = tokenize(line)
+            if command is None:
+                continue
+            if "G91" in command.line:           # relative coordinates are not supported, will use the gcode file
+                return None
+            if command.command is None and not motion is None:
+                command.command = motion        # modal command (line with coordinates only)
+            if command.command in ("G0", "G1", "G2", "G3"):
+                motion = command.command
+            if "G28" in command.line:
+                x = y = 0.0
+            if not command.x is None:
+                x = command.x
+            if not command.y is None:
+                y = command.y
+
+            if command.is_move():
+                code = OP_G0 if command.command == "G0" else OP_G1
+                if not command.x is None: code |= HAS_X
+                if not command.y is None: code |= HAS_Y
+                if not command.f is None: code |= HAS_F
+                bounds = [min(bounds[0], x), max(bounds[1], x), min(bounds[2], y), max(bounds[3], y)]
+            else:
+                code = OP_RAW
+                raw_records.append(len(codes))
+                raw_texts.append(command.line.encode())
+            codes.append(code)
+            xs.append(x)
+            ys.append(y)
+            fs.append(command.f if not command.f is None else nan)
+
+    if bounds[0] > bounds[1]:
+        bounds = [0, 1, 0, 1]                   # no moves in the drawing
+    raw_offsets = array("I", [0])
+    for t in raw_texts:
+        raw_offsets.append(raw_offsets[-1] + len(t))
+
+    sidecar_path = get_sidecar_path(gcode_path)
+    tmp_path = sidecar_path + ".tmp"
+    size, mtime = _source_signature(gcode_path)
+    with open(tmp_path, "wb") as f:
+        f.write(_header.pack(SIDECAR_MAGIC, SIDECAR_VERSION, flags, len(codes), len(raw_records), size, mtime, *bounds))
+        for a in (codes, xs, ys, fs, raw_records, raw_offsets):
+            data = a.tobytes()
+            f.write(data)
+            f.write(bytes(_padding(len(data))))
+        f.write(b"".join(raw_texts))
+    os.replace(tmp_path, sidecar_path)          # the file is replaced only when completely written
+    return sidecar_path
+
+def open_sidecar(gcode_path):
+    """Returns the sidecar of the given .gcode file or None if it is not available or stale (the .gcode file must be used instead)"""
+    sidecar_path = get_sidecar_path(gcode_path)
+    if not os.path.isfile(sidecar_path):
+        return None
+    try:
+        sidecar = GcodeSidecar(sidecar_path)
+    except (OSError, ValueError):               # empty or unreadable file
+        return None
+    if sidecar.is_valid_for(gcode_path):
+        return sidecar
+    sidecar.close()
+    return None
+
+
+class GcodeSidecar():
+    """
+        Read only access to a sidecar file
+        The arrays are memoryviews on the mmap of the file: the data is loaded by the OS only when accessed
+        Must be closed after use (can be used as a context manager)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if len(self._view) >= _header.size:
+            magic, self.version, self.flags, self.count, raw_count, self.source_size, self.source_mtime, *self.bounds = _header.unpack_from(self._view, 0)
+        else:
+            magic = None                # file from an older version or corrupted
+        self._arrays = []
+        if magic != SIDECAR_MAGIC or self.version != SIDECAR_VERSION:
+            self.count = 0
+            raw_count = 0
+            self.version = -1
+            self.flags = 0
+            self.bounds = [0, 1, 0, 1]
+        offset = _header.size
+        self.codes,         offset = self._get_array(offset, "B", self.count)
+        self.x,             offset = self._get_array(offset, "d", self.count)
+        self.y,             offset = self._get_array(offset, "d", self.count)
+        self.f,             offset = self._get_array(offset, "f", self.count)
+        raw_records,        offset = self._get_array(offset, "I", raw_count)
+        raw_offsets,        offset = self._get_array(offset, "I", raw_count + 1 if raw_count else 0)
+        # the raw commands are few: they are decoded once and kept in a dict
+        self._raw = {raw_records[k]: bytes(self._view[offset + raw_offsets[k]: offset + raw_offsets[k+1]]).decode() for k in range(raw_count)}
+
+    def _get_array(self, offset, typecode, length):
+        size = struct.calcsize(typecode)*length
+        res = self._view[offset: offset + size].cast(typecode)
+        self._arrays.append(res)
+        return res, offset + size + _padding(size)
+
+    def is_valid_for(self, gcode_path):
+        """Checks that the sidecar was generated from the current version of the .gcode file"""
+        if self.version != SIDECAR_VERSION:
+            return False
+        try:
+            return (self.source_size, self.source_mtime) == _source_signature(gcode_path)
+        except OSError:
+            return False
+
+    def is_pre_transformed(self):
+        return bool(self.flags & FLAG_PRE_TRANSFORMED)
+
+    def __len__(self):
+        return self.count
+
+    def get_command(self, index):
+        """Returns the GcodeCommand of the given record"""
+        code = self.codes[index]
+        op = code & OP_MASK
+        if op == OP_RAW:
+            command = tokenize(self._raw[index])
+            return command
+        return GcodeCommand(
+            _op_commands[op],
+            x = self.x[index] if code & HAS_X else None,
+            y = self.y[index] if code & HAS_Y else None,
+            f = self.f[index] if code & HAS_F else None)
+
+    def get_feedrate(self, index):
+        """Returns the feedrate set by the given record or by the last record before it that sets the feedrate (None if not set)"""
+        f = self.f
+        for i in range(index, -1, -1):
+            if f[i] == f[i]:            # NaN if the record does not set the feedrate
+                return f[i]
+        return None
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, path=None, fit=None, start=0):
+        """
+            Yields the position after each record and the record command: (x, y, command)
+            The path transformed with a filter can be used instead of the original one (see "load_transformed_path")
+            The first "start" records of the path are skipped (used to resume a drawing)
+            An arc that the filter cannot transform is yielded as several segments: the position is None on all of them but the last one
+        """
+        if path is None:
+            x, y = self.x, self.y
+            for i in range(start, self.count):
+                yield x[i], y[i], self.get_command(i)
+            return
+        x, y, arcs, feedrates = path.x, path.y, path.arcs, path.feedrates
+        indices = path.get_indices()
+        codes, f = self.codes, self.f
+        last_feedrate = None
+        for k, i in enumerate(indices[start:], start):
+            code = codes[i]
+            op = code & OP_MASK
+            feedrate = f[i] if code & HAS_F else None
+            if not feedrates is None:
+                planned = feedrates[k]
+                if planned == planned:              # NaN if the record is not planned
+                    # the planned feedrate replaces the one of the drawing and is sent only when it changes
+                    feedrate = planned if planned != last_feedrate else None
+                    last_feedrate = planned
+                else:
+                    last_feedrate = None            # the record may change the feedrate
+            if i in arcs:
+                arc_i, arc_j, clockwise = arcs[i]
+                command = GcodeCommand("G2" if clockwise else "G3", x[i], y[i], feedrate, arc_i, arc_j)
+            elif op == OP_RAW:
+                command = tokenize(self._raw[i])
+                if not command.x is None or not command.y is None:
+                    start_point = (self.x[indices[k-1]], self.y[indices[k-1]]) if k > 0 else (0, 0)
+                    commands = fit.transform_command(command, x[i], y[i], start_point)
+                    for c in commands[:-1]:
+                        yield None, None, c
+                    command = commands[-1]
+            elif code & (HAS_X | HAS_Y):
+                # both the axes are necessary because the filter may rotate or swap them
+                command = GcodeCommand(_op_commands[op], x[i], y[i], feedrate)
+            else:
+                command = GcodeCommand(_op_commands[op], f = feedrate)
+            yield x[i], y[i], command
+
+    def close(self):
+        for a in self._arrays:
+            a.release()
+        self._arrays = []
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_drawing_fit_dimensions(sidecar, device):
+    """Returns the dimensions for the Fit filter used to play the drawing (device: device settings, values only)"""
+    dims = get_fit_dimensions(*sidecar.bounds, device, sidecar.is_pre_transformed())
+    if sidecar.is_pre_transformed():
+        # pre-transformed drawings are already in the table coordinates
+        dims["offset_x"] = 0
+        dims["offset_y"] = 0
+    return dims
+
+class TransformedPath():
+    """
+        Path of a drawing transformed for the table
+         * x, y: coordinates of all the records of the sidecar
+         * indices: records to play (None to play all the records)
+         * arcs: arcs that replace the records between two indices: {index of the last record: (i, j, clockwise)}
+         * feedrates: planned feedrate of every record to play (None if the feedrate is not planned)
+         * index: cumulative length and estimated time of the records to play (see "PathIndex", set by "load_transformed_path")
+         * key: cache key of the path (filter and optimization settings, set by "load_transformed_path")
+    """
+    def __init__(self, x, y, indices=None, arcs=None, feedrates=None):
+        self.x = x
+        self.y = y
+        self.indices = indices
+        self.arcs = arcs if not arcs is None else {}
+        self.feedrates = feedrates
+        self.index = None
+        self.key = None
+
+    def get_indices(self):
+        """Returns the indices of the records to play"""
+        return range(len(self.x)) if self.indices is None else self.indices
+
+    def get_length(self, stop=None):
+        """Returns the length of the path (mm) until the given position (number of records played)"""
+        x, y, arcs = self.x, self.y, self.arcs
+        indices = self.get_indices()[:stop]
+        length = 0
+        last_x, last_y = 0, 0
+        for i in indices:
+            if i in arcs:
+                arc_i, arc_j, clockwise = arcs[i]
+                length += arc_length(last_x, last_y, x[i], y[i], arc_i, arc_j, clockwise)
+            else:
+                length += math.hypot(x[i] - last_x, y[i] - last_y)
+            last_x, last_y = x[i], y[i]
+        return length
+
+def _pad(f, size):
+    f.write(bytes(_padding(size)))
+
+def _read_transformed_path(path, sidecar):
+    with open(path, "rb") as f:
+        magic, version, flags, count, size, mtime, kept, arcs_count = _transformed_header.unpack(f.read(_transformed_header.size))
+        if (magic, version, count, size, mtime) != (TRANSFORMED_MAGIC, TRANSFORMED_VERSION, sidecar.count, sidecar.source_size, sidecar.source_mtime):
+            return None
+        x, y = array("d"), array("d")
+        x.fromfile(f, count)
+        y.fromfile(f, count)
+        indices = None
+        if flags & FLAG_HAS_INDICES:
+            indices = array("I")
+            indices.fromfile(f, kept)
+            f.read(_padding(kept*4))
+        arc_records, arc_i, arc_j, arc_clockwise = array("I"), array("d"), array("d"), array("B")
+        arc_records.fromfile(f, arcs_count)
+        f.read(_padding(arcs_count*4))
+        arc_i.fromfile(f, arcs_count)
+        arc_j.fromfile(f, arcs_count)
+        arc_clockwise.fromfile(f, arcs_count)
+        arcs = {r: (i, j, bool(c)) for r, i, j, c in zip(arc_records, arc_i, arc_j, arc_clockwise)}
+        feedrates = None
+        if flags & FLAG_HAS_FEEDRATES:
+            f.read(_padding(arcs_count))
+            feedrates = array("f")
+            feedrates.fromfile(f, kept)
+        return TransformedPath(x, y, indices, arcs, feedrates)
+
+def _write_transformed_path(path, sidecar, transformed):
+    indices = transformed.indices
+    records = sorted(transformed.arcs.keys())
+    flags = FLAG_HAS_INDICES if not indices is None else 0
+    if not transformed.feedrates is None:
+        flags |= FLAG_HAS_FEEDRATES
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_transformed_header.pack(TRANSFORMED_MAGIC, TRANSFORMED_VERSION, flags, sidecar.count, sidecar.source_size, sidecar.source_mtime,
+            len(indices) if not indices is None else sidecar.count, len(records)))
+        transformed.x.tofile(f)
+        transformed.y.tofile(f)
+        if not indices is None:
+            indices.tofile(f)
+            _pad(f, len(indices)*4)
+        array("I", records).tofile(f)
+        _pad(f, len(records)*4)
+        array("d", [transformed.arcs[r][0] for r in records]).tofile(f)
+        array("d", [transformed.arcs[r][1] for r in records]).tofile(f)
+        array("B", [transformed.arcs[r][2] for r in records]).tofile(f)
+        if not transformed.feedrates is None:
+            _pad(f, len(records))
+            transformed.feedrates.tofile(f)
+    os.replace(tmp_path, path)
+
+def _read_path_index(path, sidecar, transformed):
+    with open(path, "rb") as f:
+        magic, version, flags, count, size, mtime, kept = _index_header.unpack(f.read(_index_header.size))
+        if (magic, version, count, size, mtime, kept) != (INDEX_MAGIC, INDEX_VERSION, sidecar.count, sidecar.source_size, sidecar.source_mtime, len(transformed.get_indices())):
+            return None
+        length, time = array("d"), array("d")
+        length.fromfile(f, kept)
+        time.fromfile(f, kept)
+        return PathIndex.from_lengths(transformed, length, time)
+
+def _write_path_index(path, sidecar, index):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_index_header.pack(INDEX_MAGIC, INDEX_VERSION, 0, sidecar.count, sidecar.source_size, sidecar.source_mtime, len(index)))
+        index.length.tofile(f)
+        index.time.tofile(f)
+    os.replace(tmp_path, path)
+
+def estimate_feedrates(sidecar, transformed, planner_limits=None):
+    """
+        Returns the feedrate (mm/min) expected for every record to play of the transformed path (used to estimate the time of the drawing)
+         * planned records: the planned feedrate
+         * other feed moves: the feedrate of the drawing, limited by the speed that the acceleration allows on short segments and turns
+         * rapid moves: the max feedrate
+    """
+    acceleration, max_feedrate = planner_limits if not planner_limits is None else (DEFAULT_ACCELERATION, DEFAULT_MAX_FEEDRATE)
+    indices = transformed.get_indices()
+    codes, f = sidecar.codes, sidecar.f
+    # the feedrate of the drawing is modal: the records removed by the simplification may not change it (see "is_removable")
+    drawing = array("f")
+    feedrate, r = DEFAULT_FEEDRATE, 0
+    for i in indices:
+        while r <= i:
+            if codes[r] & HAS_F:
+                feedrate = f[r]
+            r += 1
+        drawing.append(feedrate)
+    planned = transformed.feedrates
+    if planned is None:
+        plannable = bytes((c & OP_MASK) == OP_G1 for c in codes)
+        planned = plan_feedrates(transformed.x, transformed.y, transformed.indices, transformed.arcs, plannable, acceleration, max(drawing, default=max_feedrate))
+        planned = array("f", (min(p, d) if p == p else d for p, d in zip(planned, drawing)))
+    result = array("f")
+    for k, i in enumerate(indices):
+        if codes[i] & OP_MASK == OP_G0:
+            result.append(max_feedrate)
+        else:
+            result.append(planned[k] if planned[k] == planned[k] else drawing[k])
+    return result
+
+def load_transformed_path(gcode_path, sidecar, fit, tolerance=0, arc_tolerance=0, planner_limits=None, logger=None):
+    """
+        Returns the TransformedPath of the sidecar records with the given Fit filter
+        The path can be optimized (the tolerances are in mm, 0 to disable):
+         * tolerance: the path is simplified (see "path_simplification")
+         * arc_tolerance: the runs of points on a circle are replaced by arcs (see "arc_fitting")
+        The feedrate of the moves is planned if the planner limits (acceleration, max feedrate) are given (see "feedrate_planner")
+        The result is cached next to the drawing and is calculated again only when the filter parameters (device settings) change
+        The cumulative length and estimated time of the path ("index" attribute) are cached in the same way (and built for the old drawings when missing)
+    """
+    base_path = os.path.splitext(gcode_path)[0]
+    key = fit.get_hash()
+    if tolerance > 0:
+        key += "_s" + format_number(tolerance)
+    if arc_tolerance > 0:
+        key += "_a" + format_number(arc_tolerance)
+    if not planner_limits is None:
+        key += "_p{}_{}".format(*[format_number(v) for v in planner_limits])
+    path = "{}_{}{}".format(base_path, key, TRANSFORMED_EXTENSION)
+    try:
+        transformed = _read_transformed_path(path, sidecar)
+    except (OSError, EOFError, struct.error):
+        transformed = None
+    if transformed is None:
+        transformed = _transform_path(sidecar, fit, tolerance, arc_tolerance, planner_limits, logger)
+        # removes the files cached with the old settings
+        for old_path in glob.glob("{}_*{}".format(glob.escape(base_path), TRANSFORMED_EXTENSION)) + glob.glob("{}_*{}".format(glob.escape(base_path), INDEX_EXTENSION)):
+            os.remove(old_path)
+        _write_transformed_path(path, sidecar, transformed)
+    transformed.key = key
+
+    index_path = "{}_{}{}".format(base_path, key, INDEX_EXTENSION)
+    try:
+        transformed.index = _read_path_index(index_path, sidecar, transformed)
+    except (OSError, EOFError, struct.error):
+        transformed.index = None
+    if transformed.index is None:
+        transformed.index = PathIndex.from_path(transformed, estimate_feedrates(sidecar, transformed, planner_limits))
+        _write_path_index(index_path, sidecar, transformed.index)
+    return transformed
+
+def _transform_path(sidecar, fit, tolerance, arc_tolerance, planner_limits, logger):
+    x, y = fit.transform_arrays(sidecar.x, sidecar.y)
+    transformed = TransformedPath(x, y)
+    # the optimizations are done on the transformed coordinates because the tolerances are in mm
+    if tolerance > 0 or arc_tolerance > 0:
+        removable = bytes(is_removable(c) for c in sidecar.codes)
+    if tolerance > 0:
+        fixed = bytes(not r for r in removable)
+        transformed.indices, report = simplify_path(x, y, sidecar.f, tolerance, fixed)
+        if not logger is None:
+            logger.info("Drawing simplified with a {tolerance:.3f} mm tolerance: {points_in} -> {points_out} points, estimated time saved: {estimated_time_saved:.0f} s".format(**report))
+    if arc_tolerance > 0:
+        points_in = len(transformed.indices) if not transformed.indices is None else sidecar.count
+        transformed.indices, transformed.arcs = fit_arcs(x, y, transformed.indices, removable, arc_tolerance)
+        if not logger is None:
+            logger.info("Arc fitting with a {:.3f} mm tolerance: {} -> {} commands ({} arcs)".format(arc_tolerance, points_in, len(transformed.indices), len(transformed.arcs)))
+    if not planner_limits is None:
+        plannable = bytes((c & OP_MASK) == OP_G1 for c in sidecar.codes)
+        transformed.feedrates = plan_feedrates(x, y, transformed.indices, transformed.arcs, plannable, *planner_limits)
+        if not logger is None:
+            logger.info("Feedrate planned with {:.0f} mm/s^2 acceleration and {:.0f} mm/min max feedrate".format(*planner_limits))
+    return transformed
@@ -0,0 +1,225 @@
+import re
+from array import array
+
+# Gcode line tokenizer
+# Parses a line once into a GcodeCommand object that can be passed around (drawing element -> feeder) without parsing the text again
+# This is the only gcode parser of the project: feeder, drawing elements, emulator, rescalers and thumbnails use it
+#  * tokenize: single line. Lines with the words separated by spaces ("G1 X10 Y-2.5 F3000") are split, the other ones ("G1X10Y-2.5") are parsed with a regex
+#  * tokenize_all: whole file at once, the values are collected in arrays
+
+MOTION_COMMANDS = {"G0": "G0", "G00": "G0", "G1": "G1", "G01": "G1", "G2": "G2", "G02": "G2", "G3": "G3", "G03": "G3"}
+STRAIGHT_MOTION_COMMANDS = ("G0", "G1")
+
+_word_regex = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")  # a letter followed by a number (spaces between the words are optional)
+_token_regex = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))|(\S)")  # as above but also returns the characters that are not part of a word (third group)
+_feed_regex = re.compile(r"F\s*[-+]?(?:\d+\.?\d*|\.\d+)")
+
+def format_number(value):
+    """Formats a coordinate with at most 4 decimals and without trailing zeros"""
+    return "{:.4f}".format(value).rstrip("0").rstrip(".")
+
+class GcodeCommand():
+    """
+        Single gcode line
+         * command: "G0", "G1", "G2", "G3" (normalized) or any other command ("M114", "G28", ...). None if the line contains only coordinates (modal command)
+           If the line contains several commands the motion command is used wherever it is ("G90 G1 X10" -> "G1")
+         * x, y, f, i, j: values of the parameters (None if not available in the line)
+         * line: cleaned line (uppercase, without comments). None if the command was created from the values directly
+         * extra: True if the line contains something that is not a command followed by X, Y, F, I, J parameters
+    """
+    __slots__ = ("command", "x", "y", "f", "i", "j", "line", "extra")
+
+    def __init__(self, command=None, x=None, y=None, f=None, i=None, j=None, line=None, extra=False):
+        self.command = command
+        self.x = x
+        self.y = y
+        self.f = f
+        self.i = i
+        self.j = j
+        self.line = line
+        self.extra = extra
+
+    def is_move(self):
+        """Returns True for a straight move with only X, Y, F parameters (G0/G1)"""
+        return self.command in STRAIGHT_MOTION_COMMANDS and not self.extra
+
+    def with_feedrate(self, feedrate):
+        """Returns a copy of the command using the given feedrate"""
+        if self.extra:
+            line = str(self)
+            if "F" in line:
+                line = _feed_regex.sub("F{:.0f}".format(feedrate), line, count=1)
+            else: line = line + " F{:.0f}".format(feedrate)
+            return GcodeCommand(self.command, self.x, self.y, feedrate, self.i, self.j, line=line, extra=True)
+        return GcodeCommand(self.command, self.x, self.y, feedrate, self.i, self.j)
+
+    def with_position(self, x, y, i=None, j=None, command=None):
+        """Returns a copy of the command moving to the given position (and with the given arc center and command if not None)"""
+        command = command if not command is None else self.command
+        if self.extra:
+            values = {"X": x, "Y": y, "I": i, "J": j}
+            def replace(match):
+                letter = match.group(1)
+                if letter in values and not values[letter] is None:
+                    return letter + format_number(values.pop(letter))
+                if letter in "GM" and letter + match.group(2) in MOTION_COMMANDS:
+                    return command
+                return match.group(0)
+            line = _word_regex.sub(replace, str(self))
+            for letter in ("X", "Y", "I", "J"):             # the parameter may be missing in the original line
+                if not values.get(letter) is None:
+                    line += " {}{}".format(letter, format_number(values[letter]))
+            return GcodeCommand(command, x, y, self.f, i, j, line=line, extra=True)
+        return GcodeCommand(command, x, y, self.f, i, j)
+
+    def __str__(self):
+        if not self.line is None:
+            return self.line
+        words = [self.command] if not self.command is None else []
+        if not self.x is None:
+            words.append("X" + format_number(self.x))
+        if not self.y is None:
+            words.append("Y" + format_number(self.y))
+        if not self.i is None:
+            words.append("I" + format_number(self.i))
+        if not self.j is None:
+            words.append("J" + format_number(self.j))
+        if not self.f is None:
+            words.append("F" + format_number(self.f))
+        return " ".join(words)
+
+    def __repr__(self):
+        return "GcodeCommand({})".format(str(self))
+
+
+def clean_line(line):
+    """Removes comments and spaces at the beginning and the end of the line and converts it to uppercase"""
+    if ";" in line:
+        line = line.split(";", 1)[0]
+    if "(" in line:
+        line = line.split("(", 1)[0]
+    return line.strip().upper()
+
+def _set_command(res, word):
+    """Sets the command of the line. With several commands in the same line the motion command has the precedence"""
+    if res.command is None:
+        res.command = MOTION_COMMANDS.get(word, word)
+        return
+    res.extra = True                                    # additional commands in the same line
+    if word in MOTION_COMMANDS and not res.command in MOTION_COMMANDS:
+        res.command = MOTION_COMMANDS[word]
+
+def _split_words(res, line):
+    """Fast path: parses a line with the words separated by spaces. Returns False if a word is not a letter followed by a number"""
+    for word in line.split():
+        letter = word[0]
+        value = word[1:]
+        if letter == "G" or letter == "M":
+            if not value.isdigit():
+                return False                            # "G28.1", compact lines ("G1X10"), ...
+            _set_command(res, word)
+            continue
+        if "E" in value or "N" in value or "_" in value:    # exponents, "INF", "NAN" and "1_000" are accepted by "float" but are not gcode numbers
+            return False
+        try:
+            number = float(value)
+        except ValueError:
+            return False
+        if letter == "X":
+            res.x = number
+        elif letter == "Y":
+            res.y = number
+        elif letter == "F":
+            res.f = number
+        elif letter == "I":
+            res.i = number
+        elif letter == "J":
+            res.j = number
+        else:
+            res.extra = True                            # additional parameters (Z, N, S, ...)
+    return True
+
+def tokenize(line):
+    """
+        Parses a gcode line
+        Returns a GcodeCommand or None if the line is empty or contains only comments
+    """
+    line = clean_line(line)
+    if line == "" or line[0] == "%":
+        return None
+    res = GcodeCommand(line=line)
+    if " " in line:
+        if _split_words(res, line):
+            return res
+        res = GcodeCommand(line=line)
+    words = 0
+    for letter, value, other in _token_regex.findall(line):
+        if other:
+            res.extra = True                # something that is not a word (macros, "*" checksums, "$" commands, ...)
+            continue
+        words += 1
+        if letter == "X":
+            res.x = float(value)
+        elif letter == "Y":
+            res.y = float(value)
+        elif letter == "F":
+            res.f = float(value)
+        elif letter == "I":
+            res.i = float(value)
+        elif letter == "J":
+            res.j = float(value)
+        elif letter == "G" or letter == "M":
+            _set_command(res, letter + value)
+        else:
+            res.extra = True            # additional commands or parameters in the same line (Z, N, ...)
+    if words == 0:
+        res.extra = True                # "$" commands and other non standard lines
+    return res
+
+
+class GcodeArrays():
+    """
+        Lines of a whole file parsed at once (only the lines with a command, the empty lines and the comments are skipped)
+         * commands: list of the commands (as in GcodeCommand)
+         * x, y, f, i, j: arrays of doubles with the values of the parameters (nan if the parameter is not in the line)
+         * extra: bytearray with 1 for the lines with something more than a command with X, Y, F, I, J parameters
+         * lines: list of the cleaned lines
+         * line_numbers: index of the line in the source
+    """
+    def __init__(self):
+        self.commands = []
+        self.x = array("d")
+        self.y = array("d")
+        self.f = array("d")
+        self.i = array("d")
+        self.j = array("d")
+        self.extra = bytearray()
+        self.lines = []
+        self.line_numbers = array("I")
+
+    def __len__(self):
+        return len(self.commands)
+
+    def get_command(self, index):
+        """Returns the GcodeCommand of the given line"""
+        value = lambda a: a[index] if a[index] == a[index] else None       # nan -> None
+        return GcodeCommand(self.commands[index], value(self.x), value(self.y), value(self.f), value(self.i), value(self.j), line=self.lines[index], extra=bool(self.extra[index]))
+
+def tokenize_all(lines):
+    """Parses all the lines (file object or list of strings) and returns a GcodeArrays object"""
+    res = GcodeArrays()
+    nan = float("nan")
+    for n, line in enumerate(lines):
+        command = tokenize(line)
+        if command is None:
+            continue
+        res.commands.append(command.command)
+        res.x.append(command.x if not command.x is None else nan)
+        res.y.append(command.y if not command.y is None else nan)
+        res.f.append(command.f if not command.f is None else nan)
+        res.i.append(command.i if not command.i is None else nan)
+        res.j.append(command.j if not command.j is None else nan)
+        res.extra.append(command.extra)
+        res.lines.append(command.line)
+        res.line_numbers.append(n)
+    return res
@@ -0,0 +1,64 @@
+import re
+from functools import lru_cache
+from threading import Lock
+
+from py_expression_eval import Parser
+
+# Macros: expressions between two MACRO_CHAR symbols evaluated with the current position and feedrate (i.e. "G1 X&x+10& Y&y&")
+# Parsing an expression is much slower than evaluating it: the commands are split in text and parsed expressions once
+# and kept in a LRU cache (the scripts and the patterns repeat the same commands). Only "evaluate" runs for every line.
+# see https://pypi.org/project/py-expression-eval/ for more info about the parser
+
+MACRO_CHAR = "&"
+MACRO_CACHE_SIZE = 256      # number of different commands with macros kept parsed
+
+_macro_regex = re.compile(MACRO_CHAR + "(.*?)" + MACRO_CHAR)     # looks for stuff between two "&" symbols
+_parser = Parser()
+_parser_mutex = Lock()                                          # the parser keeps its state while parsing
+
+# returns a tuple of parts: strings (text) or (macro, parsed expression) tuples
+# the macros that cannot be parsed have None as expression (the text of the macro is left in the command)
+@lru_cache(maxsize=MACRO_CACHE_SIZE)
+def compile_macros(command):
+    parts = []
+    for n, part in enumerate(_macro_regex.split(command)):
+        if n % 2 == 0:
+            if part != "":
+                parts.append(part)
+            continue
+        try:
+            with _parser_mutex:
+                parts.append((part, _parser.parse(part)))
+        except Exception:
+            parts.append((part, None))
+    return tuple(parts)
+
+# precompiles the commands of a script: returns the list of the macros that cannot be parsed
+def compile_script(script):
+    errors = []
+    for line in script.split("\n"):
+        if MACRO_CHAR in line:
+            errors += [part[0] for part in compile_macros(line) if not isinstance(part, str) and part[1] is None]
+    return errors
+
+# replaces the macros of the command with their values
+#  * variables: dict with the values of the variables used in the expressions
+#  * on_error: called with the macro and the exception when a macro cannot be parsed or evaluated (the text of the macro is left in the command)
+def evaluate_macros(command, variables, on_error=None):
+    if not MACRO_CHAR in command:
+        return command
+    res = []
+    for part in compile_macros(command):
+        if isinstance(part, str):
+            res.append(part)
+            continue
+        macro, expression = part
+        try:
+            if expression is None:
+                raise ValueError("Cannot parse the expression")
+            res.append(str(expression.evaluate(variables)))
+        except Exception as e:
+            res.append(MACRO_CHAR + macro + MACRO_CHAR)
+            if not on_error is None:
+                on_error(macro, e)
+    return "".join(res)
@@ -0,0 +1,170 @@
+from array import array
+from time import perf_counter
+from threading import Lock
+
+# Lightweight metrics used to check where the time goes while streaming a drawing (see "/api/metrics")
+#  * Counter: monotonic counter
+#  * Gauge: value that can go up and down
+#  * Histogram: log-linear histogram of durations (HDR style): every power of two of microseconds is split in 8 buckets (12.5% precision).
+#    Recording a value is an index calculation and an increment of a preallocated array: cheap enough to leave the metrics always on
+# The histograms are written without locks: concurrent updates of the same histogram may rarely lose a sample, that is acceptable for statistics.
+
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_BITS = 40                               # about 12 days in microseconds
+BUCKETS = SUB_BUCKETS*(MAX_BITS - SUB_BUCKET_BITS + 1)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+PREFIX = "sandypi_"
+
+def _bucket_index(us):
+    if us < SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - SUB_BUCKET_BITS - 1
+    return min(SUB_BUCKETS*(shift + 1) + ((us >> shift) & (SUB_BUCKETS - 1)), BUCKETS - 1)
+
+def _bucket_upper_bound(index):
+    if index < SUB_BUCKETS:
+        return index + 1
+    shift = index//SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS) + SUB_BUCKETS + 1) << shift
+
+class Counter():
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def reset(self):
+        self.value = 0
+
+class Gauge():
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def reset(self):
+        self.value = 0
+
+class Histogram():
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.reset()
+
+    def reset(self):
+        self._counts = array("Q", bytes(8*BUCKETS))
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # records a duration in seconds
+    def record(self, seconds):
+        self._counts[_bucket_index(int(seconds*1e6))] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # returns the value (seconds) below which the given fraction of the samples falls (upper bound of the bucket)
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        target = q*self.count
+        total = 0
+        for index, c in enumerate(self._counts):
+            total += c
+            if c > 0 and total >= target:
+                return min(_bucket_upper_bound(index)/1e6, self.max)
+        return self.max
+
+    # measures the time spent in a "with" block
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum/self.count if self.count > 0 else 0,
+            "max": self.max,
+            "quantiles": {str(q): self.quantile(q) for q in QUANTILES}
+        }
+
+class _Timer():
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._histogram.record(perf_counter() - self._start)
+
+class Metrics():
+    def __init__(self):
+        self._mutex = Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, description):
+        with self._mutex:
+            if not name in self._metrics:
+                self._metrics[name] = cls(name, description)
+            return self._metrics[name]
+
+    def counter(self, name, description=""):
+        return self._get(Counter, name, description)
+
+    def gauge(self, name, description=""):
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name, description=""):
+        return self._get(Histogram, name, description)
+
+    def reset(self):
+        with self._mutex:
+            for m in self._metrics.values():
+                m.reset()
+
+    def snapshot(self):
+        with self._mutex:
+            metrics = list(self._metrics.values())
+        return {
+            "counters": {m.name: m.value for m in metrics if isinstance(m, Counter)},
+            "gauges": {m.name: m.value for m in metrics if isinstance(m, Gauge)},
+            "histograms": {m.name: m.snapshot() for m in metrics if isinstance(m, Histogram)}
+        }
+
+    # Prometheus text exposition format: the histograms are exported as summaries (quantiles, sum and count, in seconds)
+    def to_prometheus(self):
+        with self._mutex:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for m in metrics:
+            name = PREFIX + m.name
+            lines.append("# HELP {} {}".format(name, m.description))
+            if isinstance(m, Counter):
+                lines.append("# TYPE {} counter".format(name))
+                lines.append("{} {}".format(name, m.value))
+            elif isinstance(m, Gauge):
+                lines.append("# TYPE {} gauge".format(name))
+                lines.append("{} {}".format(name, m.value))
+            else:
+                lines.append("# TYPE {} summary".format(name))
+                for q in QUANTILES:
+                    lines.append('{}{{quantile="{}"}} {:.9f}'.format(name, q, m.quantile(q)))
+                lines.append("{}_sum {:.9f}".format(name, m.sum))
+                lines.append("{}_count {}".format(name, m.count))
+        return "\n".join(lines) + "\n"
+
+# metrics of the application
+metrics = Metrics()
@@ -0,0 +1,120 @@
+import math
+from array import array
+from bisect import bisect_left
+
+from server.utils.arc_fitting import arc_length
+
+"""
+    Cumulative length and estimated time of the path of a drawing
+
+    Used to map the position reported by the device onto the drawing (see "PositionTracker") and to calculate the progress and the ETA:
+     * x, y: end point of every command played (same coordinates of the lines sent to the device)
+     * length: length of the path at the end of every command [mm]
+     * time: estimated time at the end of every command [s] (zeros if the feedrates are not known)
+    The lengths and times are computed when the drawing is precompiled and cached next to it (see "load_transformed_path")
+    The command k moves from the end of the command k-1 (the origin for the first command) to (x[k], y[k]). The arcs are measured along the arc
+    but are located and interpolated along their chord.
+"""
+
+class PathIndex():
+    def __init__(self, x, y, length, time=None):
+        self.x = x
+        self.y = y
+        self.length = length
+        self.time = time if not time is None else array("d", bytes(8*len(length)))
+
+    @classmethod
+    def from_path(cls, path, feedrates=None):
+        """
+            Builds the index of a TransformedPath (see "gcode_sidecar")
+            The time is estimated with the feedrate of every command [mm/min] (the commands without a feedrate take no time)
+        """
+        px, py, arcs = path.x, path.y, path.arcs
+        x, y, length, time = array("d"), array("d"), array("d"), array("d")
+        last_x, last_y, total, total_time = 0.0, 0.0, 0.0, 0.0
+        for k, i in enumerate(path.get_indices()):
+            if i in arcs:
+                arc_i, arc_j, clockwise = arcs[i]
+                segment = arc_length(last_x, last_y, px[i], py[i], arc_i, arc_j, clockwise)
+            else:
+                segment = math.hypot(px[i] - last_x, py[i] - last_y)
+            total += segment
+            if not feedrates is None and feedrates[k] > 0:
+                total_time += segment*60/feedrates[k]
+            last_x, last_y = px[i], py[i]
+            x.append(last_x)
+            y.append(last_y)
+            length.append(total)
+            time.append(total_time)
+        return cls(x, y, length, time)
+
+    @classmethod
+    def from_lengths(cls, path, length, time):
+        """Builds the index of a TransformedPath with the lengths and times already calculated"""
+        px, py = path.x, path.y
+        indices = path.get_indices()
+        return cls(array("d", (px[i] for i in indices)), array("d", (py[i] for i in indices)), length, time)
+
+    def __len__(self):
+        return len(self.length)
+
+    def get_total_length(self):
+        return self.length[-1] if len(self.length) > 0 else 0
+
+    def get_total_time(self):
+        return self.time[-1] if len(self.time) > 0 else 0
+
+    def get_length(self, count):
+        """Returns the length of the path at the end of the first "count" commands"""
+        if count <= 0 or len(self.length) == 0:
+            return 0
+        return self.length[min(count, len(self.length)) - 1]
+
+    def get_time_at(self, length):
+        """Returns the estimated time to reach the given length of the path"""
+        if len(self.length) == 0:
+            return 0
+        k = min(bisect_left(self.length, length), len(self.length) - 1)
+        previous_length, previous_time = (self.length[k-1], self.time[k-1]) if k > 0 else (0, 0)
+        segment = self.length[k] - previous_length
+        t = 0 if segment <= 0 else min(max((length - previous_length)/segment, 0), 1)
+        return previous_time + t*(self.time[k] - previous_time)
+
+    def _segment(self, k):
+        x0, y0 = (self.x[k-1], self.y[k-1]) if k > 0 else (0.0, 0.0)
+        return x0, y0, self.x[k] - x0, self.y[k] - y0
+
+    def locate(self, x, y, start, stop, tolerance):
+        """
+            Returns the command and the length of the path at the point closest to (x, y): (k, length)
+            Only the commands from "start" to "stop" (excluded) are checked. The device moves forward along the path: the first run of commands closer
+            than the tolerance is used (the path may pass again on the same point later)
+            Returns None if there are no commands to check
+        """
+        stop = min(stop, len(self.length))
+        best = None
+        for k in range(max(start, 0), stop):
+            x0, y0, dx, dy = self._segment(k)
+            squared = dx*dx + dy*dy
+            t = 0 if squared == 0 else min(max(((x - x0)*dx + (y - y0)*dy)/squared, 0), 1)
+            distance = math.hypot(x0 + t*dx - x, y0 + t*dy - y)
+            if best is None or distance < best[0]:
+                best = (distance, k, t)
+            elif best[0] <= tolerance and distance > tolerance:
+                break
+        if best is None:
+            return None
+        _, k, t = best
+        previous = self.length[k-1] if k > 0 else 0
+        return k, previous + t*(self.length[k] - previous)
+
+    def position_at(self, length):
+        """Returns the point of the path at the given length: (k, x, y)"""
+        if len(self.length) == 0:
+            return 0, 0.0, 0.0
+        k = min(bisect_left(self.length, length), len(self.length) - 1)
+        x0, y0, dx, dy = self._segment(k)
+        previous = self.length[k-1] if k > 0 else 0
+        segment = self.length[k] - previous
+        t = 0 if segment <= 0 else min(max((length - previous)/segment, 0), 1)
+        return k, x0 + t*dx, y0 + t*dy
@@ -0,0 +1,118 @@
+from math import sqrt
+from array import array
+
+# Path simplification (Ramer-Douglas-Peucker) for the precompiled drawings
+# Drawings exported with a high resolution contain many almost collinear tiny segments: the controller must slow down to plan them.
+# The points closer to the simplified path than the tolerance are removed.
+# Some points can be marked as fixed (are always kept): the sidecar keeps all the records that are not straight moves (G1) without feedrate changes.
+
+# max number of points simplified together (the simplification keeps at least a point every MAX_SECTION_LENGTH points)
+MAX_SECTION_LENGTH = 4096
+# the tolerance is derived from the ball diameter if not set
+BALL_DIAMETER_TOLERANCE_FACTOR = 0.05
+# used to estimate the time saved: the controller cannot run a segment faster than the time required to receive it (~20 bytes at 115200 baud) and plan it
+MIN_SEGMENT_TIME = 0.002
+# used to estimate the time saved if the drawing does not set the feedrate (mm/min)
+DEFAULT_FEEDRATE = 2000
+
+def get_path_tolerance(device):
+    """Returns the tolerance in mm used to optimize the drawings from the device settings (values only)"""
+    tolerance = float(device.get("simplification_tolerance", 0) or 0)
+    if tolerance <= 0:
+        tolerance = float(device.get("ball_diameter", 0) or 0) * BALL_DIAMETER_TOLERANCE_FACTOR
+    return max(tolerance, 0)
+
+def get_tolerance(device):
+    """Returns the simplification tolerance in mm from the device settings (values only). 0 if the simplification is disabled"""
+    if not device.get("path_simplification", False):
+        return 0
+    return get_path_tolerance(device)
+
+def get_arc_tolerance(device):
+    """Returns the arc fitting tolerance in mm from the device settings (values only). 0 if the arc fitting is disabled"""
+    if not device.get("arc_fitting", False):
+        return 0
+    return get_path_tolerance(device)
+
+def simplify(xs, ys, tolerance, fixed=None):
+    """
+        Returns the indices of the points to keep (array of uint32)
+         * fixed: sequence of flags, the points with a true flag are always kept (None to simplify the full path)
+        Iterative implementation (uses a stack instead of the recursion): works also with millions of points
+    """
+    n = len(xs)
+    keep = bytearray(n)
+    stack = []
+    # the path is split in sections between records that must be kept, every section is simplified separately
+    # long sections are split: unbalanced splits (spirals, circles) would scan the whole section for every point kept
+    start = 0
+    for i in range(n):
+        if i == n-1 or i - start >= MAX_SECTION_LENGTH or (not fixed is None and fixed[i]):
+            keep[i] = 1
+            if i - start > 1:
+                stack.append((start, i))
+            start = i
+    if n > 0:
+        keep[0] = 1
+
+    tolerance_sq = tolerance*tolerance
+    while stack:
+        first, last = stack.pop()
+        x0, y0 = xs[first], ys[first]
+        dx, dy = xs[last] - x0, ys[last] - y0
+        length_sq = dx*dx + dy*dy
+        section = zip(xs[first+1:last], ys[first+1:last])
+        if length_sq > 0:
+            # distance from the line: |cross product| / length
+            c = y0*dx - x0*dy
+            distances = [abs(x*dy - y*dx + c) for x, y in section]
+            farthest = max(distances)
+            max_distance = farthest*farthest/length_sq
+        else:
+            # closed section (the first and last points are the same): uses the distance from the point
+            distances = [(x - x0)**2 + (y - y0)**2 for x, y in section]
+            farthest = max(distances)
+            max_distance = farthest
+        if max_distance > tolerance_sq:
+            index = first + 1 + distances.index(farthest)
+            keep[index] = 1
+            if index - first > 1:
+                stack.append((first, index))
+            if last - index > 1:
+                stack.append((index, last))
+    return array("I", [i for i in range(n) if keep[i]])
+
+def estimate_time(xs, ys, fs, indices=None):
+    """
+        Estimates the time (s) required to draw the path (or only the given points)
+         * fs: feedrate of every point (mm/min, NaN if the point does not change the feedrate)
+        Every segment requires at least MIN_SEGMENT_TIME: this is what makes the dense drawings slow
+    """
+    if indices is None:
+        indices = range(len(xs))
+    total = 0
+    feedrate = DEFAULT_FEEDRATE/60
+    last_x, last_y = 0, 0
+    for i in indices:
+        f = fs[i]
+        if f == f and f > 0:            # NaN if the record does not set the feedrate
+            feedrate = f/60
+        x, y = xs[i], ys[i]
+        total += max(sqrt((x - last_x)**2 + (y - last_y)**2)/feedrate, MIN_SEGMENT_TIME)
+        last_x, last_y = x, y
+    return total
+
+def simplify_path(xs, ys, fs, tolerance, fixed=None):
+    """
+        Simplifies the path and returns the indices of the points to keep and a report with the points in/out and the estimated time saved
+    """
+    indices = simplify(xs, ys, tolerance, fixed)
+    time_in = estimate_time(xs, ys, fs)
+    time_out = estimate_time(xs, ys, fs, indices)
+    report = {
+        "tolerance": tolerance,
+        "points_in": len(xs),
+        "points_out": len(indices),
+        "estimated_time_saved": time_in - time_out
+    }
+    return indices, report
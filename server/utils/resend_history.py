@@ -0,0 +1,48 @@
+from array import array
+
+# History of the last lines sent to the device, used to answer the Marlin "Resend: N" requests
+# Fixed size ring buffer indexed by the line number modulo the capacity: storing a line is a single assignment and
+# a resend is a lookup of the slots from the required line to the last one (no copies or scans of the whole history)
+# The lines are stored already encoded, so that all the lines to resend can be joined in a single write
+
+class ResendHistory():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self._lines = [None]*self.capacity
+        self._numbers = array("q", [-1])*self.capacity      # line number stored in every slot (-1 if empty)
+        self._last = None                                   # number of the last line stored
+
+    def add(self, n, line):
+        slot = n % self.capacity
+        self._lines[slot] = line
+        self._numbers[slot] = n
+        self._last = n
+
+    def get(self, n):
+        slot = n % self.capacity
+        return self._lines[slot] if self._numbers[slot] == n else None
+
+    def get_from(self, n):
+        """
+            Returns the number of the first line available from n (None if there are no lines from n) and the lines from that one to the last line stored
+            The lines older than the capacity of the history are not available anymore
+        """
+        if self._last is None or n > self._last:
+            return None, []
+        first = max(n, self._last - self.capacity + 1)
+        lines = []
+        for k in range(first, self._last + 1):
+            slot = k % self.capacity
+            if self._numbers[slot] != k:                    # the numeration has been reset: the older slots contain stale lines
+                first, lines = k + 1, []
+                continue
+            lines.append(self._lines[slot])
+        if len(lines) == 0:
+            return None, []
+        return first, lines
+
+    def __len__(self):
+        return sum(1 for n in self._numbers if n >= 0)
@@ -0,0 +1,93 @@
+from threading import Condition
+
+# Bounded single producer/single consumer buffer used to connect two threads
+# The producer blocks when the buffer is full and the consumer blocks when it is empty
+# The buffer can be closed from any thread:
+#  * "put" returns False if the buffer has been closed (the producer should stop)
+#  * "get" returns the remaining items and then raises "RingBuffer.Closed" (the consumer should stop)
+# The buffer keeps track of its depth to check which side of the pipeline is the bottleneck
+
+class RingBuffer():
+    class Closed(Exception):
+        pass
+
+    def __init__(self, size):
+        self.size = size
+        self._items = [None]*size
+        self._head = 0                  # next item to read
+        self._count = 0
+        self._closed = False
+        self._condition = Condition()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._condition:
+            self._max_depth = 0
+            self._depth_sum = 0
+            self._gets = 0
+            self._full_waits = 0        # number of times the producer had to wait (consumer is the bottleneck)
+            self._empty_waits = 0       # number of times the consumer had to wait (producer is the bottleneck)
+
+    def put(self, item):
+        with self._condition:
+            if self._count == self.size and not self._closed:
+                self._full_waits += 1
+                while self._count == self.size and not self._closed:
+                    self._condition.wait()
+            if self._closed:
+                return False
+            self._items[(self._head + self._count) % self.size] = item
+            self._count += 1
+            self._max_depth = max(self._max_depth, self._count)
+            self._condition.notify_all()
+            return True
+
+    def get(self):
+        with self._condition:
+            if self._count == 0 and not self._closed:
+                self._empty_waits += 1
+                while self._count == 0 and not self._closed:
+                    self._condition.wait()
+            if self._count == 0:
+                raise RingBuffer.Closed()
+            self._depth_sum += self._count
+            self._gets += 1
+            item = self._items[self._head]
+            self._items[self._head] = None
+            self._head = (self._head + 1) % self.size
+            self._count -= 1
+            self._condition.notify_all()
+            return item
+
+    # closes the buffer: the consumer can still read the items already in the buffer
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    # closes the buffer and drops the items that are still in the buffer
+    def clear(self):
+        with self._condition:
+            self._closed = True
+            self._items = [None]*self.size
+            self._count = 0
+            self._condition.notify_all()
+
+    def is_closed(self):
+        with self._condition:
+            return self._closed
+
+    def __len__(self):
+        with self._condition:
+            return self._count
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "size": self.size,
+                "depth": self._count,
+                "max_depth": self._max_depth,
+                "mean_depth": self._depth_sum / self._gets if self._gets > 0 else 0,
+                "full_waits": self._full_waits,
+                "empty_waits": self._empty_waits
+            }